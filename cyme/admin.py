@@ -12,7 +12,7 @@ from django.utils.translation import ugettext_lazy as _
 from djcelery.admin_utils import action, display_field, fixedwidth
 from djcelery.humanize import naturaldate
 
-from .models import Broker, Instance, Queue
+from .models import Broker, Instance, InstanceQueue, Queue
 from .branch.supervisor import supervisor
 
 
@@ -39,6 +39,11 @@ def status(instance):
             enabled, color, state)
 
 
+class InstanceQueueInline(admin.TabularInline):
+    model = InstanceQueue
+    extra = 1
+
+
 class InstanceAdmin(admin.ModelAdmin):
     detail_title = _('Instance detail')
     list_page_title = _('Instances')
@@ -46,14 +51,16 @@ class InstanceAdmin(admin.ModelAdmin):
     fieldsets = (
             (None, {
                 'fields': ('name', 'max_concurrency', 'min_concurrency',
-                           '_queues', 'is_enabled', '_broker'),
+                           'is_enabled', '_broker'),
                 'classes': ('extrapretty', ),
             }), )
     list_display = (fixedwidth('name', pt=10), maxmin_concurrency,
                     status, 'broker')
     read_only_fields = ('created_at', )
-    list_filter = ('name', 'max_concurrency', 'min_concurrency', '_queues')
-    search_fields = ('name', 'max_concurrency', 'min_concurrency', '_queues')
+    list_filter = ('name', 'max_concurrency', 'min_concurrency')
+    search_fields = ('name', 'max_concurrency', 'min_concurrency',
+                     'instance_queues__queue')
+    inlines = [InstanceQueueInline]
     actions = ['disable_instances',
                'enable_instances',
                'restart_instances']
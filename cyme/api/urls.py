@@ -20,6 +20,7 @@ def _o_(u):
 
 urlpatterns = patterns('',
     (r'^ping/$', views.ping.as_view()),
+    (r'^metrics/?$', views.metrics.as_view()),
     (r'^admin/doc/', include('django.contrib.admindocs.urls')),
 
     (r'^admin/', include(admin.site.urls)),
@@ -33,6 +34,8 @@ urlpatterns = patterns('',
         views.autoscale.as_view()),
     (_o_(r'^APP/instances/!(?P<name>.+)?/stats/?'),
         views.instance_stats.as_view()),
+    (_o_(r'^APP/instances/!(?P<name>.+)?/restarts/?'),
+        views.instance_restarts.as_view()),
     (_o_(r'^APP/instances/!(?P<name>.+?)?/?$'), views.Instance.as_view()),
     (_o_(r'^APP/query/(?P<uuid>.+?)/state/?'), views.task_state.as_view()),
     (_o_(r'^APP/query/(?P<uuid>.+?)/result/?'), views.task_result.as_view()),
@@ -7,9 +7,12 @@ import re
 
 from celery import current_app as celery
 from celery.result import AsyncResult
+from django.http import HttpResponse
 
 from . import web
 from cyme.branch.controller import apps, branches, instances, queues
+from cyme.branch.fleet import fleet
+from cyme.branch.metrics import CONTENT_TYPE, registry
 from cyme.tasks import webhook
 from cyme.utils import uuid
 
@@ -38,7 +41,7 @@ class App(web.ApiView):
 class Instance(web.ApiView):
 
     def get(self, request, app, name=None, nowait=False):
-        return instances.get(name) if name else instances.all(app=app)
+        return instances.get(name) if name else fleet.instances(app=app)
 
     def delete(self, request, app, name, nowait=False):
         return self.Ok(instances.remove(name, nowait=nowait))
@@ -70,7 +73,7 @@ class Consumer(web.ApiView):
 class Queue(web.ApiView):
 
     def get(self, request, app, name=None):
-        return queues.get(name) if name else queues.all()
+        return queues.get(name) if name else fleet.queues()
 
     def delete(self, request, app, name, nowait=False):
         return self.Ok(queues.delete(name))
@@ -149,6 +152,11 @@ def instance_stats(self, request, app, name):
     return instances.stats(name)
 
 
+@web.simple_get
+def instance_restarts(self, request, app, name):
+    return instances.restarts(name)
+
+
 @web.simple_get
 def task_state(self, request, app, uuid):
     return {'state': AsyncResult(uuid).state}
@@ -167,3 +175,8 @@ def task_wait(self, request, app, uuid):
 @web.simple_get
 def ping(self, request):
     return {'ok': 'pong'}
+
+
+@web.simple_get
+def metrics(self, request):
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
@@ -72,15 +72,25 @@ class Env(object):
         celery._pool = pools.connections[celery.broker_connection()]
 
     def syncdb(self, interactive=True):
+        """Create the database tables.
+
+        This runs every time, as syncdb creates the tables added
+        since the database was created, and upgrades data stored by
+        earlier versions (see :mod:`cyme.management`).  It's only
+        interactive (and verbose) when the database is new.
+
+        """
         from django.conf import settings
         from django.db.utils import DEFAULT_DB_ALIAS
         dbconf = settings.DATABASES[DEFAULT_DB_ALIAS]
+        verbosity = 1
         if dbconf['ENGINE'] == 'django.db.backends.sqlite3':
             if Path(dbconf['NAME']).absolute().exists():
-                return
+                interactive, verbosity = False, 0
         gp, getpass.getpass = getpass.getpass, getpass.fallback_getpass
         try:
-            self.management.call_command('syncdb', interactive=interactive)
+            self.management.call_command('syncdb', interactive=interactive,
+                                         verbosity=verbosity)
         finally:
             getpass.getpass = gp
 
@@ -98,6 +108,11 @@ class BaseApp(object):
     def get_version(self):
         return 'cyme v%s' % (__version__, )
 
+    def wants_eventlet(self, argv):
+        """Returns true if eventlet must be set up before running
+        with ``argv``."""
+        return self.needs_eventlet
+
     def run_from_argv(self, argv=None):
         argv = sys.argv if argv is None else argv
         if '--version' in argv:
@@ -105,7 +120,8 @@ class BaseApp(object):
             sys.exit(0)
         try:
             with (self.env or
-                    Env(self.needs_eventlet, self.instance_dir)) as env:
+                    Env(self.wants_eventlet(argv),
+                        self.instance_dir)) as env:
                 return self.run(env, argv)
         except KeyboardInterrupt:
             if DEBUG:
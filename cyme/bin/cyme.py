@@ -5,7 +5,14 @@ from __future__ import absolute_import
 from .base import app
 
 
-@app()
+def wants_eventlet(self, argv):
+    # eventlet must patch the standard library before Django
+    # and celery are set up.
+    from cyme.management.commands.cyme import ROLLING_COMMANDS
+    return bool(ROLLING_COMMANDS.intersection(argv))
+
+
+@app(wants_eventlet=wants_eventlet)
 def cyme(env, argv):
     from cyme.management.commands import cyme
     cyme.Command(env=env).run_from_argv([argv[0], 'cyme'] + argv[1:])
@@ -20,7 +20,7 @@ from . import signals
 from .state import state
 from .thread import gThread
 
-from cyme.utils import find_symbol, instantiate
+from cyme.utils import cached_property, find_symbol, instantiate
 
 
 class MockSup(LogMixin):
@@ -39,6 +39,7 @@ class Branch(gThread):
     controller_cls = '.controller.Controller'
     httpd_cls = '.httpd.HttpServer'
     supervisor_cls = '.supervisor.Supervisor'
+    monitor_cls = '.monitor.EventMonitor'
     intsup_cls = '.intsup.gSup'
 
     _components_ready = {}
@@ -48,7 +49,8 @@ class Branch(gThread):
 
     def __init__(self, addrport='', id=None, loglevel=logging.INFO,
             logfile=None, without_httpd=False, numc=2, sup_interval=None,
-            ready_event=None, colored=None, **kwargs):
+            ready_event=None, colored=None, sup_pool_size=None,
+            spawn_limit=None, **kwargs):
         self.id = id or gen_unique_id()
         if isinstance(addrport, basestring):
             addr, _, port = addrport.partition(':')
@@ -64,18 +66,24 @@ class Branch(gThread):
         self.colored = colored or term.colored(enabled=False)
         self.httpd = None
         gSup = find_symbol(self, self.intsup_cls)
+        if spawn_limit:
+            self.processes.set_spawn_limit(spawn_limit)
         if not self.without_httpd:
             self.httpd = MockSup(instantiate(self, self.httpd_cls, addrport),
                               signals.httpd_ready)
         self.supervisor = gSup(instantiate(self, self.supervisor_cls,
-                                sup_interval), signals.supervisor_ready)
+                                sup_interval, pool_size=sup_pool_size),
+                               signals.supervisor_ready)
+        self.monitor = gSup(instantiate(self, self.monitor_cls),
+                            signals.monitor_ready)
         self.controllers = [gSup(instantiate(self, self.controller_cls,
                                    id='%s.%s' % (self.id, i),
                                    connection=self.connection,
                                    branch=self),
                                  signals.controller_ready)
                                 for i in xrange(1, numc + 1)]
-        c = [self.supervisor] + self.controllers + [self.httpd]
+        c = ([self.supervisor, self.monitor]
+                + self.controllers + [self.httpd])
         c = self.components = list(filter(None, c))
         self._components_ready = dict(zip([z.thread for z in c],
                                           [False] * len(c)))
@@ -102,10 +110,17 @@ class Branch(gThread):
         signals.controller_ready.connect(self._component_ready)
         signals.httpd_ready.connect(self._component_ready)
         signals.supervisor_ready.connect(self._component_ready)
+        signals.monitor_ready.connect(self._component_ready)
         signals.presence_ready.connect(self._component_ready)
         signals.branch_ready.connect(self.on_ready)
         signals.thread_post_shutdown.connect(self._component_shutdown)
 
+    def before(self):
+        self.snapshots.connect()
+        self.start_periodic_timer(self.snapshots.check_interval,
+                                  self.snapshots.check)
+        self.replies.start()
+
     def run(self):
         state.is_branch = True
         signals.branch_startup_request.send(sender=self)
@@ -127,6 +142,8 @@ class Branch(gThread):
                     pass
                 except BaseException, exc:
                     component.error('Error in shutdown: %r', exc)
+        self.replies.stop()
+        self.snapshots.disconnect()
 
     def _component_shutdown(self, sender, **kwargs):
         self._components_shutdown[sender] = True
@@ -141,7 +158,21 @@ class Branch(gThread):
         return {'id': self.id,
                 'loglevel': LOG_LEVELS[self.loglevel],
                 'numc': self.numc,
-                'sup_interval': self.supervisor.interval,
+                'sup_interval': self.supervisor.thread.interval,
+                'sup_pool_size': self.supervisor.thread.pool_size,
+                'spawn_limit': self.processes.spawn_limit,
                 'logfile': self.logfile,
                 'port': port,
                 'url': url}
+
+    @cached_property
+    def processes(self):
+        return find_symbol(self, '.processes.processes')
+
+    @cached_property
+    def snapshots(self):
+        return find_symbol(self, '.snapshots.snapshots')
+
+    @cached_property
+    def replies(self):
+        return find_symbol(self, '.replies.replies')
@@ -6,23 +6,23 @@
 
 from __future__ import absolute_import
 
-from functools import partial
-
-from cell.presence import AwareActorMixin, announce_after
+from cell.presence import announce_after
 from cell.utils import flatten, first_or_raise, shortuuid
 from celery import current_app as celery
 from kombu import Exchange
 from kombu.common import uuid
 
-from . import metrics
 from . import signals
+from .fleet import fleet
+from .placement import local_metrics, placement
+from .snapshots import snapshots
 from .state import state
 from .thread import gThread
 
 from cyme import conf
 from cyme import models
-from cyme.utils import cached_property, find_symbol, promise
-from cyme.utils.actors import Actor, AwareAgent
+from cyme.utils import ExpiringLRUCache, cached_property, find_symbol, promise
+from cyme.utils.actors import Actor, AwareActorMixin, AwareAgent
 
 
 class CymeActor(Actor, AwareActorMixin):
@@ -105,7 +105,8 @@ class Branch(CymeActor):
 
     @property
     def meta(self):
-        return {'this': [self.state.id()]}
+        # the load is used to place new instances (see :mod:`.placement`).
+        return {'this': [self.state.id()], 'load': local_metrics()}
 branches = Branch()
 
 
@@ -114,31 +115,34 @@ class App(ModelActor):
     model = models.App
     types = ('scatter', )
     exchange = Exchange('cyme.App')
-    _cache = {}
+    _cache = ExpiringLRUCache(limit=conf.CYME_APP_CACHE_LIMIT,
+                              ttl=conf.CYME_APP_CACHE_TTL)
 
     class state:
 
         def all(self):
-            return [app.name for app in self.objects.all()]
+            return snapshots.apps.names()
 
         def add(self, name, broker=None, arguments=None, extra_config=None):
+            # every branch is told about the change, so the
+            # app is read again the next time it's used.
+            self.actor._cache.invalidate(name)
             return self.objects.add(name, broker=broker,
                                           arguments=arguments,
                                           extra_config=extra_config).as_dict()
 
         def delete(self, name):
+            self.actor._cache.invalidate(name)
             return self.objects.filter(name=name).delete() and 'ok'
 
         def get(self, name):
             try:
-                return self.objects.get(name=name).as_dict()
+                return snapshots.apps.get(name)
             except self.model.DoesNotExist:
                 raise self.Next()
 
         def metrics(self):
-            instance_dir = str(conf.CYME_INSTANCE_DIR)
-            return {'load_average': metrics.load_average(),
-                    'disk_use': metrics.df(instance_dir).capacity}
+            return local_metrics()
 
     def all(self):
         return flatten(self.scatter('all'))
@@ -148,7 +152,7 @@ class App(ModelActor):
         return self.state.add(name, **broker)
 
     def delete(self, name, **kw):
-        self._cache.pop(name, None)
+        self._cache.invalidate(name)
         return list(self.scatter('delete', dict({'name': name}, **kw)))
 
     def metrics(self, name=None):
@@ -158,13 +162,15 @@ class App(ModelActor):
         objects = self.state.objects
         if not name:
             return objects.get_default()
-        if name not in self._cache:
+        try:
+            return self._cache.get(name)
+        except KeyError:
             app = self._get(name)
             if not app:
                 raise KeyError(name)
-            self._cache[name] = objects.recreate(**app)
-
-        return self._cache[name]
+            app = objects.recreate(**app)
+            self._cache.put(name, app)
+            return app
 
     def _get(self, name):
         try:
@@ -187,17 +193,15 @@ class Instance(ModelActor):
     class state:
 
         def all(self, app=None):
-            fun = self.objects.all
             if app:
-                fun = partial(self.objects.filter, app=apps.get(app))
-            return [instance.name for instance in fun()]
+                return snapshots.instances.names(app=apps.get(app).name)
+            return snapshots.instances.names()
 
         def get(self, name, app=None):
             try:
-                x = self.objects.get(name=name)
+                return snapshots.instances.get(name)
             except self.model.DoesNotExist:
                 raise self.Next()
-            return x.as_dict()
 
         @announce_after
         def add(self, name=None, app=None, **kwargs):
@@ -223,8 +227,11 @@ class Instance(ModelActor):
             return self.local.cancel_consumer(name, queue) and 'ok'
 
         def remove_queue_from_all(self, queue):
+            # don't wait for the instances to be verified, as the reply
+            # is collected by scatter (note that maybe_wait only waits
+            # if nowait is set).
             return [instance.name for instance in
-                        self.objects.remove_queue_from_instances(queue)]
+                        self.local.remove_queue(queue, nowait=False)]
 
         def autoscale(self, name, max=None, min=None):
             instance = self.local.get(name)
@@ -238,6 +245,10 @@ class Instance(ModelActor):
         def stats(self, name):
             return self.local.get(name).stats()
 
+        def restarts(self, name):
+            return models.RestartState._default_manager.get_for(
+                        self.local.get(name).name).as_dict()
+
         @cached_property
         def local(self):
             return find_symbol(self, '.managers.local_instances')
@@ -250,16 +261,32 @@ class Instance(ModelActor):
         return flatten(self.scatter('all', {'app': app}))
 
     def add(self, name=None, app=None, nowait=False, **kwargs):
+        # named here, so that adding it again below is idempotent
+        # if the first request went through after all.
+        name = name if name else uuid()
+        args = dict({'name': name, 'app': app}, **kwargs)
+        # add to the least loaded branch, if the load of any is known.
+        to = placement.choose(app)
+        ret = None
+        if to:
+            try:
+                ret = self.send('add', args, to=to, nowait=nowait)
+            except Exception, exc:
+                self.log.error('Cannot add instance to %s: %r', to, exc)
+                placement.remove(to)
+                to = None
+        if not to:
+            ret = self.throw('add', args, nowait=nowait)
         if nowait:
-            name = name if name else uuid()
-        ret = self.throw('add', dict({'name': name, 'app': app}, **kwargs),
-                         nowait=nowait)
-        if nowait:
-            return {'name': name}
+            ret = {'name': name}
+        if ret and ret.get('name'):
+            fleet.added(ret['name'], app)
         return ret
 
     def remove(self, name, **kw):
-        return self.send_to_able('remove', {'name': name}, to=name, **kw)
+        ret = self.send_to_able('remove', {'name': name}, to=name, **kw)
+        fleet.removed(name)
+        return ret
 
     def restart(self, name, **kw):
         return self.send_to_able('restart', {'name': name}, to=name, **kw)
@@ -293,9 +320,14 @@ class Instance(ModelActor):
     def stats(self, name, **kw):
         return self.send_to_able('stats', {'name': name}, to=name, **kw)
 
+    def restarts(self, name, **kw):
+        return self.send_to_able('restarts', {'name': name}, to=name, **kw)
+
     @property
     def meta(self):
-        return {'instances': self.state.all()}
+        # the apps are used by the fleet view (see :mod:`.fleet`).
+        return {'instances': self.state.all(),
+                'apps': snapshots.instances.indexed('app')}
 instances = Instance()
 
 
@@ -310,11 +342,11 @@ class Queue(ModelActor):
     class state:
 
         def all(self):
-            return [q.name for q in self.objects.all()]
+            return snapshots.queues.names()
 
         def get(self, name):
             try:
-                return self.objects.get(name=name).as_dict()
+                return snapshots.queues.get(name)
             except self.model.DoesNotExist:
                 raise KeyError(name)
 
@@ -351,6 +383,11 @@ class Queue(ModelActor):
 queues = Queue()
 
 
+#: Controllers of this branch that are running, the first of them
+#: feeds the fleet view and placement (see :meth:`Controller.on_awake`).
+_listening = []
+
+
 class Controller(AwareAgent, gThread):
     actors = [Branch(), App(), Instance(), Queue()]
     connect_max_retries = celery.conf.BROKER_CONNECTION_MAX_RETRIES
@@ -368,6 +405,7 @@ class Controller(AwareAgent, gThread):
         # so presence can be used.
         for actor in (branches, apps, instances, queues):
             actor.agent = self
+        self._start_listening()
 
     def on_connection_revived(self):
         state.on_broker_revive()
@@ -397,8 +435,39 @@ class Controller(AwareAgent, gThread):
             signals.thread_shutdown_step.send(sender=self)
             self.presence.g.wait()
             signals.thread_shutdown_step.send(sender=self)
+            self._stop_listening()
         super(Controller, self).stop()
 
+    def _start_listening(self):
+        # the fleet view and placement are shared by all controllers
+        # of the branch, and fed by the presence of one of them.
+        _listening.append(self)
+        if len(_listening) == 1:
+            self._feed_listeners()
+
+    def _stop_listening(self):
+        if self not in _listening:
+            return
+        feeding = _listening[0] is self
+        _listening.remove(self)
+        if feeding:
+            for listener in (fleet, placement):
+                if listener in self.presence.state.listeners:
+                    self.presence.state.listeners.remove(listener)
+            if _listening:
+                # hand over to a controller that is still running.
+                _listening[0]._feed_listeners()
+            else:
+                fleet.clear()
+                placement.clear()
+                fleet.state = None
+
+    def _feed_listeners(self):
+        state = self.presence.state
+        state.listeners.extend([fleet, placement])
+        fleet.state = state
+        placement.expire_after = state.heartbeat_expire
+
     @property
     def logger_name(self):
         return '#'.join([self.__class__.__name__, self._shortid()])
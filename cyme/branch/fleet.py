@@ -0,0 +1,145 @@
+"""cyme.branch.fleet
+
+- Merged view of the instances and queues of all branches,
+  used to serve the instance and queue lists without asking
+  every branch.
+
+- Fed by the presence announcements of the branches, which include
+  the instances (and their apps) and queues of the branch, and
+  are sent when they change (see :func:`cell.presence.announce_after`)
+  and with every heartbeat.
+
+- Until every branch has been heard from the lists are collected from
+  all branches using scatter, as before.
+
+- Instances added or removed using this branch are included (or left
+  out) until the change has been announced, so they're listed right away.
+
+"""
+
+from __future__ import absolute_import
+
+from time import time
+
+from kombu.log import LogMixin
+
+from cyme.utils import cached_property
+
+
+class BranchView(object):
+    """The instances and queues announced by one branch.
+
+    :param version: Time of the announcement.
+    :param instances: ``{name: app}`` mapping of the branch's instances.
+    :param queues: Names of the branch's queues.
+
+    """
+
+    def __init__(self, version, instances, queues):
+        self.version = version
+        self.instances = instances
+        self.queues = queues
+
+
+class FleetView(LogMixin):
+    """Index of the instances and queues of all branches, by branch."""
+
+    #: Presence state of the branch, used to find the branches
+    #: that should be heard from (set by the controller).
+    state = None
+
+    #: Instances added or removed are included (or left out) until
+    #: the change is announced, or for this many seconds.
+    pending_expire = 30.0
+
+    def __init__(self):
+        self._branches = {}
+        self._pending = {}  # (expires, app, exists) by instance name
+
+    def update(self, agent, meta, version=None):
+        """Replace the view of branch ``agent`` with the ``meta``
+        it announced, unless a more recent announcement has
+        already been applied."""
+        instances = (meta.get('Instance') or {}).get('apps')
+        if instances is None:
+            return  # not a branch, or a branch not announcing apps.
+        known = self._branches.get(agent)
+        if known is not None and version is not None and \
+                known.version is not None and version < known.version:
+            self.debug('ignoring stale announcement from %s', agent)
+            return
+        queues = (meta.get('Queue') or {}).get('queues') or []
+        for name, (_, _, exists) in self._pending.items():
+            if exists:
+                announced = name in instances
+            else:  # gone from the branch that had it.
+                announced = known is not None and \
+                        name in known.instances and name not in instances
+            if announced:
+                del self._pending[name]
+        self._branches[agent] = BranchView(version, dict(instances),
+                                           list(queues))
+
+    def remove(self, agent):
+        """Forget branch ``agent``, as it's gone."""
+        self._branches.pop(agent, None)
+
+    def added(self, name, app=None):
+        """Include instance ``name`` of ``app`` until it's announced,
+        as it was just added."""
+        self._pending[name] = (time() + self.pending_expire, app, True)
+
+    def removed(self, name):
+        """Leave out instance ``name`` until its removal is announced,
+        as it was just removed."""
+        self._pending[name] = (time() + self.pending_expire, None, False)
+
+    def instances(self, app=None):
+        """Returns the names of all instances,
+        or only those of ``app``."""
+        if not self.ready:
+            return self.actors.instances.all(app=app)
+        apps = {}
+        for branch in self._branches.itervalues():
+            apps.update(branch.instances)
+        now = time()
+        for name, (expires, app_name, exists) in self._pending.items():
+            if expires < now:
+                del self._pending[name]
+            elif exists:
+                apps.setdefault(name, app_name)
+            else:
+                apps.pop(name, None)
+        return sorted(name for name, app_name in apps.iteritems()
+                        if app is None or app_name == app)
+
+    def queues(self):
+        """Returns the names of all queues."""
+        if not self.ready:
+            return self.actors.queues.all()
+        return sorted(set(name for branch in self._branches.itervalues()
+                                for name in branch.queues))
+
+    def clear(self):
+        self._branches.clear()
+        self._pending.clear()
+
+    @property
+    def ready(self):
+        """True if every branch has been heard from."""
+        if self.state is None:
+            return False
+        # also forgets the branches that expired.
+        expected = self.state.can('Instance')
+        return bool(expected) and expected <= set(
+                agent.partition('.')[0] for agent in self._branches)
+
+    @cached_property
+    def actors(self):
+        from . import controller
+        return controller
+
+    @property
+    def logger_name(self):
+        return 'Fleet'
+fleet = FleetView()
@@ -52,7 +52,8 @@ class HttpServer(gThread):
 
             def write(self, message):
                 message = message.rstrip('\n')
-                (logger.debug if '/ping/' in message else logger.info)(message)
+                quiet = '/ping/' in message or '/metrics' in message
+                (logger.debug if quiet else logger.info)(message)
 
         return _Log()
 
@@ -56,9 +56,18 @@ class LocalInstanceManager(object):
                 self.Instances.remove_queue_from_instances(queue, name=name),
                 nowait)
 
-    def remove_queue(self, queue, nowait=False):
+    def add_queue(self, queue, nowait=False, **query):
+        """Make all instances (matching ``query``) consume from
+        ``queue``, and verify the instances that changed."""
         return self.maybe_wait(sup.verify,
-                self.Instances.remove_queue_from_instances(queue), nowait)
+                self.Instances.add_queue_to_instances(queue, **query), nowait)
+
+    def remove_queue(self, queue, nowait=False, **query):
+        """Remove ``queue`` from all instances (matching ``query``),
+        and verify the instances that changed."""
+        return self.maybe_wait(sup.verify,
+                self.Instances.remove_queue_from_instances(queue, **query),
+                nowait)
 
     def maybe_wait(self, fun, instances, nowait):
         if instances:
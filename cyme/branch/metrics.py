@@ -1,17 +1,62 @@
-"""cyme.branch.metrics"""
+"""cyme.branch.metrics
+
+- Load average, memory and disk usage of the branch host.
+
+- Counters and histograms instrumenting the supervisor and the
+  commands sent to instances, served by the branch in the
+  Prometheus text format at ``/metrics/``.
+
+"""
 
 from __future__ import absolute_import
+from __future__ import with_statement
 
+import multiprocessing
 import os
+
+from contextlib import contextmanager
 from math import ceil
+from time import time
 
 from cyme.utils import cached_property
 
+#: Content type of :meth:`Registry.render`.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#: Default histogram buckets (in seconds).
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
 
 def load_average():
     return tuple(ceil(l * 1e2) / 1e2 for l in os.getloadavg())
 
 
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def memory(path='/proc/meminfo'):
+    """Returns the total and available memory in kB, as a tuple,
+    or ``(None, None)`` if not known on this platform."""
+    info = {}
+    try:
+        with open(path) as fh:
+            for line in fh:
+                key, _, value = line.partition(':')
+                info[key] = int(value.split()[0])
+    except (IOError, ValueError, IndexError):
+        return None, None
+    available = info.get('MemAvailable')
+    if available is None and 'MemFree' in info:
+        available = info['MemFree'] + info.get('Buffers', 0) + \
+                        info.get('Cached', 0)
+    return info.get('MemTotal'), available
+
+
 class df(object):
 
     def __init__(self, path):
@@ -34,3 +79,201 @@ class df(object):
     @cached_property
     def stat(self):
         return os.statvfs(self.path)
+
+
+def _escape(value):
+    return unicode(value).replace('\\', r'\\') \
+                         .replace('\n', r'\n') \
+                         .replace('"', r'\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (key, _escape(value))
+                                for key, value in labels), )
+
+
+class Metric(object):
+    """Base class for metrics, keeping one value for every
+    combination of label values."""
+    type = 'untyped'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(sorted(labels.iteritems()))
+
+    def get(self, **labels):
+        """Returns the current value for ``labels``."""
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        """Returns ``(name, labels, value)`` tuples for all the values."""
+        return [(self.name, key, value)
+                    for key, value in sorted(self._values.iteritems())]
+
+    def remove(self, **labels):
+        """Removes the values of all label combinations
+        including ``labels``, e.g. when an instance is deleted."""
+        match = set(labels.iteritems())
+        for key in [key for key in self._values if match <= set(key)]:
+            del self._values[key]
+
+    def clear(self):
+        self._values.clear()
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. the number of times
+    something happened."""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down, e.g. the size of a queue."""
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Counts observed values in buckets, e.g. the time
+    operations took.
+
+    :keyword buckets: Upper bounds of the buckets,
+        default is :data:`DEFAULT_BUCKETS`.
+
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=None):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(sorted(buckets or DEFAULT_BUCKETS)) \
+                     + (float('inf'), )
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        try:
+            counts, total = self._values[key]
+        except KeyError:
+            counts, total = [0] * len(self.buckets), 0.0
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Context observing the time spent in the block."""
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - start, **labels)
+
+    def get(self, **labels):
+        """Returns the number of values observed for ``labels``."""
+        try:
+            return self._values[self._key(labels)][0][-1]
+        except KeyError:
+            return 0
+
+    def samples(self):
+        samples = []
+        for key, (counts, total) in sorted(self._values.iteritems()):
+            for bound, count in zip(self.buckets, counts):
+                samples.append((self.name + '_bucket',
+                                key + (('le', _format_value(bound)), ),
+                                count))
+            samples.append((self.name + '_sum', key, total))
+            samples.append((self.name + '_count', key, counts[-1]))
+        return samples
+
+
+class Registry(object):
+    """Collection of metrics that can be rendered in the
+    Prometheus text exposition format."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self.register(Gauge(name, help))
+
+    def histogram(self, name, help, buckets=None):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for name, metric in sorted(self.metrics.iteritems()):
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+            for sample, labels, value in metric.samples():
+                lines.append('%s%s %s' % (sample, _format_labels(labels),
+                                          _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        for metric in self.metrics.itervalues():
+            metric.clear()
+registry = Registry()
+
+#: Time in seconds it took to verify the instances due at the same time.
+sweep_seconds = registry.histogram('cyme_supervisor_sweep_seconds',
+        'Time taken to verify the instances due at the same time.')
+
+#: Number of actions waiting to be started by the supervisor.
+jobs_waiting = registry.gauge('cyme_supervisor_jobs_waiting',
+        'Number of actions waiting to be started by the supervisor.')
+
+#: 1 if the supervisor is paused because a broker is unavailable.
+paused = registry.gauge('cyme_supervisor_paused',
+        'Whether the supervisor is paused (1) or not (0).')
+
+#: Total time in seconds the supervisor has been paused.
+paused_seconds = registry.counter('cyme_supervisor_paused_seconds_total',
+        'Total time the supervisor has been paused.')
+
+#: Time it took to apply actions (remote control commands
+#: and starting/stopping workers), by action.
+action_seconds = registry.histogram('cyme_action_seconds',
+        'Time taken by remote control commands and worker actions.')
+
+#: Number of instances not replying to remote control commands in time,
+#: by instance and command.
+broadcast_timeouts = registry.counter('cyme_broadcast_timeouts_total',
+        'Instances not replying to remote control commands in time.')
+
+#: Time spent waiting for a producer from the pool of a broker.
+producer_wait_seconds = registry.histogram(
+        'cyme_broker_producer_wait_seconds',
+        'Time spent waiting for a producer from the broker pool.')
+
+#: Number of producers in use, by broker.
+producers_in_use = registry.gauge('cyme_broker_producers_in_use',
+        'Number of producers acquired from the broker pool.')
+
+#: Max number of connections and producers, by broker.
+broker_pool_limit = registry.gauge('cyme_broker_pool_limit',
+        'Max number of connections (and producers) for the broker.')
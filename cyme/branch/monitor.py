@@ -0,0 +1,230 @@
+"""cyme.branch.monitor
+
+- Consumes events sent by the worker instances, to keep track of
+  which instances are alive without having to ping them.
+
+"""
+
+from __future__ import absolute_import
+
+import socket
+
+from time import time
+
+from celery import current_app as celery
+from eventlet import sleep, spawn
+from eventlet.hubs import get_hub
+
+from .signals import monitor_ready
+from .snapshots import snapshots
+from .state import state
+from .supervisor import supervisor
+from .thread import gThread
+
+from cyme.models import Broker, Instance
+
+
+class EventMonitor(gThread):
+    """Keeps track of when every worker was last heard from, by consuming
+    ``worker-online``, ``worker-heartbeat`` and ``worker-offline`` events
+    from all the brokers used by instances.
+
+    The supervisor is asked to verify an instance as soon as it
+    goes offline, or misses a heartbeat, and it can be notified
+    when a worker comes online (see :meth:`expect_online`).
+
+    Events from workers that are not cyme instances are ignored.
+
+    :keyword interval: Interval (in seconds as an int/float) between
+        checking for new brokers to consume events from.
+    :keyword expire_after: Workers not heard from in this many seconds
+        are no longer known to be alive (or offline).
+
+    """
+
+    #: Default interval (time in seconds as a float).
+    interval = 30.0
+
+    #: Workers send heartbeats every 30 seconds by default,
+    #: so a worker is considered to be gone if it missed one.
+    expire_after = 45.0
+
+    #: Time in seconds to wait before reconnecting after connection loss.
+    reconnect_interval = 2.0
+
+    #: Interval (in seconds as a float) between checking for
+    #: missed heartbeats.
+    check_interval = 5.0
+
+    def __init__(self, interval=None, expire_after=None,
+            set_as_current=True):
+        self.interval = interval or self.interval
+        self.expire_after = expire_after or self.expire_after
+        self.last_seen = {}  # (time, alive) by hostname
+        self._consumers = {}
+        self._reported = set()
+        self._waiters = {}
+        if set_as_current:
+            state.monitor = self
+        super(EventMonitor, self).__init__()
+
+    def is_alive(self, hostname, now=None):
+        """Returns :const:`True` if the worker was recently heard from,
+        :const:`False` if the worker announced that it went offline,
+        and :const:`None` if the state of the worker is not known."""
+        try:
+            seen, alive = self.last_seen[hostname]
+        except KeyError:
+            return None
+        now = time() if now is None else now
+        if now - seen > self.expire_after:
+            return None
+        return alive
+
+    def is_instance(self, hostname):
+        """Returns :const:`True` if ``hostname`` is the name of
+        an instance."""
+        try:
+            snapshots.instances.get(hostname)
+        except Instance.DoesNotExist:
+            return False
+        return True
+
+    def expect_online(self, hostname, timeout, callback):
+        """Call ``callback(hostname, True)`` as soon as the worker sends
+        ``worker-online``, or ``callback(hostname, False)`` if it doesn't
+        within ``timeout`` seconds.
+
+        Only events received after this call count, and heartbeats
+        don't (they may be sent by the old worker while it's shutting
+        down), so this can be used to find out when a restarted worker
+        is ready.
+
+        """
+        waiter = [callback, None]
+        waiter[1] = get_hub().schedule_call_global(timeout, spawn,
+                        self._notify_waiter, hostname, waiter, False)
+        self._waiters.setdefault(hostname, []).append(waiter)
+
+    def _notify_waiter(self, hostname, waiter, alive):
+        try:
+            self._waiters[hostname].remove(waiter)
+        except (KeyError, ValueError):
+            return  # already notified.
+        if not self._waiters[hostname]:
+            del self._waiters[hostname]
+        callback, timer = waiter
+        if alive:
+            timer.cancel()
+        try:
+            callback(hostname, alive)
+        except Exception, exc:
+            self.error('%s: online callback raised: %r', hostname, exc)
+
+    def on_worker_event(self, event):
+        hostname = event['hostname']
+        if not self.is_instance(hostname):
+            return
+        self.last_seen[hostname] = (time(), True)
+        self._reported.discard(hostname)
+
+    def on_worker_online(self, event):
+        self.on_worker_event(event)
+        hostname = event['hostname']
+        for waiter in list(self._waiters.get(hostname) or ()):
+            self._notify_waiter(hostname, waiter, True)
+
+    def on_worker_offline(self, event):
+        hostname = event['hostname']
+        if not self.is_instance(hostname):
+            return
+        # known to be offline until it expires like any other entry.
+        self.last_seen[hostname] = (time(), False)
+        self.on_worker_gone(hostname)
+
+    def on_worker_gone(self, hostname):
+        """Called when a worker went offline or missed a heartbeat."""
+        self._reported.add(hostname)
+        try:
+            instance = Instance._default_manager.get(name=hostname)
+        except Instance.DoesNotExist:
+            # not one of ours.
+            self.last_seen.pop(hostname, None)
+        else:
+            self.info('%s: instance went away', hostname)
+            supervisor.verify([instance])
+
+    def check_expired(self):
+        now = time()
+        for hostname in self.last_seen.keys():
+            if self.is_alive(hostname, now) is None:
+                if hostname in self._reported:
+                    # back to unknown, so the supervisor pings it again.
+                    self.last_seen.pop(hostname, None)
+                    self._reported.discard(hostname)
+                else:
+                    self.on_worker_gone(hostname)
+
+    def update_consumers(self):
+        """Start consuming events from brokers we don't have
+        a consumer for yet."""
+        for broker in [Broker._default_manager.get_default()] + list(
+                Broker._default_manager.all()):
+            if broker.url not in self._consumers:
+                self.debug('consuming events from %s', broker.url)
+                self._consumers[broker.url] = self.spawn(self._consume,
+                                                         broker)
+
+    def _consume(self, broker):
+        handlers = {'worker-online': self.on_worker_online,
+                    'worker-heartbeat': self.on_worker_event,
+                    'worker-offline': self.on_worker_offline}
+        while not self.should_stop:
+            conn = broker.connection.clone()
+            try:
+                try:
+                    self._drain_events(celery.events.Receiver(conn,
+                                            handlers=handlers,
+                                            routing_key='worker.#'))
+                except conn.connection_errors + conn.channel_errors, exc:
+                    self.error('Connection to %s lost: %r', broker.url, exc)
+                    sleep(self.reconnect_interval)
+                except Exception, exc:
+                    self.error('Cannot consume events from %s: %r',
+                               broker.url, exc)
+                    sleep(self.reconnect_interval)
+            finally:
+                conn.close()
+
+    def _drain_events(self, receiver):
+        conn = receiver.connection
+        with receiver.consumer() as consumer:
+            # ask the workers to send a heartbeat now,
+            # so we don't have to wait for the next one.
+            receiver.wakeup_workers(channel=consumer.channel)
+            while not self.should_stop:
+                try:
+                    conn.drain_events(timeout=1)
+                except socket.timeout:
+                    pass
+
+    def before(self):
+        self.update_consumers()
+        self.start_periodic_timer(self.interval, self.update_consumers)
+        self.start_periodic_timer(self.check_interval, self.check_expired)
+
+    def run(self):
+        self.info('started')
+        monitor_ready.send(sender=self)
+        while not self.should_stop:
+            self.respond_to_ping()
+            sleep(1)
+
+    def after(self):
+        for consumer in self._consumers.values():
+            consumer.kill()
+        self._consumers.clear()
+        for waiters in self._waiters.values():
+            for _, timer in waiters:
+                timer.cancel()
+        self._waiters.clear()
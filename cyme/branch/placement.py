@@ -0,0 +1,138 @@
+"""cyme.branch.placement
+
+- Chooses the branch new instances are added to, using the load
+  of every branch, instead of adding them to whichever branch
+  picks up the request first.
+
+- The load of the branches (see :func:`local_metrics`) is sent
+  with the presence heartbeats, so it's gathered every
+  presence interval without extra requests.
+
+- Branches are ordered by the score function set by the
+  ``CYME_PLACEMENT_SCORE`` setting (:func:`default_score` by default),
+  and branches with less than ``100 - CYME_PLACEMENT_MAX_DISK_USE``
+  percent disk left are never chosen.
+
+"""
+
+from __future__ import absolute_import
+
+from time import time
+
+from kombu.log import LogMixin
+
+from . import metrics
+from .snapshots import snapshots
+
+from cyme import conf
+from cyme.utils import cached_property, find_symbol
+
+
+def local_metrics():
+    """Returns the load of this branch."""
+    total_memory, free_memory = metrics.memory()
+    try:
+        disk_use = metrics.df(str(conf.CYME_INSTANCE_DIR)).capacity
+    except OSError:
+        disk_use = None  # instance dir not created yet.
+    return {'load_average': metrics.load_average(),
+            'cpus': metrics.cpu_count(),
+            'total_memory': total_memory,
+            'free_memory': free_memory,
+            'disk_use': disk_use,
+            'instances': len(snapshots.instances.names())}
+
+
+def default_score(load, app=None):
+    """Score of a branch with ``load`` (see :func:`local_metrics`),
+    lower is better: the 1 minute load average per CPU, plus
+    the fraction of memory in use, plus one for every 100 instances."""
+    score = load['load_average'][0] / float(load.get('cpus') or 1)
+    if load.get('total_memory') and load.get('free_memory') is not None:
+        score += 1.0 - load['free_memory'] / float(load['total_memory'])
+    return score + load.get('instances', 0) / 100.0
+
+
+class Placement(LogMixin):
+    """Keeps the load announced by every branch, and chooses
+    the least loaded branch for new instances.
+
+    :keyword score: Score function, or the name of one.
+        Called with the load of a branch, and the name of the app
+        of the new instance, and returns a number (lower is better).
+    :keyword max_disk_use: Max disk use (in percent) of a branch
+        new instances can be added to.
+    :keyword expire_after: Loads announced more than this many seconds
+        ago are not used, as the branch may be gone.
+
+    """
+
+    #: Same as the presence heartbeat expiry by default
+    #: (2.5 heartbeat intervals).
+    expire_after = 25.0
+
+    def __init__(self, score=None, max_disk_use=None, expire_after=None):
+        self._score = score
+        self.max_disk_use = max_disk_use or conf.CYME_PLACEMENT_MAX_DISK_USE
+        self.expire_after = expire_after or self.expire_after
+        self._branches = {}
+
+    def update(self, agent, meta, version=None):
+        """Called for every presence announcement (see
+        :class:`~cyme.utils.actors.RoutingState`), ``version``
+        is the time of the announcement."""
+        load = (meta.get('Branch') or {}).get('load')
+        if load is not None:
+            # every controller of a branch announces the same load,
+            # so it's kept once per branch, with the agent to send to.
+            self._branches[self.branch_id(agent)] = (version or time(),
+                                                     dict(load), agent)
+
+    def remove(self, agent):
+        self._branches.pop(self.branch_id(agent), None)
+
+    def branch_id(self, agent):
+        # agent ids of controllers are ``<branch id>.<n>``.
+        return agent.partition('.')[0]
+
+    def choose(self, app=None, now=None):
+        """Returns the id of the agent of the branch to add an instance
+        of ``app`` to, or :const:`None` if no recent branch load is known."""
+        now = time() if now is None else now
+        scores = []
+        for branch, (announced, load, agent) in self._branches.items():
+            if now - announced > self.expire_after:
+                del self._branches[branch]  # not heard from, maybe gone.
+            elif self.eligible(load):
+                try:
+                    scores.append((self.score(load, app=app), branch))
+                except Exception, exc:
+                    self.error('Cannot score branch %s: %r', branch, exc)
+        if scores:
+            _, load, agent = self._branches[min(scores)[1]]
+            self._reserve(load)
+            return agent
+
+    def _reserve(self, load):
+        # loads are only announced with every heartbeat, so count the
+        # new instance (and the process it starts) until the next one,
+        # or all instances added before then go to the same branch.
+        load['instances'] = (load.get('instances') or 0) + 1
+        load_average = list(load.get('load_average') or (0.0, ))
+        load_average[0] += 1.0
+        load['load_average'] = load_average
+
+    def eligible(self, load):
+        return (load.get('disk_use') or 0) < self.max_disk_use
+
+    def clear(self):
+        self._branches.clear()
+
+    @cached_property
+    def score(self):
+        return find_symbol(self, self._score or conf.CYME_PLACEMENT_SCORE)
+
+    @property
+    def logger_name(self):
+        return 'Placement'
+placement = Placement()
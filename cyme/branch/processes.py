@@ -0,0 +1,371 @@
+"""cyme.branch.processes
+
+- Starts and stops the worker processes of the instances managed
+  by this branch directly, instead of going through
+  :program:`celeryd-multi`.
+
+- Keeps track of the worker processes of the instances managed
+  by this branch, so that the supervisor is notified as soon as
+  a worker exits.
+
+- On Linux the processes are watched using a pidfd, which becomes
+  readable when the process exits.  On other platforms, or if pidfds
+  are not supported by the kernel, the processes are polled using
+  signal 0.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import errno
+import os
+import signal
+import sys
+
+from time import time
+
+from celery import platforms
+from eventlet import Timeout, sleep, spawn
+from eventlet.hubs import trampoline
+from eventlet.semaphore import Semaphore
+from kombu.log import LogMixin
+
+from .state import state
+from .supervisor import supervisor
+
+from cyme.models import Instance, shsplit
+
+#: Syscall number of ``pidfd_open`` (the same on all architectures).
+NR_pidfd_open = 434
+
+#: Options handled by :program:`celeryd-detach` and not by the worker,
+#: these are applied by the spawner instead.
+DETACH_OPTIONS = frozenset(['--workdir', '--uid', '--gid', '--umask'])
+
+_syscall = None
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes
+        _syscall = ctypes.CDLL(None, use_errno=True).syscall
+    except (ImportError, OSError, AttributeError):
+        pass
+
+
+def pidfd_open(pid):
+    """Returns a file descriptor referring to the process ``pid``,
+    or :const:`None` if pidfds are not supported.
+
+    :raises OSError: if the process does not exist.
+
+    """
+    if _syscall is None:
+        return None
+    fd = _syscall(NR_pidfd_open, pid, 0)
+    if fd < 0:
+        err = ctypes.get_errno()
+        if err == errno.ESRCH:
+            raise OSError(err, os.strerror(err))
+        return None
+    return fd
+
+
+def pid_exists(pid):
+    """Returns :const:`True` if the process ``pid`` responds to signals."""
+    try:
+        os.kill(pid, 0)
+    except OSError, exc:
+        if exc.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
+
+def is_worker_of(pid, hostname, proc='/proc'):
+    """Returns :const:`True` if the process ``pid`` is the worker
+    with ``hostname``, e.g. to check that the pid found in a pidfile
+    has not been reused by another process.
+
+    Always :const:`True` if the command line of the process can't be
+    read (no :file:`/proc` filesystem), but the process exists.
+
+    """
+    try:
+        with open(os.path.join(proc, str(pid), 'cmdline')) as fh:
+            argv = fh.read().split('\0')
+    except IOError, exc:
+        if exc.errno == errno.ENOENT and os.path.isdir(proc):
+            return False  # no such process.
+        return pid_exists(pid)
+    # started by the branch (--hostname=x), or celeryd-multi (-n x).
+    return '--hostname=%s' % (hostname, ) in argv or \
+            any(opt == '-n' and value == hostname
+                    for opt, value in zip(argv, argv[1:]))
+
+
+def worker_argv(instance):
+    """Returns the command line used to start the worker for ``instance``,
+    and a dictionary of the detach options (``workdir``, ``uid``,
+    ``gid`` and ``umask``) found in the instance arguments."""
+    args = shsplit(' '.join(instance.get_arguments()))
+    argv, options = [], {}
+    while args:
+        arg = args.pop(0)
+        opt, sep, value = arg.partition('=')
+        if opt in DETACH_OPTIONS:
+            if not sep:
+                value = args.pop(0) if args else None
+            options[opt[2:]] = value
+        else:
+            argv.append(arg)
+    return ([sys.executable, '-m', 'celery.bin.celeryd',
+             '--hostname=%s' % (instance.name, )] + argv
+          + ['--'] + instance.get_extra_config()), options
+
+
+def spawn_worker(argv, env=None, logfile=None, workdir=None,
+        uid=None, gid=None, umask=None):
+    """Fork and execute ``argv`` in a new session, returning the pid
+    of the child process.
+
+    The output of the child is redirected to ``logfile``, so that
+    errors happening before the worker has set up logging are not lost.
+
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    # child: must never return from here.
+    try:
+        os.setsid()
+        if umask:
+            os.umask(int(umask, 8))  # octal, as for celeryd-detach.
+        if workdir:
+            os.chdir(workdir)
+        platforms.set_effective_user(uid, gid)
+        out = os.open(logfile or os.devnull,
+                      os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+        os.dup2(out, 1)
+        os.dup2(out, 2)
+        os.closerange(3, platforms.get_fdmax(2048))
+        os.execve(argv[0], argv, env if env is not None else os.environ)
+    except BaseException, exc:
+        try:
+            os.write(2, "Can't exec %r: %r\n" % (' '.join(argv), exc))
+        finally:
+            os._exit(1)
+
+
+class ProcessRegistry(LogMixin):
+    """Registry of the worker processes started by this branch.
+
+    Processes are only started and tracked when running as
+    :program:`cyme-branch`, see :attr:`enabled`.
+
+    :keyword spawn_limit: Max number of workers starting up at
+        the same time.
+
+    """
+    #: Interval (in seconds as a float) between polling processes,
+    #: when pidfds are not available.
+    poll_interval = 1.0
+
+    #: Signal sent to stop workers (warm shutdown).
+    stop_signal = signal.SIGTERM
+
+    #: Default max number of workers starting up at the same time.
+    spawn_limit = 10
+
+    #: A worker is starting up until it has written its pidfile,
+    #: or this many seconds passed.
+    startup_timeout = 10.0
+
+    #: Time in seconds to wait for a worker to exit after the stop
+    #: signal, before it's killed (and again after it's killed).
+    stop_timeout = 60.0
+
+    def __init__(self, spawn_limit=None):
+        self._pids = {}
+        self.set_spawn_limit(spawn_limit or self.spawn_limit)
+
+    def set_spawn_limit(self, limit):
+        """Change the max number of workers starting up at the same time.
+        Must be called before any workers are started."""
+        self.spawn_limit = limit
+        self._spawn_slots = Semaphore(limit)
+
+    @property
+    def enabled(self):
+        """:const:`True` if workers are started by the branch itself."""
+        return state.is_branch and os.name == 'posix'
+
+    def start(self, instance):
+        """Start the worker for ``instance``, unless it's already running.
+
+        At most :attr:`spawn_limit` workers are starting up at the
+        same time.
+
+        Returns the pid of the worker started.
+
+        """
+        if instance.responds_to_signal():
+            return
+        with self._spawn_slots:
+            pid = self._spawn(instance, self.env)
+            self.track(instance.name, pid)
+            self._wait_for_startup(instance, pid)
+        return pid
+
+    def _spawn(self, instance, env):
+        argv, options = worker_argv(instance)
+        self.info('%s: %s', instance.name, ' '.join(argv))
+        return spawn_worker(argv, env=env,
+                            logfile=str(instance.logfile), **options)
+
+    def _wait_for_startup(self, instance, pid, interval=0.1):
+        # the worker writes its pidfile when it's done loading.
+        pidfile = platforms.PIDFile(str(instance.pidfile))
+        deadline = time() + self.startup_timeout
+        while time() < deadline and self._pids.get(instance.name) == pid:
+            try:
+                if pidfile.read_pid() == pid:
+                    return True
+            except ValueError:
+                pass
+            sleep(interval)
+        return False
+
+    def stop(self, instance, sig=None):
+        """Send the stop signal to the worker of ``instance``.
+
+        Returns the pid of the worker signalled.
+
+        """
+        pid = self._getpid(instance)
+        if pid and self._signal(pid, sig or self.stop_signal):
+            return pid
+
+    def stop_verify(self, instance, sig=None):
+        """Like :meth:`stop`, but also waits for the worker to exit.
+
+        The worker is killed if it has not exited
+        within :attr:`stop_timeout` seconds.
+
+        """
+        pid = self.stop(instance, sig=sig)
+        if pid and not self._wait_for_exit(pid, self.stop_timeout):
+            self.warn('%s: process %s did not exit in time, killing it',
+                      instance.name, pid)
+            if self._signal(pid, signal.SIGKILL) and \
+                    not self._wait_for_exit(pid, self.stop_timeout):
+                self.error('%s: process %s does not exit',
+                           instance.name, pid)
+        return pid
+
+    def restart(self, instance, sig=None):
+        """Stop the worker of ``instance``, waiting for it to exit,
+        and start it again."""
+        self.stop_verify(instance, sig=sig)
+        return self.start(instance)
+
+    def _getpid(self, instance):
+        # the process is expected to exit, so stop tracking it.
+        pid = self.forget(instance.name)
+        if pid is None:
+            try:
+                pid = platforms.PIDFile(str(instance.pidfile)).read_pid()
+            except ValueError:
+                pass
+            if pid and not is_worker_of(pid, instance.name):
+                self.warn('%s: ignoring stale pidfile (pid %s)',
+                          instance.name, pid)
+                return
+        return pid
+
+    def _signal(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError, exc:
+            if exc.errno != errno.ESRCH:
+                raise
+            return False
+        return True
+
+    @property
+    def env(self):
+        env = os.environ.copy()
+        env.pop('CELERY_LOADER', None)
+        return env
+
+    def get(self, name):
+        """Returns the pid of the worker process for instance ``name``,
+        or :const:`None` if the process is not tracked."""
+        return self._pids.get(name)
+
+    def track(self, name, pid):
+        """Start tracking the worker process ``pid`` of the instance
+        ``name``.  The supervisor is asked to verify the instance
+        when the process exits."""
+        if state.is_branch and self._pids.get(name) != pid:
+            self._pids[name] = pid
+            spawn(self._watch, name, pid)
+
+    def forget(self, name):
+        """Stop tracking the worker process of instance ``name``,
+        e.g. because it's about to be stopped."""
+        return self._pids.pop(name, None)
+
+    def _watch(self, name, pid):
+        try:
+            self._wait_for_exit(pid)
+        except Exception, exc:
+            self.error('Cannot watch process %s: %r', pid, exc)
+            self._pids.pop(name, None)
+            return
+        self._reap(pid)
+        if self._pids.get(name) == pid:
+            self._pids.pop(name, None)
+            self.on_process_exit(name, pid)
+
+    def _wait_for_exit(self, pid, timeout=None):
+        """Wait for the process ``pid`` to exit, returns :const:`False`
+        if it's still running after ``timeout`` seconds."""
+        try:
+            fd = pidfd_open(pid)
+        except OSError:
+            return True  # already exited.
+        if fd is not None:
+            try:
+                trampoline(fd, read=True, timeout=timeout)
+            except Timeout:
+                return False
+            finally:
+                os.close(fd)
+        else:
+            deadline = time() + timeout if timeout is not None else None
+            # children must be reaped, as zombies still respond to signals.
+            while pid_exists(pid) and not self._reap(pid):
+                if deadline is not None and time() >= deadline:
+                    return False
+                sleep(self.poll_interval)
+        return True
+
+    def _reap(self, pid):
+        # collect the exit status if the process is our child.
+        try:
+            return os.waitpid(pid, os.WNOHANG)[0] == pid
+        except OSError:
+            return False
+
+    def on_process_exit(self, name, pid):
+        self.info('%s: process %s exited', name, pid)
+        try:
+            instance = Instance._default_manager.get(name=name)
+        except Instance.DoesNotExist:
+            pass
+        else:
+            supervisor.verify([instance])
+
+
+processes = ProcessRegistry()
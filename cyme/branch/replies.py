@@ -0,0 +1,223 @@
+"""cyme.branch.replies
+
+- Keeps one long-lived reply queue for every broker used to send
+  remote control commands to the instances, so that a query
+  doesn't have to declare, consume from and delete a reply queue
+  of its own.
+
+- Replies are routed to the waiting caller by the ticket
+  (routing key) they're sent with.  Tickets are bound to the reply
+  queue ahead of time by the consumer, and reused after that.
+
+- Only used when running as :program:`cyme-branch`, otherwise
+  :meth:`cyme.models.Broker.broadcast` uses a reply queue per call.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import socket
+
+from itertools import count
+from time import time
+
+from celery import current_app as celery
+from eventlet import Timeout, sleep, spawn
+from eventlet.event import Event
+from kombu import Consumer, Queue
+from kombu.log import LogMixin
+from kombu.utils import uuid
+
+from cyme.brokers import brokers
+
+
+class ReplyConsumer(LogMixin):
+    """Consumes the replies to remote control commands sent
+    using one broker.
+
+    :param url: Broker URL.
+
+    """
+
+    #: Time in seconds to wait before reconnecting after connection loss.
+    reconnect_interval = 2.0
+
+    #: Tickets of commands not fully answered in time may still receive
+    #: late replies, so they're not reused until this many seconds later.
+    quarantine = 60.0
+
+    #: Number of tickets kept bound and ready to be used.  When they're
+    #: all in use, callers fall back to a reply queue of their own.
+    spare_tickets = 10
+
+    def __init__(self, url):
+        self.url = url
+        self.mailbox = celery.control.mailbox
+        self.queue = None
+        self._callbacks = {}     # callback by ticket
+        self._free = []          # tickets bound to the current queue
+        self._quarantined = []   # (reusable after, ticket)
+        self._counter = count(1)
+        self._greenlet = None
+
+    def start(self):
+        self._greenlet = spawn(self._consume)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+        self.queue = None
+
+    def call(self, command, arguments, destination=None, timeout=1,
+            limit=None, callback=None, channel=None):
+        """Send remote control command, and call ``callback``
+        with every reply received within ``timeout`` seconds,
+        or until ``limit`` replies has been received.
+
+        :param channel: Channel to publish the command on.
+
+        Returns :const:`False` if the command was not sent,
+        as no ticket is available.
+
+        """
+        ticket = self._acquire_ticket()
+        if ticket is None:
+            return False
+        received = [0]
+        done = Event()
+
+        def on_reply(body):
+            received[0] += 1
+            if callback:
+                callback(body)
+            if limit and received[0] >= limit and not done.ready():
+                done.send()
+
+        self._callbacks[ticket] = on_reply
+        try:
+            self.mailbox._publish(command, arguments, destination=destination,
+                                  reply_ticket=ticket, channel=channel)
+            with Timeout(timeout, False):
+                done.wait()
+        finally:
+            self._callbacks.pop(ticket, None)
+            self._release_ticket(ticket, answered=done.ready())
+        return True
+
+    @property
+    def ready(self):
+        """True if the reply queue is being consumed from."""
+        return self.queue is not None
+
+    def _acquire_ticket(self):
+        now = time()
+        while self._quarantined and self._quarantined[0][0] <= now:
+            self._free.append(self._quarantined.pop(0)[1])
+        if self._free:
+            return self._free.pop()
+
+    def _bind_tickets(self, channel, queue):
+        # called by the consumer, as the bindings must be made on the
+        # channel it's consuming from, and be in place before use.
+        while len(self._free) < self.spare_tickets:
+            ticket = '%s.%s' % (queue.routing_key, next(self._counter))
+            channel.queue_bind(queue=queue.name,
+                               exchange=queue.exchange.name,
+                               routing_key=ticket)
+            self._free.append(ticket)
+
+    def _release_ticket(self, ticket, answered):
+        queue = self.queue
+        if queue is None or not ticket.startswith(queue.routing_key + '.'):
+            return  # bound to a queue that's gone.
+        if answered:
+            self._free.append(ticket)
+        else:
+            self._quarantined.append((time() + self.quarantine, ticket))
+
+    def _on_reply(self, body, message):
+        try:
+            callback = self._callbacks[message.delivery_info['routing_key']]
+        except KeyError:
+            pass  # late reply.
+        else:
+            callback(body)
+        message.ack()
+
+    def _consume(self):
+        while 1:
+            conn = brokers[self.url].connection.clone()
+            try:
+                try:
+                    self._drain_events(conn)
+                except conn.connection_errors + conn.channel_errors, exc:
+                    self.error('Connection to %s lost: %r', self.url, exc)
+                except Exception, exc:
+                    self.error('Cannot consume replies from %s: %r',
+                               self.url, exc)
+                sleep(self.reconnect_interval)
+            finally:
+                self._reset()
+                conn.close()
+
+    def _drain_events(self, conn):
+        # a new queue every time, as the old one (and its bindings)
+        # is deleted when the connection is lost.
+        id = uuid()
+        queue = Queue('%s.%s' % (id, self.mailbox.reply_exchange.name),
+                      exchange=self.mailbox.reply_exchange,
+                      routing_key=id, durable=False, auto_delete=True)
+        channel = conn.default_channel
+        with Consumer(channel, [queue], callbacks=[self._on_reply]):
+            self._bind_tickets(channel, queue)
+            self.queue = queue
+            self.debug('consuming replies from %s', self.url)
+            while 1:
+                self._bind_tickets(channel, queue)
+                try:
+                    conn.drain_events(timeout=1)
+                except socket.timeout:
+                    pass
+
+    def _reset(self):
+        self.queue = None
+        self._free[:] = []
+        self._quarantined[:] = []
+
+    @property
+    def logger_name(self):
+        return 'Replies'
+
+
+class Replies(object):
+    """The reply consumers used by the branch, by broker URL."""
+    Consumer = ReplyConsumer
+
+    def __init__(self):
+        self.enabled = False
+        self._consumers = {}
+
+    def get(self, url):
+        """Returns the reply consumer for broker ``url``,
+        or :const:`None` if it can't be used (yet)."""
+        if not self.enabled:
+            return
+        try:
+            consumer = self._consumers[url]
+        except KeyError:
+            consumer = self._consumers[url] = self.Consumer(url)
+            consumer.start()
+        if consumer.ready:
+            return consumer
+
+    def start(self):
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        consumers, self._consumers = self._consumers, {}
+        for consumer in consumers.itervalues():
+            consumer.stop()
+replies = Replies()
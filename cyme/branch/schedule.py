@@ -0,0 +1,131 @@
+"""cyme.branch.schedule
+
+- Decides when the supervisor verifies each instance.
+
+  Every instance has its own verification interval, so that checks
+  are spread out over time instead of happening in bursts, and
+  instances that recently failed are checked more often than
+  instances that have been stable for a long time.
+
+"""
+
+from __future__ import absolute_import
+
+import heapq
+import random
+
+from time import time
+
+
+class Schedule(object):
+    """Priority queue of instance names, ordered by when they are
+    next due to be verified.
+
+    :param interval: Interval (in seconds as a float) new instances
+        are verified at.
+    :keyword min_interval: Interval used after an instance failed
+        verification, e.g. because it had to be restarted.
+    :keyword max_interval: Max interval for instances that have been
+        stable for a long time.
+    :keyword jitter: Intervals are randomized by this fraction, so that
+        instances scheduled at the same time drift apart.
+
+    """
+
+    #: An instance that passed verification has its interval
+    #: multiplied by this factor (up to :attr:`max_interval`).
+    backoff = 1.5
+
+    def __init__(self, interval, min_interval=None, max_interval=None,
+            jitter=0.1):
+        self.interval = interval
+        self.min_interval = min_interval or interval
+        self.max_interval = max_interval or interval
+        self.jitter = jitter
+        self._heap = []
+        self._due = {}
+        self._intervals = {}
+        self._active = set()
+
+    def __contains__(self, name):
+        return name in self._due or name in self._active
+
+    def __iter__(self):
+        return iter(set(self._due) | self._active | set(self._intervals))
+
+    def __len__(self):
+        return len(self._due)
+
+    def add(self, name, due=None):
+        """Schedule instance to be verified at ``due``
+        (default is right away), unless it's already due before that."""
+        due = time() if due is None else due
+        if due < self._due.get(name, due + 1):
+            self._due[name] = due
+            heapq.heappush(self._heap, (due, name))
+
+    def spread(self, names, now=None):
+        """Schedule new instances evenly spread over one interval."""
+        names = [name for name in names if name not in self]
+        now = time() if now is None else now
+        step = self.interval / (len(names) or 1)
+        for i, name in enumerate(names):
+            self.add(name, now + i * step)
+
+    def reschedule(self, name, ok=True, now=None):
+        """Schedule the next verification of an instance that was just
+        verified.
+
+        :keyword ok: :const:`True` if the instance was consistent,
+            :const:`False` if it failed (the interval drops to
+            :attr:`min_interval`), or :const:`None` if the instance
+            could not be verified (the interval is unchanged).
+
+        """
+        interval = self.interval_for(name)
+        if ok:
+            interval = min(interval * self.backoff, self.max_interval)
+        elif ok is not None:
+            interval = self.min_interval
+        self._intervals[name] = interval
+        now = time() if now is None else now
+        self._active.discard(name)
+        self._due.pop(name, None)
+        self.add(name, now + interval * random.uniform(1 - self.jitter,
+                                                       1 + self.jitter))
+
+    def interval_for(self, name):
+        """Returns the current verification interval of an instance."""
+        return self._intervals.get(name, self.interval)
+
+    def forget(self, name):
+        """Stop scheduling instance, e.g. because it was deleted."""
+        self._due.pop(name, None)
+        self._intervals.pop(name, None)
+        self._active.discard(name)
+
+    def pop_due(self, now=None):
+        """Remove and return the names of the instances that are due.
+
+        The instances are not scheduled again until
+        :meth:`reschedule` (or :meth:`add`) is called for them,
+        e.g. when their verification completes.
+
+        """
+        now = time() if now is None else now
+        heap, due = self._heap, []
+        while heap and heap[0][0] <= now:
+            at, name = heapq.heappop(heap)
+            # skip entries that have been superseded.
+            if self._due.get(name) == at:
+                del self._due[name]
+                self._active.add(name)
+                due.append(name)
+        return due
+
+    def next_due(self):
+        """Returns the time the next instance is due, or :const:`None`."""
+        heap = self._heap
+        while heap and self._due.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
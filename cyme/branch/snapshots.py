@@ -0,0 +1,240 @@
+"""cyme.branch.snapshots
+
+- In-memory cache of the apps, instances and queues in the database,
+  used by the actors so that read requests (like listing instances,
+  or looking up a queue declaration) don't have to query the database.
+
+- The cache is kept up to date using the ``post_save`` and
+  ``post_delete`` signals, and compared with the database at intervals,
+  to catch changes made by other processes.
+
+- The cache is only used when running as :program:`cyme-branch`,
+  otherwise all reads go to the database.
+
+"""
+
+from __future__ import absolute_import
+
+from copy import deepcopy
+
+from django.db.models.signals import post_delete, post_save
+from kombu.log import LogMixin
+
+from cyme import models
+
+
+class SnapshotCache(LogMixin):
+    """Read-through cache of model snapshots (:meth:`as_dict`),
+    by name.
+
+    :param model: The model class to cache.
+
+    Objects are read from the database the first time they're
+    requested, and all objects are read the first time :meth:`names`
+    is called.  After that changes made in this process are applied
+    by signal handlers (see :meth:`connect`), and :meth:`check`
+    reloads the objects from the database.
+
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.connected = False
+        self._snapshots = {}
+        self._index = {}
+        self._names = {}  # name by primary key
+        self._stale = set()
+        self._complete = False
+
+    def connect(self):
+        """Start caching, and keep the cache up to date using signals."""
+        post_save.connect(self._on_save, sender=self.model)
+        post_delete.connect(self._on_delete, sender=self.model)
+        self.connected = True
+
+    def disconnect(self):
+        post_save.disconnect(self._on_save, sender=self.model)
+        post_delete.disconnect(self._on_delete, sender=self.model)
+        self.connected = False
+        self.clear()
+
+    def get(self, name):
+        """Returns the snapshot of the object named ``name``.
+
+        :raises DoesNotExist: if there is no such object.
+
+        """
+        if not self.connected:
+            return self.snapshot(self.objects.get(name=name))
+        if name not in self._stale:
+            try:
+                return deepcopy(self._snapshots[name])
+            except KeyError:
+                if self._complete:
+                    raise self.model.DoesNotExist(name)
+        try:
+            self.store(self.objects.get(name=name))
+        except self.model.DoesNotExist:
+            self._stale.discard(name)
+            raise
+        return deepcopy(self._snapshots[name])
+
+    def names(self, **index):
+        """Returns the names of all objects, or only the objects
+        matching ``index`` (see :meth:`index`)."""
+        if not self.connected:
+            return [obj.name for obj in self.queryset()
+                        if self._matches(self.index(obj), index)]
+        if not self._complete:
+            self.reload()
+        return [name for name in sorted(self._snapshots)
+                    if self._matches(self._index[name], index)]
+
+    def indexed(self, key):
+        """Returns a ``{name: value}`` mapping of the ``key`` index
+        value of all objects (see :meth:`index`)."""
+        if not self.connected:
+            return dict((obj.name, self.index(obj).get(key))
+                            for obj in self.queryset())
+        if not self._complete:
+            self.reload()
+        return dict((name, index.get(key))
+                        for name, index in self._index.iteritems())
+
+    def _matches(self, values, index):
+        return all(values.get(key) == value
+                    for key, value in index.iteritems())
+
+    def snapshot(self, obj):
+        return obj.as_dict()
+
+    def index(self, obj):
+        """Returns values :meth:`names` can be filtered by."""
+        return {}
+
+    def queryset(self):
+        return self.objects.all()
+
+    def store(self, obj):
+        self.discard(obj.pk)
+        self._stale.discard(obj.name)
+        self._snapshots[obj.name] = self.snapshot(obj)
+        self._index[obj.name] = self.index(obj)
+        self._names[obj.pk] = obj.name
+
+    def discard(self, pk):
+        """Remove the object with primary key ``pk`` from the cache."""
+        name = self._names.pop(pk, None)
+        if name is not None:
+            self._snapshots.pop(name, None)
+            self._index.pop(name, None)
+        return name
+
+    def reload(self):
+        """Read all objects from the database."""
+        self.clear()
+        for obj in self.queryset():
+            self.store(obj)
+        self._complete = True
+
+    def clear(self):
+        self._snapshots.clear()
+        self._index.clear()
+        self._names.clear()
+        self._stale.clear()
+        self._complete = False
+
+    def check(self):
+        """Compare the cache with the database, and replace it with
+        the objects in the database if they differ."""
+        if not self.connected or not self._complete:
+            return
+        cached = dict(self._snapshots)
+        self.reload()
+        stale = [name for name in set(cached) | set(self._snapshots)
+                    if cached.get(name) != self._snapshots.get(name)]
+        if stale:
+            self.info('Cache was out of date: %s', ', '.join(sorted(stale)))
+        return stale
+
+    def _on_save(self, sender, instance, **kwargs):
+        self.store(instance)
+
+    def _on_delete(self, sender, instance, **kwargs):
+        self.discard(instance.pk)
+
+    @property
+    def objects(self):
+        return self.model._default_manager
+
+    @property
+    def logger_name(self):
+        return 'Snapshots.%s' % (self.model.__name__, )
+
+
+class InstanceSnapshotCache(SnapshotCache):
+    """Instance snapshots, which can be filtered by ``app`` name,
+    and also change when the queues of an instance, or the
+    app of an instance, change."""
+
+    def index(self, obj):
+        return {'app': obj.app.name}
+
+    def queryset(self):
+        return self.objects.for_sweep()
+
+    def connect(self):
+        super(InstanceSnapshotCache, self).connect()
+        for signal in (post_save, post_delete):
+            signal.connect(self._on_queues_changed,
+                           sender=models.InstanceQueue)
+            signal.connect(self._on_app_changed, sender=models.App)
+
+    def disconnect(self):
+        for signal in (post_save, post_delete):
+            signal.disconnect(self._on_queues_changed,
+                              sender=models.InstanceQueue)
+            signal.disconnect(self._on_app_changed, sender=models.App)
+        super(InstanceSnapshotCache, self).disconnect()
+
+    def _on_queues_changed(self, sender, instance, **kwargs):
+        # read again the next time it's requested.
+        name = self._names.get(instance.instance_id)
+        if name is not None:
+            self._stale.add(name)
+
+    def _on_app_changed(self, sender, instance, **kwargs):
+        self.clear()
+
+
+class Snapshots(object):
+    """The snapshot caches used by the branch."""
+
+    #: Interval (in seconds as a float) between comparing the
+    #: caches with the database.
+    check_interval = 60.0
+
+    def __init__(self):
+        self.apps = SnapshotCache(models.App)
+        self.instances = InstanceSnapshotCache(models.Instance)
+        self.queues = SnapshotCache(models.Queue)
+
+    def connect(self):
+        for cache in self.caches:
+            cache.connect()
+
+    def disconnect(self):
+        for cache in self.caches:
+            cache.disconnect()
+
+    def check(self):
+        for cache in self.caches:
+            try:
+                cache.check()
+            except Exception, exc:
+                cache.error('Cannot check cache: %r', exc)
+
+    @property
+    def caches(self):
+        return (self.apps, self.instances, self.queues)
+snapshots = Snapshots()
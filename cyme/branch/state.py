@@ -21,6 +21,10 @@ class State(object):
     #: set to true if the process is a cyme-branch
     is_branch = False
 
+    #: the :class:`~cyme.branch.monitor.EventMonitor` of this branch,
+    #: if any.
+    monitor = None
+
     def on_broker_revive(self, *args, **kwargs):
         self.broker_last_revived = time()
         self.supervisor.resume()
@@ -3,20 +3,128 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
+from collections import deque
 from threading import Lock
+from time import time
 from Queue import Empty
 
 from celery.local import Proxy
+from django.db.models.signals import post_delete, post_save
+from eventlet import GreenPool
 from eventlet.queue import LightQueue
 from eventlet.event import Event
 
+from . import metrics
+from .schedule import Schedule
 from .signals import supervisor_ready
+from .state import state
 from .thread import gThread
 
+from cyme.models import Instance, RestartState
 from cyme.status import Status
 
 __current = None
 
+#: Lane used for requests that someone is waiting for (e.g. API calls).
+INTERACTIVE = 'interactive'
+
+#: Lane used for periodic verification of instances.
+BACKGROUND = 'background'
+
+
+class Job(object):
+    """An action waiting to be applied to an instance,
+    see :class:`JobQueue`."""
+
+    def __init__(self, instance, action, kwargs, lane, key):
+        self.instance = instance
+        self.action = action
+        self.kwargs = kwargs
+        self.lane = lane
+        self.key = key
+        self.started = False
+        self.done = Event()
+
+    def wait(self):
+        """Wait until the action has been applied."""
+        return self.done.wait()
+
+
+class JobQueue(object):
+    """Queue of actions to apply to instances, with one lane for
+    interactive requests and one for background requests.
+
+    Jobs in the interactive lane are always started before jobs in
+    the background lane, and a request for an action that is already
+    waiting to be applied to the same instance (with the same
+    arguments) shares the existing job instead of adding a new one.
+
+    Jobs for the same instance are always started in the order they
+    were requested: when an interactive job is added, any background
+    jobs already waiting for that instance are moved to the
+    interactive lane.
+
+    """
+    lanes = (INTERACTIVE, BACKGROUND)
+
+    def __init__(self):
+        self._lanes = dict((lane, deque()) for lane in self.lanes)
+        self._pending = {}
+        # one token for every job not yet started.
+        self._ready = LightQueue()
+
+    def __len__(self):
+        return self._ready.qsize()
+
+    def put(self, instance, action, kwargs={}, lane=INTERACTIVE):
+        """Add job, or return the job already waiting for the same
+        action to be applied to the same instance."""
+        name = instance.name
+        key = (action, tuple(sorted((k, v) for k, v in kwargs.iteritems()
+                                        if k != 'replies')))
+        pending = self._pending.setdefault(name, [])
+        if lane == INTERACTIVE:
+            for job in pending:
+                if job.lane != lane:
+                    job.lane = lane
+                    self._lanes[lane].append(job)
+        if pending and pending[-1].key == key:
+            job = pending[-1]
+            if kwargs.get('replies') is not None:
+                job.kwargs = kwargs  # more recent snapshot.
+            return job
+        job = Job(instance, action, kwargs, lane, key)
+        pending.append(job)
+        self._lanes[lane].append(job)
+        self._ready.put_nowait(None)
+        metrics.jobs_waiting.set(len(self))
+        return job
+
+    def get(self, timeout=None):
+        """Remove and return the next job to start.
+
+        :raises Queue.Empty: if no job is available within ``timeout``.
+
+        """
+        self._ready.get(timeout=timeout)
+        for lane in self.lanes:
+            jobs = self._lanes[lane]
+            while jobs:
+                job = jobs.popleft()
+                if not job.started and job.lane == lane:
+                    return self._start(job)
+        raise RuntimeError('JobQueue: ready but no jobs')
+
+    def _start(self, job):
+        job.started = True
+        name = job.instance.name
+        pending = self._pending[name]
+        pending.remove(job)
+        if not pending:
+            del self._pending[name]
+        metrics.jobs_waiting.set(len(self))
+        return job
+
 
 class Supervisor(gThread, Status):
     """The supervisor wakes up at intervals to monitor changes in the model.
@@ -24,9 +132,25 @@ class Supervisor(gThread, Status):
     operations can be either async or sync.
 
     :keyword interval:  This is the interval (in seconds as an int/float),
-       between verifying all the registered instances.
+       between verifying a registered instance.  The actual interval
+       is adapted for every instance, see :attr:`min_interval` and
+       :attr:`stale_after`.
     :keyword queue: Custom :class:`~Queue.Queue` instance used to send
         and receive commands.
+    :keyword pool_size: Max number of instances to operate on at the same
+       time.  Operations on the same instance are always performed
+       in the order they were requested.
+    :keyword stale_after: Max time in seconds an instance can go
+       without being verified.
+    :keyword min_interval: Interval (in seconds as an int/float) between
+       verifying an instance that recently failed verification.
+
+    Requests are either interactive (the default) or background
+    requests, where interactive requests always go first
+    (see :class:`JobQueue`).  Periodic verification of instances
+    uses the background lane, so API requests don't have to wait
+    for it to complete.  Requesting an action that is already waiting
+    to be applied to the same instance doesn't apply the action twice.
 
     It is responsible for:
 
@@ -41,42 +165,89 @@ class Supervisor(gThread, Status):
           model,  sending ``autoscale`` broadcast commands to the noes
           as it finds inconsistencies.
 
+    Every instance is verified on its own schedule
+    (see :class:`~cyme.branch.schedule.Schedule`), so the checks are
+    spread out evenly over time instead of all happening at once.
+    Instances that failed verification, e.g. because they had to be
+    restarted, are verified again after :attr:`min_interval` seconds,
+    and the interval grows for every successful verification up to
+    :attr:`stale_after` seconds.  Instances where the model changed
+    are verified right away.
+
     The supervisor is resilient to intermittent connection failures,
     and will auto-retry any operation that is dependent on a broker.
 
+    Restarted instances are not waited for: the supervisor moves on to
+    other instances, and verifies the instance again as soon as the
+    worker reports that it's online (see
+    :meth:`~cyme.branch.monitor.EventMonitor.expect_online`).
+
     Since workers cannot respond to broadcast commands while the
     broker is off-line, the supervisor will not restart affected
     instances until the instance has had a chance to reconnect (decided
     by the :attr:`wait_after_broker_revived` attribute).
 
     """
-    #: Limit instance restarts to 1/m, so out of control
-    #: instances will be disabled
-    restart_max_rate = '1/m'
+    #: Restart state of instances not restarted for this many seconds
+    #: is deleted.
+    restart_idle_after = 24 * 3600.0
 
     #: Default interval_max for ensure_connection is 30 secs.
     wait_after_broker_revived = 35.0
 
     #: Connection errors pauses the supervisor, so events does not accumulate.
     paused = False
+    paused_at = None
 
     #: Default interval (time in seconds as a float to reschedule).
     interval = 60.0
 
-    def __init__(self, interval=None, queue=None, set_as_current=True):
+    #: Default max number of instances to operate on concurrently.
+    pool_size = 10
+
+    #: Instances not verified for this many seconds are verified again,
+    #: even if they are not known to have changed.
+    stale_after = 300.0
+
+    #: Default interval between verifying instances that recently failed.
+    min_interval = 5.0
+
+    #: Max time in seconds to wait for a restarted instance to come online.
+    restart_timeout = 30.0
+
+    #: Interval (in seconds as a float) between looking for instances
+    #: that are due to be verified.
+    tick = 1.0
+
+    def __init__(self, interval=None, queue=None, set_as_current=True,
+            pool_size=None, stale_after=None, min_interval=None):
         self.set_as_current = set_as_current
         if self.set_as_current:
             set_current(self)
         self._orig_queue_arg = queue
         self.interval = interval or self.interval
+        self.pool_size = pool_size or self.pool_size
+        self.stale_after = stale_after or self.stale_after
+        self.min_interval = min(min_interval or self.min_interval,
+                                self.interval)
         self.queue = LightQueue() if queue is None else queue
+        self.jobs = JobQueue()
+        self.pool = GreenPool(self.pool_size)
         self._pause_mutex = Lock()
-        self._last_update = None
+        self._inflight = {}
+        self._dirty = set()
+        self._restarting = {}
+        self.schedule = Schedule(self.interval,
+                                 min_interval=self.min_interval,
+                                 max_interval=self.stale_after)
         gThread.__init__(self)
         Status.__init__(self)
 
     def __copy__(self):
-        return self.__class__(self.interval, self._orig_queue_arg)
+        return self.__class__(self.interval, self._orig_queue_arg,
+                              pool_size=self.pool_size,
+                              stale_after=self.stale_after,
+                              min_interval=self.min_interval)
 
     def pause(self):
         """Pause all timers."""
@@ -85,6 +256,8 @@ class Supervisor(gThread, Status):
             if not self.paused:
                 self.debug('pausing')
                 self.paused = True
+                self.paused_at = time()
+                metrics.paused.set(1)
 
     def resume(self):
         """Resume all timers."""
@@ -92,34 +265,52 @@ class Supervisor(gThread, Status):
             if self.paused:
                 self.debug('resuming')
                 self.paused = False
+                metrics.paused.set(0)
+                if self.paused_at is not None:
+                    metrics.paused_seconds.inc(time() - self.paused_at)
+                    self.paused_at = None
 
-    def verify(self, instances, ratelimit=False):
+    def verify(self, instances, ratelimit=False, sweep=False,
+            lane=INTERACTIVE):
         """Verify the consistency of one or more instances.
 
         :param instances: List of instances to verify.
+        :keyword sweep: If true all the instances are inspected
+            using a single broadcast
+            (see :meth:`~cyme.status.Status.inspect_all`), instead of
+            inspecting the instances one by one.
+        :keyword lane: Either ``"interactive"`` (default)
+            or ``"background"``.
 
         This operation is asynchronous, and returns a :class:`Greenlet`
         instance that can be used to wait for the operation to complete.
 
         """
         return self._request(instances, self._do_verify_instance,
-                            {'ratelimit': ratelimit})
+                            {'ratelimit': ratelimit},
+                            prepare=self._prepare_sweep if sweep else None,
+                            lane=lane)
 
-    def restart(self, instances):
+    def restart(self, instances, lane=INTERACTIVE):
         """Restart one or more instances.
 
         :param instances: List of instances to restart.
+        :keyword lane: Either ``"interactive"`` (default)
+            or ``"background"``.
 
         This operation is asynchronous, and returns a :class:`Greenlet`
         instance that can be used to wait for the operation to complete.
 
         """
-        return self._request(instances, self._do_restart_instance)
+        return self._request(instances, self._do_restart_instance,
+                             lane=lane)
 
-    def shutdown(self, instances):
+    def shutdown(self, instances, lane=INTERACTIVE):
         """Shutdown one or more instances.
 
         :param instances: List of instances to stop.
+        :keyword lane: Either ``"interactive"`` (default)
+            or ``"background"``.
 
         This operation is asynchronous, and returns a :class:`Greenlet`
         instance that can be used to wait for the operation to complete.
@@ -131,47 +322,226 @@ class Supervisor(gThread, Status):
             model has been marked as disabled.
 
         """
-        return self._request(instances, self._do_stop_instance)
+        return self._request(instances, self._do_stop_instance, lane=lane)
 
-    def _request(self, instances, action, kwargs={}):
+    def _request(self, instances, action, kwargs={}, prepare=None,
+            lane=INTERACTIVE):
         event = Event()
-        self.queue.put_nowait((instances, event, action, kwargs))
+        self.queue.put_nowait((instances, event, action, kwargs,
+                               prepare, lane))
         return event
 
+    def _prepare_sweep(self, instances):
+        if self.paused:
+            return {}
+        return {'replies': self.inspect_all(instances)}
+
+    def _do_verify_instance(self, instance, **kwargs):
+        name = instance.name
+        if self._restarting.get(name, 0) > time():
+            # still waiting for the instance to come online.
+            self.schedule.reschedule(name, None)
+            return
+        self._dirty.discard(name)
+        consistent = None
+        try:
+            consistent = Status._do_verify_instance(self, instance, **kwargs)
+        finally:
+            self.schedule.reschedule(name, consistent)
+            if name in self._dirty:
+                # changed while being verified.
+                self.schedule.add(name)
+        return consistent
+
+    def _verify_restart_instance(self, instance):
+        """Restart the instance without waiting for it to come online.
+
+        Returns :const:`None`, as the outcome is not known yet.
+        Falls back to polling the instance using ping if no event
+        monitor is running.
+
+        """
+        monitor = state.monitor
+        if monitor is None:
+            return Status._verify_restart_instance(self, instance)
+
+        def on_online(hostname, alive):
+            self._restarting.pop(instance.name, None)
+            self._on_restart_done(instance, alive)
+
+        # expect the online event before restarting, so it's not missed
+        # if the worker is quick to start.
+        self._restarting[instance.name] = time() + self.restart_timeout
+        monitor.expect_online(instance.name, self.restart_timeout, on_online)
+        self.info('%s instance.restart' % (instance, ))
+        try:
+            instance.restart()
+        except Exception:
+            self._restarting.pop(instance.name, None)
+            raise
+
+    def _on_restart_done(self, instance, alive):
+        if not alive:
+            # maybe the worker doesn't send events.
+            alive = self.insured(instance, instance.responds_to_ping)
+        if alive:
+            self.info('%s successfully restarted' % (instance, ))
+            # verify queues and concurrency settings now that it's up.
+            self.verify([instance])
+        else:
+            self.info("%s instance doesn't respond after restart" % (
+                    instance, ))
+
+    def mark_dirty(self, name):
+        """Mark instance as dirty, so it will be verified right away."""
+        self._dirty.add(name)
+        self.schedule.add(name)
+
+    def _on_instance_changed(self, sender, instance, **kwargs):
+        self.mark_dirty(instance.name)
+
+    def _on_instance_deleted(self, sender, instance, **kwargs):
+        self._dirty.discard(instance.name)
+        self._restarting.pop(instance.name, None)
+        self.schedule.forget(instance.name)
+        self.failing.pop(instance.name, None)
+
     def before(self):
-        self.start_periodic_timer(self.interval, self._verify_all)
+        post_save.connect(self._on_instance_changed, sender=Instance)
+        post_delete.connect(self._on_instance_deleted, sender=Instance)
+        self._sync_schedule()
+        self.start_periodic_timer(self.interval, self._sync_schedule)
+        self.start_periodic_timer(self.tick, self._verify_due)
+
+    def after(self):
+        post_save.disconnect(self._on_instance_changed, sender=Instance)
+        post_delete.disconnect(self._on_instance_deleted, sender=Instance)
 
     def run(self):
         queue = self.queue
         self.info('started')
         supervisor_ready.send(sender=self)
+        self.spawn(self._dispatch)
         while not self.should_stop:
             try:
-                instances, event, action, kwargs = queue.get(timeout=1)
+                request = queue.get(timeout=1)
             except Empty:
                 self.respond_to_ping()
                 continue
             self.respond_to_ping()
             self.debug('wake-up')
+            if request[4] is not None:
+                # don't delay other requests while preparing.
+                self.spawn(self._accept, *request)
+            else:
+                self._accept(*request)
+
+    def _accept(self, instances, event, action, kwargs, prepare, lane):
+        jobs = []
+        try:
+            if prepare is not None:
+                instances = list(instances)
+                try:
+                    kwargs = dict(kwargs, **prepare(instances))
+                except Exception, exc:
+                    self.error('Preparing event caused exception: %r', exc)
+            for instance in instances:
+                jobs.append(self.jobs.put(instance, action, kwargs, lane))
+        finally:
+            self.spawn(self._send_when_done, jobs, event)
+
+    def _dispatch(self):
+        """Start jobs as they become available, in order of priority."""
+        while not self.should_stop:
             try:
-                for instance in instances:
-                    try:
-                        action(instance, **kwargs)
-                    except Exception, exc:
-                        self.error('Event caused exception: %r', exc)
-            finally:
-                event.send(True)
-
-    def _verify_all(self, force=False):
-        if self._last_update and self._last_update.ready():
+                job = self.jobs.get(timeout=1)
+            except Empty:
+                continue
+            except Exception, exc:
+                # keep going, no jobs would be started after this.
+                self.error('Cannot get next job: %r', exc)
+                continue
             try:
-                self._last_update.wait()  # collect result
-            except self.GreenletExit:
-                pass
-            force = True
-        if not self._last_update or force:
-            self._last_update = self.verify(self.all_instances(),
-                                            ratelimit=True)
+                self._spawn_action(job.instance, job.action,
+                                   job.kwargs).link(self._on_job_done, job)
+            except Exception, exc:
+                self.error('Cannot start job: %r', exc)
+                job.done.send(True)
+
+    def _on_job_done(self, greenthread, job):
+        job.done.send(True)
+
+    def _spawn_action(self, instance, action, kwargs):
+        """Apply action to instance using the pool, but only
+        after any previous action on the same instance completed."""
+        name = instance.name
+        job = self.pool.spawn(self._apply_action, self._inflight.get(name),
+                              instance, action, kwargs)
+        self._inflight[name] = job
+        job.link(self._on_action_done, name)
+        return job
+
+    def _apply_action(self, previous, instance, action, kwargs):
+        if previous is not None:
+            previous.wait()
+        self.respond_to_ping()
+        try:
+            action(instance, **kwargs)
+        except Exception, exc:
+            self.error('Event caused exception: %r', exc)
+
+    def _on_action_done(self, job, name):
+        if self._inflight.get(name) is job:
+            self._inflight.pop(name, None)
+
+    def _send_when_done(self, jobs, event):
+        try:
+            for job in jobs:
+                job.wait()
+        finally:
+            event.send(True)
+
+    def _sync_schedule(self):
+        """Schedule instances not known to the supervisor, e.g.
+        created by another process, and forget instances that have
+        been deleted."""
+        names = Instance._default_manager.values_list('name', flat=True)
+        for name in set(self.schedule) - set(names):
+            self.schedule.forget(name)
+        self.schedule.spread(names)
+        RestartState._default_manager.evict(names, self.restart_idle_after)
+
+    def _verify_due(self):
+        """Verify the instances that are due, using a single broadcast
+        for all of them."""
+        names = self.schedule.pop_due()
+        if not names:
+            return
+        if self.paused:
+            for name in names:
+                self.schedule.reschedule(name, None)
+            return
+        started = time()
+        try:
+            instances = Instance._default_manager.for_sweep(name__in=names)
+            event = None
+            if instances:
+                event = self.verify(instances, ratelimit=True, sweep=True,
+                                    lane=BACKGROUND)
+        except Exception, exc:
+            # e.g. database is locked, try again later.
+            self.error('Cannot verify instances: %r', exc)
+            for name in names:
+                self.schedule.reschedule(name, None)
+            return
+        for name in set(names) - set(i.name for i in instances):
+            self.schedule.forget(name)
+        if event is not None:
+            self.spawn(self._observe_sweep, started, event)
+
+    def _observe_sweep(self, started, event):
+        event.wait()
+        metrics.sweep_seconds.observe(time() - started)
 
 
 class _OfflineSupervisor(object):
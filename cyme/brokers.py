@@ -0,0 +1,113 @@
+"""cyme.brokers
+
+- Keeps one connection, connection pool and producer pool for every
+  broker URL used by this process, shared by all the
+  :class:`~cyme.models.Broker` objects using that URL.
+
+- The size of the pools can be set for every broker using the
+  ``CYME_BROKER_POOL_LIMITS`` setting (a ``{url: limit}`` mapping),
+  the default is the global kombu pool limit.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+from celery import current_app as celery
+from kombu.pools import ProducerPool, get_limit
+
+from cyme.branch import metrics
+from cyme.utils import find_symbol
+
+
+class InstrumentedProducerPool(ProducerPool):
+    """Producer pool recording the time spent waiting for a producer,
+    and the number of producers in use."""
+
+    def __init__(self, connections, name, *args, **kwargs):
+        self.name = name
+        super(InstrumentedProducerPool, self).__init__(connections,
+                                                       *args, **kwargs)
+
+    def acquire(self, *args, **kwargs):
+        with metrics.producer_wait_seconds.time(broker=self.name):
+            producer = super(InstrumentedProducerPool, self).acquire(
+                            *args, **kwargs)
+        self._update_in_use()
+        return producer
+
+    def release(self, resource):
+        super(InstrumentedProducerPool, self).release(resource)
+        self._update_in_use()
+
+    def _update_in_use(self):
+        metrics.producers_in_use.set(len(self._dirty), broker=self.name)
+
+
+class BrokerConnections(object):
+    """The connection, connection pool and producer pool
+    used for one broker URL.
+
+    :param url: Broker URL.
+    :keyword limit: Max number of connections (and producers).
+
+    """
+
+    def __init__(self, url, limit=None):
+        self.url = url
+        self.limit = limit
+        self.connection = celery.broker_connection(url)
+        #: URL without password, used to label metrics.
+        self.name = self.connection.as_uri()
+        self.pool = self.connection.Pool(limit=limit)
+        self.producers = InstrumentedProducerPool(self.pool, self.name,
+                                                  limit=limit)
+        metrics.broker_pool_limit.set(limit or 0, broker=self.name)
+
+    def close(self):
+        for pool in (self.producers, self.pool):
+            try:
+                pool.force_close_all()
+            except Exception:
+                pass
+
+
+class BrokerRegistry(object):
+    """Registry of :class:`BrokerConnections` by broker URL.
+
+    The connections for a URL are created the first time
+    they're requested.
+
+    """
+
+    def __init__(self):
+        self._brokers = {}
+        self._limits = {}
+
+    def __getitem__(self, url):
+        try:
+            return self._brokers[url]
+        except KeyError:
+            broker = self._brokers[url] = BrokerConnections(
+                                            url, self.get_limit(url))
+            return broker
+
+    def __contains__(self, url):
+        return url in self._brokers
+
+    def get_limit(self, url):
+        """Returns the pool limit used for broker ``url``."""
+        limit = self._limits.get(url)
+        if limit is None:
+            limit = self.limits.get(url)
+        return get_limit() if limit is None else limit
+
+    def set_limit(self, url, limit):
+        """Change the pool limit for broker ``url``.
+        Must be called before the broker is used."""
+        self._limits[url] = limit
+
+    @property
+    def limits(self):
+        return find_symbol(self, 'cyme.conf.CYME_BROKER_POOL_LIMITS')
+brokers = BrokerRegistry()
@@ -166,6 +166,9 @@ class Client(base.Client):
             def stats(self):
                 return self.parent.stats(self.name)
 
+            def restarts(self):
+                return self.parent.restarts(self.name)
+
             def autoscale(self, max=None, min=None):
                 return self.parent.autoscale(self.name, max=max, min=min)
 
@@ -214,6 +217,9 @@ class Client(base.Client):
         def stats(self, name):
             return self.GET(self.path / name / 'stats')
 
+        def restarts(self, name):
+            return self.GET(self.path / name / 'restarts')
+
         def autoscale(self, name, max=None, min=None):
             return self.POST(self.path / name / 'autoscale',
                              params={'max': max, 'min': min})
@@ -9,3 +9,10 @@ from .utils import Path
 CYME_INSTANCE_DIR = Path(getattr(settings,
                         'CYME_INSTANCE_DIR', 'instances')).absolute()
 CYME_DEFAULT_POOL = getattr(settings, 'CYME_DEFAULT_POOL', 'processes')
+CYME_BROKER_POOL_LIMITS = getattr(settings, 'CYME_BROKER_POOL_LIMITS', {})
+CYME_APP_CACHE_LIMIT = getattr(settings, 'CYME_APP_CACHE_LIMIT', 1000)
+CYME_APP_CACHE_TTL = getattr(settings, 'CYME_APP_CACHE_TTL', 300.0)
+CYME_PLACEMENT_SCORE = getattr(settings, 'CYME_PLACEMENT_SCORE',
+                               'cyme.branch.placement.default_score')
+CYME_PLACEMENT_MAX_DISK_USE = getattr(settings,
+                                      'CYME_PLACEMENT_MAX_DISK_USE', 90)
@@ -0,0 +1,46 @@
+"""cyme.management
+
+- Moves the queues of instances created by earlier versions
+  into the :class:`~cyme.models.InstanceQueue` table when
+  running :program:`syncdb`.
+
+"""
+
+from __future__ import absolute_import
+
+from django.db import connection, transaction
+from django.db.models.signals import post_syncdb
+
+from cyme import models
+
+#: Column that used to hold the comma-separated list of queues.
+LEGACY_QUEUES_COLUMN = '_queues'
+
+
+def migrate_instance_queues(sender, **kwargs):
+    """Move the queues stored in the legacy ``_queues`` column
+    of the instance table into the instance queues table.
+
+    The legacy column is cleared afterwards, so this only does
+    something the first time :program:`syncdb` runs after upgrading.
+
+    """
+    table = models.Instance._meta.db_table
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    columns = [c[0] for c in
+                connection.introspection.get_table_description(cursor, table)]
+    if LEGACY_QUEUES_COLUMN not in columns:
+        return
+    cursor.execute('SELECT id, %s FROM %s WHERE %s IS NOT NULL' % (
+        qn(LEGACY_QUEUES_COLUMN), qn(table), qn(LEGACY_QUEUES_COLUMN)))
+    rows = cursor.fetchall()
+    for pk, queues in rows:
+        for queue in (queues or '').split(','):
+            if queue:
+                models.InstanceQueue._default_manager.get_or_create(
+                        instance_id=pk, queue=queue)
+    cursor.execute('UPDATE %s SET %s = NULL' % (qn(table),
+                                                qn(LEGACY_QUEUES_COLUMN)))
+    transaction.commit_unless_managed()
+post_syncdb.connect(migrate_instance_queues, sender=models)
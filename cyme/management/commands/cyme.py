@@ -50,6 +50,19 @@ Options
 
     Broker to use for a local `branches` request.
 
+.. cmdoption:: --batch-size
+
+    Number of instances to operate on at the same time for the
+    `start-all`, `restart-all` and `shutdown-all` commands,
+    i.e. the max number of instances unavailable at once.
+    Default is 1.
+
+.. cmdoption:: --max-failure-rate
+
+    Abort `start-all`, `restart-all` and `shutdown-all` if the ratio of
+    failed instances (0.0-1.0) exceeds this value.
+    Default is to never abort.
+
 """
 
 from __future__ import absolute_import
@@ -57,6 +70,7 @@ from __future__ import absolute_import
 import anyjson
 import os
 import pprint
+import sys
 
 from functools import partial
 from inspect import getargspec
@@ -100,6 +114,7 @@ class I(object):
                 'add': self.add_instance,
                 'delete': self.delete_instance,
                 'stats': self.instance_stats,
+                'restarts': self.instance_restarts,
                 'autoscale': self.instance_autoscale},
             'queues': {
                 'all': self.all_queues,
@@ -129,7 +144,7 @@ class I(object):
         raise NotImplementedError('subclass responsibility')
     all_apps = get_app = add_app = delete_app = \
         all_instances = get_instances = add_instance = delete_instance = \
-            instance_stats = instance_autoscale = \
+            instance_stats = instance_restarts = instance_autoscale = \
                 all_queues = get_queue = add_queue = delete_queue = \
                     all_consumers = add_consumer = delete_consumer = _ni
 
@@ -203,6 +218,9 @@ class WebI(I):
     def instance_stats(self, name):
         return self.client.instances.get(name).stats()
 
+    def instance_restarts(self, name):
+        return self.client.instances.get(name).restarts()
+
     def instance_autoscale(self, name, max=None, min=None):
         return self.client.instances.get(name).autoscale(max=max, min=min)
 
@@ -306,6 +324,9 @@ class LocalI(I):
     def instance_stats(self, name):
         return self.instances.stats(name)
 
+    def instance_restarts(self, name):
+        return self.instances.restarts(name)
+
     def _get_instance(self, name):
         return self.instances.objects.get(name=name)
 
@@ -346,6 +367,10 @@ class LocalI(I):
         return {'ok': self.queues.delete(name)}
 
 
+#: Commands operating on all instances in batches, using green threads.
+ROLLING_COMMANDS = frozenset(['start-all', 'restart-all', 'shutdown-all'])
+
+
 class Command(CymeCommand):
     name = 'cyme'
     args = """type command [args]
@@ -356,15 +381,16 @@ E.g.:
 
     cyme -a <app> instances
     cyme -a <app> instances.add [name] [broker URL] [arguments] [extra config]
-    cyme -a <app> instances.[get|delete|stats] <name>
+    cyme -a <app> instances.[get|delete|stats|restarts] <name>
     cyme -a <app> instances.autoscale <name> [max] [min]
 
     cyme -a <app> queues
     cyme -a <app> queues.add <name> [exchange] [type] [rkey] [opts]
     cyme -a <app> queues.[get|delete] <name>
 
-    cyme start-all
-    cyme shutdown-all
+    cyme [--batch-size=n] [--max-failure-rate=f] start-all
+    cyme [--batch-size=n] [--max-failure-rate=f] restart-all
+    cyme [--batch-size=n] [--max-failure-rate=f] shutdown-all
 
     cyme createsuperuser
 
@@ -395,12 +421,22 @@ E.g.:
        Option('-b', '--broker',
               default='None', dest='broker',
               help='Broker to use for a local branches request'),
+       Option('--batch-size',
+              default=1, action='store', type='int', dest='batch_size',
+              help='Number of instances to start/restart/stop at once'),
+       Option('--max-failure-rate',
+              default=None, action='store', type='float',
+              dest='max_failure_rate',
+              help='Abort start/restart/stop if the ratio of failed \
+instances exceeds this value (0.0-1.0)'),
     )
 
     help = 'Cyme management utility'
 
     def handle(self, *args, **kwargs):
         local = kwargs.pop('local', False)
+        self.batch_size = kwargs.pop('batch_size', None) or 1
+        self.max_failure_rate = kwargs.pop('max_failure_rate', None)
         kwargs = self.prepare_options(**kwargs)
         self.commands = {'shell': self.drop_into_shell,
                          'sh': self.drop_into_shell,
@@ -421,13 +457,38 @@ E.g.:
             self.print_help()
 
     def start_all(self):
-        self.status.start_all()
+        self.rolling(self.status.start_all)
 
     def restart_all(self):
-        self.status.restart_all()
+        self.rolling(self.status.restart_all)
 
     def shutdown_all(self):
-        self.status.shutdown_all()
+        self.rolling(self.status.shutdown_all)
+
+    def run_from_argv(self, argv):
+        if ROLLING_COMMANDS.intersection(argv) and \
+                not self.env.needs_eventlet:
+            # instances in a batch are operated on using green threads,
+            # so eventlet must be set up before any connection is made.
+            self.env.needs_eventlet = True
+            self.env.setup_eventlet()
+            self.env.setup_pool_limit()
+        return super(Command, self).run_from_argv(argv)
+
+    def rolling(self, fun):
+        try:
+            failed = fun(batch_size=self.batch_size,
+                         max_failure_rate=self.max_failure_rate,
+                         progress=self.report_progress)
+        except self.status.RollingAborted, exc:
+            die(str(exc))
+        if failed:
+            die('%s instance(s) failed: %s' % (len(failed),
+                                               ', '.join(failed)))
+
+    def report_progress(self, done, total, failed):
+        sys.stderr.write('%s/%s instances done, %s failed\n' % (
+                            done, total, len(failed)))
 
     def drop_into_shell(self):
         from cyme.utils import setup_logging
@@ -42,6 +42,16 @@ Options
 
     Supervisor schedule Interval in seconds.  Default is 5.
 
+.. cmdoption:: --sup-pool-size
+
+    Max number of instances the supervisor operates on at the same time.
+    Default is 10.
+
+.. cmdoption:: --spawn-limit
+
+    Max number of worker instances starting up at the same time.
+    Default is 10.
+
 """
 
 from __future__ import absolute_import
@@ -68,7 +78,8 @@ BANNER = """
 -- * - **** ---   . url:         http://%(addr)s:%(port)s
 - ** ----------   . broker:      %(broker)s
 - ** ----------   . logfile:     %(logfile)s@%(loglevel)s
-- ** ----------   . sup:         interval=%(sup.interval)s
+- ** ----------   . sup:         interval=%(sup.interval)s \
+pool_size=%(sup.pool_size)s spawn_limit=%(spawn_limit)s
 - ** ----------   . presence:    interval=%(presence.interval)s
 - *** --- * ---   . controllers: #%(controllers)s
 -- ******* ----   . instancedir: %(instance_dir)s
@@ -113,6 +124,12 @@ class Command(CymeCommand):
        Option('--sup-interval',
               default=60, action='store', type='int', dest='sup_interval',
               help='Supervisor schedule interval.  Default is every minute.'),
+       Option('--sup-pool-size',
+              default=10, action='store', type='int', dest='sup_pool_size',
+              help='Number of instances to supervise at once.  Default is 10'),
+       Option('--spawn-limit',
+              default=10, action='store', type='int', dest='spawn_limit',
+              help='Number of instances starting up at once.  Default is 10'),
     ) + daemon_options(default_detach_pidfile)
 
     _startup_pbar = None
@@ -193,6 +210,8 @@ class Command(CymeCommand):
                          'addr': addr or 'localhost',
                          'port': port or 8000,
                          'sup.interval': sup.interval,
+                         'sup.pool_size': sup.pool_size,
+                         'spawn_limit': branch.about()['spawn_limit'],
                          'presence.interval': pres_interval,
                          'controllers': len(con),
                          'instance_dir': self.instance_dir}
@@ -248,6 +267,7 @@ class Command(CymeCommand):
                  self.signals.thread_post_start)
         osigs = (self.signals.httpd_ready,
                  self.signals.supervisor_ready,
+                 self.signals.monitor_ready,
                  self.signals.controller_ready,
                  self.signals.branch_ready)
 
@@ -8,6 +8,7 @@ import os
 import shlex
 import warnings
 
+from datetime import datetime, timedelta
 from threading import Lock
 
 from anyjson import deserialize
@@ -17,17 +18,22 @@ from celery.bin.celeryd_multi import MultiTool
 from celery.utils.encoding import safe_str
 from eventlet import Timeout
 from kombu.log import get_logger
-from kombu.pools import connections, producers
 
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
 from . import managers
+from cyme.branch import metrics
+from cyme.brokers import brokers
 from cyme.utils import cached_property, find_symbol
 
 logger = get_logger('Instance')
 
 
+def isoformat(dt):
+    return dt.isoformat() if dt else None
+
+
 def shsplit(s):
     if s:
         return shlex.split(safe_str(s))
@@ -54,19 +60,77 @@ class Broker(models.Model):
         """Returns this broker as a dictionary that can be Json encoded."""
         return {'url': self.url}
 
+    def broadcast(self, cmd, args={}, destination=None, **kwargs):
+        """Send remote control command to the instances using this broker,
+        and return a ``{name: reply}`` mapping of the replies received.
+
+        When ``destination`` is a list of instance names the broadcast
+        completes as soon as all of them replied, so any number
+        of instances can be queried using a single round trip.
+
+        When running as a branch the replies are received using the
+        long-lived reply queue for this broker (see
+        :mod:`cyme.branch.replies`).
+
+        """
+        timeout = kwargs.setdefault('timeout', 3)
+        if destination is not None:
+            kwargs.setdefault('limit', len(destination))
+        replies = {}
+        producer = None
+        if 'connection' not in kwargs:
+            producer = self.producers.acquire(block=True, timeout=3)
+            kwargs.update(connection=producer.connection,
+                          channel=producer.channel)
+        try:
+            try:
+                with metrics.action_seconds.time(action=cmd):
+                    with Timeout(timeout):
+                        consumer = None
+                        if producer is not None:
+                            consumer = self.replies.get(self.url)
+                        if consumer is None or not consumer.call(
+                                cmd, args, destination, timeout=timeout,
+                                limit=kwargs.get('limit'),
+                                callback=replies.update,
+                                channel=producer.channel):
+                            celery.control.broadcast(cmd, arguments=args,
+                                                reply=True,
+                                                destination=destination,
+                                                callback=replies.update,
+                                                **kwargs)
+            except Timeout:
+                pass
+            for name in set(destination or ()) - set(replies):
+                metrics.broadcast_timeouts.inc(instance=name, command=cmd)
+            return replies
+        finally:
+            if producer is not None:
+                producer.release()
+
     @property
     def pool(self):
         """Connection pool for this connection."""
-        return connections[self.connection]
+        return self.connections.pool
 
     @property
     def producers(self):
         """Producer pool for this connection."""
-        return producers[self.connection]
+        return self.connections.producers
 
-    @cached_property
+    @property
     def connection(self):
-        return celery.broker_connection(self.url)
+        return self.connections.connection
+
+    @property
+    def connections(self):
+        """The connections shared by all brokers with the same URL
+        (see :mod:`cyme.brokers`)."""
+        return brokers[self.url]
+
+    @property
+    def replies(self):
+        return find_symbol(self, 'cyme.branch.replies.replies')
 
 
 class App(models.Model):
@@ -74,6 +138,10 @@ class App(models.Model):
     Broker = Broker
     objects = managers.AppManager()
 
+    #: The default broker, used if the app has no broker
+    #: (cached by :meth:`get_broker`).
+    _default_broker = None
+
     name = models.CharField(_(u'name'), max_length=128, unique=True)
     broker = models.ForeignKey(Broker, null=True, blank=True)
     arguments = models.TextField(_(u'arguments'), null=True, blank=True)
@@ -88,7 +156,10 @@ class App(models.Model):
 
     def get_broker(self):
         if self.broker is None:
-            return self.Broker._default_manager.get_default()
+            if self._default_broker is None:
+                self._default_broker = \
+                        self.Broker._default_manager.get_default()
+            return self._default_broker
         return self.broker
 
     def as_dict(self):
@@ -130,19 +201,58 @@ class Queue(models.Model):
                 'options': self.options}
 
 
+class Queues(list):
+    """List of the names of the queues an instance consumes from,
+    changes are written to the database when the instance is saved."""
+
+    #: Set if the list was modified since it was loaded.
+    changed = False
+
+    def __init__(self, queues=()):
+        super(Queues, self).__init__()
+        for queue in queues:
+            self.add(queue)
+        self.changed = False
+
+    def add(self, queue):
+        queue = self._name(queue)
+        if queue and queue not in self:
+            self.append(queue)
+            self.changed = True
+
+    def remove(self, queue):
+        try:
+            list.remove(self, self._name(queue))
+        except ValueError:
+            pass
+        else:
+            self.changed = True
+
+    def __contains__(self, queue):
+        return list.__contains__(self, self._name(queue))
+
+    def as_str(self):
+        return ','.join(self)
+
+    def _name(self, queue):
+        return queue.name if isinstance(queue, Queue) else queue
+
+
 class Instance(models.Model):
     """A celeryd instance."""
     App = App
     Broker = Broker
     Queue = Queue
+    Queues = Queues
     MultiTool = MultiTool
 
     objects = managers.InstanceManager()
-    mutex = Lock()
+
+    #: Locks by instance name, see :attr:`mutex`.
+    _mutexes = {}
 
     app = models.ForeignKey(App)
     name = models.CharField(_(u'name'), max_length=128, unique=True)
-    _queues = models.TextField(_(u'queues'), null=True, blank=True)
     max_concurrency = models.IntegerField(_(u'max concurrency'), default=1)
     min_concurrency = models.IntegerField(_(u'min concurrency'), default=1)
     pool = models.CharField(_(u'pool'), max_length=128, blank=True, null=True)
@@ -160,11 +270,14 @@ class Instance(models.Model):
         return self.name
 
     def __init__(self, *args, **kwargs):
-        app = kwargs.get('app')
-        if app is None:
-            app = kwargs['app'] = self.App._default_manager.get_default()
-        if not isinstance(app, self.App):
-            kwargs['app'] = self.App._default_manager.get(name=app)
+        self._queues = None
+        # rows loaded from the database already have an app.
+        if not args and 'app_id' not in kwargs:
+            app = kwargs.get('app')
+            if app is None:
+                app = kwargs['app'] = self.App._default_manager.get_default()
+            if not isinstance(app, self.App):
+                kwargs['app'] = self.App._default_manager.get(name=app)
         super(Instance, self).__init__(*args, **kwargs)
 
     def as_dict(self):
@@ -180,6 +293,26 @@ class Instance(models.Model):
                 'arguments': self.arguments,
                 'extra_config': self.extra_config}
 
+    def save(self, *args, **kwargs):
+        super(Instance, self).save(*args, **kwargs)
+        if self._queues is not None and self._queues.changed:
+            self._save_queues()
+
+    def delete(self, *args, **kwargs):
+        super(Instance, self).delete(*args, **kwargs)
+        self._mutexes.pop(self.name, None)
+        metrics.broadcast_timeouts.remove(instance=self.name)
+
+    def _save_queues(self):
+        names = list(self._queues)
+        related = self.instance_queues
+        related.exclude(queue__in=names).delete()
+        existing = set(related.values_list('queue', flat=True))
+        for name in names:
+            if name not in existing:
+                related.create(queue=name)
+        self._queues.changed = False
+
     def enable(self):
         """Enables this instance (model-only)."""
         self.is_enabled = True
@@ -295,13 +428,21 @@ class Instance(models.Model):
         return self._query('cancel_consumer', dict(queue=queue), **kwargs)
 
     def getpid(self):
-        """Get the process id for this instance by reading its pid file.
+        """Get the process id for this instance.
+
+        The pid file is only read if the process is not already tracked
+        by the branch (see :mod:`cyme.branch.processes`).
 
         Returns :const:`None` if the pid file does not exist.
 
         """
-        return platforms.PIDFile(
-                self.pidfile.replace('%n', self.name)).read_pid()
+        pid = self.processes.get(self.name)
+        if pid is None:
+            pid = platforms.PIDFile(
+                    self.pidfile.replace('%n', self.name)).read_pid()
+            if pid:
+                self.processes.track(self.name, pid)
+        return pid
 
     def get_arguments(self):
         return (list(self.default_args)
@@ -314,43 +455,35 @@ class Instance(models.Model):
               + shsplit(self.extra_config))
 
     def _action(self, action, multi='celeryd-multi'):
-        """Execute :program:`celeryd-multi` command."""
-        with self.mutex:
-            argv = ([multi, action, '--nosplash', '--suffix=''', '--no-color']
-                  + [self.name]
-                  + self.get_arguments()
-                  + ['--']
-                  + self.get_extra_config())
-            logger.info(' '.join(argv))
-            return self.multi.execute_from_commandline(argv)
-
-    def _query(self, cmd, args={}, **kwargs):
-        """Send remote control command and wait for this instances reply."""
-        timeout = kwargs.setdefault('timeout', 3)
-        name = self.name
-        producer = None
-        if 'connection' not in kwargs:
-            producer = self.broker.producers.acquire(block=True, timeout=3)
-            kwargs.update(connection=producer.connection,
-                          channel=producer.channel)
+        """Start/stop the worker using the branch process registry
+        (see :mod:`cyme.branch.processes`), or by executing
+        a :program:`celeryd-multi` command when not running
+        as a branch."""
         try:
-            try:
-                with Timeout(timeout):
-                    r = celery.control.broadcast(cmd,
-                                                 arguments=args, reply=True,
-                                                 destination=[name], **kwargs)
-            except Timeout:
-                return None
-            return self.my_reply(r)
+            with self.mutex:
+                with metrics.action_seconds.time(action=action):
+                    if self.processes.enabled:
+                        return getattr(self.processes, action)(self)
+                    if action != 'start':
+                        # the process is expected to exit.
+                        self.processes.forget(self.name)
+                    argv = ([multi, action, '--nosplash', '--suffix=''',
+                             '--no-color']
+                          + [self.name]
+                          + self.get_arguments()
+                          + ['--']
+                          + self.get_extra_config())
+                    logger.info(' '.join(argv))
+                    return self.multi.execute_from_commandline(argv)
         finally:
-            if producer is not None:
-                producer.release()
+            if self.pk is None:
+                # stopped after being deleted, the lock is no longer needed.
+                self._mutexes.pop(self.name, None)
 
-    def my_reply(self, replies):
-        name = self.name
-        for reply in replies or []:
-            if name in reply:
-                return reply[name]
+    def _query(self, cmd, args={}, **kwargs):
+        """Send remote control command and wait for this instances reply."""
+        return self.broker.broadcast(cmd, args, destination=[self.name],
+                                     **kwargs).get(self.name)
 
     @cached_property
     def multi(self):
@@ -358,6 +491,17 @@ class Instance(models.Model):
         env.pop('CELERY_LOADER', None)
         return self.MultiTool(env=env)
 
+    @property
+    def mutex(self):
+        """Lock held while starting/stopping this instance, so that
+        actions on the same instance never overlap, while actions on
+        different instances can run at the same time."""
+        return self._mutexes.setdefault(self.name, Lock())
+
+    @property
+    def processes(self):
+        return find_symbol(self, 'cyme.branch.processes.processes')
+
     @property
     def direct_queue(self):
         return 'dq.%s' % (self.name, )
@@ -403,40 +547,16 @@ class Instance(models.Model):
         return self._broker
 
     def _get_queues(self):
-        instance = self
-
-        class Queues(list):
-
-            def add(self, queue):
-                if queue not in self:
-                    self.append(queue)
-                    self._update_obj()
-
-            def remove(self, queue):
-                try:
-                    list.remove(self, queue)
-                except ValueError:
-                    pass
-                self._update_obj()
-
-            def as_str(self):
-
-                def mq(q):
-                    if isinstance(q, Queue):
-                        return q.name
-                    return q
-
-                return ','.join(map(mq, self))
-
-            def _update_obj(self):
-                instance.queues = self.as_str()
-
-        return Queues(q for q in (self._queues or '').split(',') if q)
+        if self._queues is None:
+            self._queues = self.Queues(self.instance_queues.values_list(
+                                    'queue', flat=True) if self.pk else ())
+        return self._queues
 
     def _set_queues(self, queues):
-        if not isinstance(queues, basestring):
-            queues = ','.join(queues)
-        self._queues = queues
+        if isinstance(queues, basestring):
+            queues = queues.split(',')
+        self._queues = self.Queues(queues)
+        self._queues.changed = True
 
     queues = property(_get_queues, _set_queues)
 
@@ -449,3 +569,84 @@ class Instance(models.Model):
         dir = find_symbol(self, 'cyme.conf.CYME_INSTANCE_DIR') / self.name
         dir.mkdir()
         return dir
+
+
+class InstanceQueue(models.Model):
+    """A queue consumed from by an instance.
+
+    Queues are referred to by name, as an instance may be told
+    to consume from a queue before it's declared.
+
+    """
+    instance = models.ForeignKey(Instance, related_name='instance_queues')
+    queue = models.CharField(_(u'queue'), max_length=128, db_index=True)
+
+    class Meta:
+        verbose_name = _(u'instance queue')
+        verbose_name_plural = _(u'instance queues')
+        unique_together = ('instance', 'queue')
+        ordering = ['id']
+
+    def __unicode__(self):
+        return self.queue
+
+
+class RestartState(models.Model):
+    """Restart history of an instance, used by the supervisor
+    to detect instances that keep crashing (see
+    :meth:`cyme.status.Status._do_restart_instance`)."""
+    objects = managers.RestartStateManager()
+
+    name = models.CharField(_(u'instance name'), max_length=128, unique=True)
+    restarts = models.IntegerField(_(u'restarts'), default=0)
+    failures = models.IntegerField(_(u'consecutive failures'), default=0)
+    last_restart = models.DateTimeField(_(u'last restart'),
+                                        null=True, blank=True)
+    backoff_until = models.DateTimeField(_(u'backoff until'),
+                                         null=True, blank=True)
+
+    class Meta:
+        verbose_name = _(u'restart state')
+        verbose_name_plural = _(u'restart states')
+
+    def __unicode__(self):
+        return self.name
+
+    def as_dict(self):
+        """Returns dictionary representation of this restart state that can
+        be Json encoded."""
+        return {'name': self.name,
+                'restarts': self.restarts,
+                'failures': self.failures,
+                'last_restart': isoformat(self.last_restart),
+                'backoff_until': isoformat(self.backoff_until)}
+
+    def record(self, backoff=None, now=None):
+        """Record a restart of the instance.
+
+        :keyword backoff: Seconds to wait before the instance can be
+            restarted again, :const:`None` means it was restarted
+            by request, which also resets the failure count.
+
+        """
+        now = now or datetime.now()
+        self.restarts += 1
+        self.last_restart = now
+        if backoff is None:
+            self.failures = 0
+            self.backoff_until = None
+        else:
+            self.failures += 1
+            self.backoff_until = now + timedelta(seconds=backoff)
+        self.save()
+
+    def reset(self):
+        """Reset failure count, e.g. because the instance is up
+        and running."""
+        self.failures = 0
+        self.backoff_until = None
+        self.save()
+
+    def in_backoff(self, now=None):
+        return bool(self.backoff_until and
+                    (now or datetime.now()) < self.backoff_until)
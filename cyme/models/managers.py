@@ -10,8 +10,11 @@
 
 from __future__ import absolute_import
 
+from datetime import datetime, timedelta
+
 from anyjson import serialize
 from celery import current_app as celery
+from django.db import transaction
 from djcelery.managers import ExtendedManager
 
 from cyme.utils import cached_property, uuid
@@ -66,6 +69,35 @@ class InstanceManager(ExtendedManager):
     def enabled(self):
         return self.filter(is_enabled=True)
 
+    def for_sweep(self, **query):
+        """Returns the instances matching ``query`` as a list, with
+        their app, broker and queues loaded using a fixed number of
+        queries, instead of a few queries for every instance.
+
+        The apps are shared by the instances using them, and the
+        default broker is only looked up once.
+
+        """
+        instances = list(self.filter(**query).select_related(
+                                'app', 'app__broker', '_broker'))
+        apps, default_broker = {}, None
+        for instance in instances:
+            app = apps.setdefault(instance.app_id, instance.app)
+            if app.broker is None and instance._broker is None:
+                if default_broker is None:
+                    default_broker = app.get_broker()
+                app._default_broker = default_broker
+            instance.app = app
+        queues = dict((instance.pk, []) for instance in instances)
+        if queues:
+            for pk, queue in self.InstanceQueues.filter(
+                    instance__in=queues.keys()).values_list('instance',
+                                                            'queue'):
+                queues[pk].append(queue)
+        for instance in instances:
+            instance._queues = self.model.Queues(queues[instance.pk])
+        return instances
+
     def _maybe_queues(self, queues):
         if isinstance(queues, basestring):
             queues = queues.split(',')
@@ -107,23 +139,43 @@ class InstanceManager(ExtendedManager):
     def disable(self, name):
         return self._action(name, 'disable')
 
+    def consuming_from(self, queue, **query):
+        """Instances consuming from ``queue`` (by name)."""
+        return self.filter(instance_queues__queue=queue, **query)
+
+    @transaction.commit_on_success
     def remove_queue_from_instances(self, queue, **query):
-        instances = []
-        for instance in self.filter(**query).iterator():
-            if queue in instance.queues:
-                instance.queues.remove(queue)
-                instance.save()
-                instances.append(instance)
+        """Stop all instances matching ``query`` from consuming
+        from ``queue``, in a single transaction.
+
+        Returns the instances that were consuming from the queue.
+
+        """
+        instances = list(self.consuming_from(queue, **query))
+        if instances:
+            self.InstanceQueues.filter(queue=queue,
+                                       instance__in=instances).delete()
         return instances
 
+    @transaction.commit_on_success
     def add_queue_to_instances(self, queue, **query):
-        instances = []
-        for instance in self.filter(**query).iterator():
-            instance.queues.add(queue)
-            instance.save()
-            instances.append(instance)
+        """Make all instances matching ``query`` consume from
+        ``queue``, in a single transaction.
+
+        Returns the instances that were not already consuming
+        from the queue.
+
+        """
+        has_queue = self.consuming_from(queue).values_list('pk', flat=True)
+        instances = list(self.filter(**query).exclude(pk__in=has_queue))
+        for instance in instances:
+            self.InstanceQueues.create(instance=instance, queue=queue)
         return instances
 
+    @cached_property
+    def InstanceQueues(self):
+        return self.model.instance_queues.related.model._default_manager
+
 
 class QueueManager(ExtendedManager):
 
@@ -138,3 +190,21 @@ class QueueManager(ExtendedManager):
         options = serialize(options) if options else None
         return self._add(name, exchange=exchange, exchange_type=exchange_type,
                                routing_key=routing_key, options=options)
+
+
+class RestartStateManager(ExtendedManager):
+
+    def get_for(self, name):
+        return self.get_or_create(name=name)[0]
+
+    def failing(self):
+        return self.filter(failures__gt=0)
+
+    def evict(self, names, idle_after):
+        """Delete the restart state of instances not in ``names``
+        (list or values queryset), and of instances that have not been
+        restarted in ``idle_after`` seconds."""
+        self.exclude(name__in=names).delete()
+        self.filter(failures=0,
+                    last_restart__lt=datetime.now() - timedelta(
+                        seconds=idle_after)).delete()
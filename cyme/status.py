@@ -2,55 +2,157 @@
 
 from __future__ import absolute_import, with_statement
 
-from collections import defaultdict
+from datetime import datetime, timedelta
 
-from celery.datastructures import TokenBucket
-from celery.utils.timeutils import rate
+from eventlet import GreenPool
 from kombu.common import insured as _insured
 from kombu.log import LogMixin
 from kombu.utils import fxrangemax
 
-from .models import Instance
+from .models import Instance, RestartState
 from .branch.state import state
 
 
+class RollingAborted(Exception):
+    """Raised when a rolling operation is aborted because
+    too many instances failed."""
+
+
 class Status(LogMixin):
+    RollingAborted = RollingAborted
     paused = False
-    restart_max_rate = '100/s'
+
+    #: Time in seconds to wait for replies to the broadcast commands
+    #: used to check many instances at once.
+    ping_timeout = 3.0
+
+    #: Time in seconds to wait before an instance that failed can be
+    #: restarted again, doubled for every consecutive failure
+    #: (up to :attr:`restart_backoff_max`).
+    restart_backoff = 10.0
+    restart_backoff_max = 1800.0
+
+    #: An instance still up this many seconds after it was restarted
+    #: is no longer failing.
+    restart_stable_after = 120.0
+
+    #: Instances failing this many times in a row are disabled.
+    max_restart_failures = 10
 
     def __init__(self):
-        self._buckets = defaultdict(lambda: TokenBucket(
-                                        rate(self.restart_max_rate)))
+        self._failing = None
+
+    def start_all(self, **rolling):
+        """Start all instances that are not running.
+
+        See :meth:`rolling` for the supported keyword arguments.
+
+        """
+        instances = list(self.all_instances())
+        replies = self.inspect_all(instances)
+
+        def start(instance):
+            if not instance.is_enabled:
+                self._do_verify_instance(instance, replies=replies)
+                return True
+            if not self._is_alive(instance, replies):
+                # restarting waits until the instance responds to ping,
+                # so it's not pinged again.
+                return bool(self._do_restart_instance(instance))
+            # alive (maybe found using ping), so verify without pinging.
+            replies.setdefault(instance.name, None)
+            self._do_verify_instance(instance, ratelimit=False,
+                                     replies=replies)
+            return True
+
+        return self.rolling(start, instances, **rolling)
+
+    def restart_all(self, **rolling):
+        """Restart all instances.
 
-    def start_all(self):
-        for instance in self.all_instances():
-            self._do_verify_instance(instance, ratelimit=False)
+        See :meth:`rolling` for the supported keyword arguments.
 
-    def restart_all(self):
-        for instance in self.all_instances():
-            self._do_restart_instance(instance, ratelimit=False)
+        """
+        return self.rolling(self._do_restart_instance,
+                            self.all_instances(), **rolling)
 
-    def shutdown_all(self):
-        for instance in self.all_instances():
+    def shutdown_all(self, **rolling):
+        """Shutdown all instances, waiting for the workers to exit.
+
+        See :meth:`rolling` for the supported keyword arguments.
+
+        """
+        return self.rolling(self._do_stop_verify_instance,
+                            self.all_instances(), **rolling)
+
+    def rolling(self, fun, instances, batch_size=None,
+            max_failure_rate=None, progress=None):
+        """Apply ``fun`` to instances in batches, where the instances
+        in a batch are operated on in parallel.
+
+        :param fun: Function called with an instance as argument.
+            The operation failed if the function returns :const:`False`
+            or raises an exception.
+        :param instances: List of instances.
+        :keyword batch_size: Max number of instances to operate on at
+            the same time (i.e. the max number of unavailable
+            instances).  Default is one at a time.
+        :keyword max_failure_rate: Abort after a batch if the ratio of
+            failed instances (``0.0``-``1.0``) exceeds this value.
+            Default is to never abort.
+        :keyword progress: Callback called after every batch with
+            the arguments ``(done, total, failed)``.
+
+        :raises RollingAborted: if the operation was aborted.
+
+        Returns the list of names of the instances that failed.
+
+        """
+        instances = list(instances)
+        batch_size = batch_size or 1
+        total, failed = len(instances), []
+        pool = GreenPool(batch_size)
+
+        def apply(instance):
+            self.respond_to_ping()
             try:
-                self._do_stop_verify_instance(instance)
+                return fun(instance) is not False
             except Exception, exc:
-                self.error("Couldn't stop instance %s: %r" % (instance.name,
-                                                              exc))
+                self.error('%s: operation failed: %r', instance, exc)
+                return False
+
+        for i in xrange(0, total, batch_size):
+            batch = instances[i:i + batch_size]
+            for instance, ok in zip(batch, pool.imap(apply, batch)):
+                if not ok:
+                    failed.append(instance.name)
+            done = i + len(batch)
+            if progress:
+                progress(done, total, failed)
+            if max_failure_rate is not None and \
+                    float(len(failed)) / done > max_failure_rate:
+                raise self.RollingAborted(
+                    'Aborted after %s of %s instances: %s failed (%s)' % (
+                        done, total, len(failed), ', '.join(failed)))
+        return failed
 
     def all_instances(self):
-        return Instance.objects.all()
+        return Instance.objects.for_sweep()
 
     def insured(self, instance, fun, *args, **kwargs):
         """Ensures any function performing a broadcast command completes
         despite intermittent connection failures."""
+        return self.insured_broker(instance.broker, fun, *args, **kwargs)
+
+    def insured_broker(self, broker, fun, *args, **kwargs):
+        """Like :meth:`insured` but for a :class:`~cyme.models.Broker`."""
 
-        def errback(self, exc, interval):
+        def errback(exc, interval):
             self.error(
                 'Error while trying to broadcast %r: %r\n' % (fun, exc))
             self.pause()
 
-        return _insured(instance.broker.pool, fun, args, kwargs,
+        return _insured(broker.pool, fun, args, kwargs,
                         on_revive=state.on_broker_revive,
                         errback=errback)
 
@@ -59,6 +161,44 @@ class Status(LogMixin):
             fun.im_self, fun(*args, **kwargs))``"""
         return self.insured(fun.im_self, fun, *args, **kwargs)
 
+    def inspect_all(self, instances, timeout=None):
+        """Get the liveness, autoscale settings and active queues
+        of many instances at once, using the ``cyme_inspect``
+        remote control command (see :mod:`cyme.tasks`).
+
+        One broadcast is sent for every broker used by the instances,
+        so the number of round trips does not grow with the number
+        of instances.  Instances known to be offline from the events
+        they send (see :class:`~cyme.branch.monitor.EventMonitor`)
+        are not inspected.
+
+        Returns a ``{name: snapshot}`` mapping of the instances
+        that replied, where ``snapshot`` is a dictionary with
+        the keys ``autoscaler`` and ``active_queues``.
+
+        """
+        return self.broadcast_all('cyme_inspect',
+                [i for i in instances if self._seen_alive(i) is not False],
+                timeout=timeout)
+
+    def broadcast_all(self, cmd, instances, args={}, timeout=None):
+        """Send remote control command to many instances using one
+        broadcast for every broker used by the instances,
+        and return a ``{name: reply}`` mapping of the replies."""
+        timeout = self.ping_timeout if timeout is None else timeout
+        by_broker = {}
+        for instance in instances:
+            broker = instance.broker
+            by_broker.setdefault(broker.url, (broker, []))[1].append(
+                    instance.name)
+        replies = {}
+        for broker, names in by_broker.itervalues():
+            self.respond_to_ping()
+            replies.update(self.insured_broker(broker, broker.broadcast,
+                                               cmd, args, destination=names,
+                                               timeout=timeout))
+        return replies
+
     def pause(self):
         self.paused = True  # only used in supervisor.
 
@@ -85,6 +225,7 @@ class Status(LogMixin):
         else:
             self.info("%s instance doesn't respond after restart" % (
                     instance, ))
+        return is_alive
 
     def _can_restart(self):
         """Returns true if the supervisor is allowed to restart
@@ -92,19 +233,57 @@ class Status(LogMixin):
         return True
 
     def _do_restart_instance(self, instance, ratelimit=False):
-        bucket = self._buckets[instance.restart]
+        """Restart instance.
+
+        If ``ratelimit`` is set the instance is not restarted again
+        until the backoff time has passed, and instances that keep
+        failing are disabled (see :attr:`max_restart_failures`).
+
+        """
+        name = instance.name
+        restarts = self._restart_state(name)
         if ratelimit:
-            if self._can_restart():
-                if bucket.can_consume(1):
-                    self._verify_restart_instance(instance)
-                else:
-                    self.error(
-                        '%s instance.disabled: Restarted too often', instance)
-                    instance.disable()
-                    self._buckets.pop(instance.restart)
+            if not self._can_restart() or restarts.in_backoff():
+                return
+            if restarts.failures >= self.max_restart_failures:
+                self.error(
+                    '%s instance.disabled: Restarted too often', instance)
+                instance.disable()
+                restarts.reset()
+                self.failing.pop(name, None)
+                return
+            restarts.record(backoff=min(
+                    self.restart_backoff * 2 ** restarts.failures,
+                    self.restart_backoff_max))
+            self.failing[name] = restarts
         else:
-            self._buckets.pop(instance.restart, None)
-            self._verify_restart_instance(instance)
+            restarts.record()
+            self.failing.pop(name, None)
+        return self._verify_restart_instance(instance)
+
+    def _restart_state(self, name):
+        try:
+            return self.failing[name]
+        except KeyError:
+            return RestartState._default_manager.get_for(name)
+
+    def _instance_is_up(self, instance):
+        """Reset the failure count of a restarted instance
+        that stayed up."""
+        restarts = self.failing.get(instance.name)
+        if restarts is not None and datetime.now() - restarts.last_restart \
+                > timedelta(seconds=self.restart_stable_after):
+            restarts.reset()
+            self.failing.pop(instance.name, None)
+
+    @property
+    def failing(self):
+        """Restart state of the instances that recently failed,
+        by instance name."""
+        if self._failing is None:
+            self._failing = dict((restarts.name, restarts) for restarts in
+                                    RestartState._default_manager.failing())
+        return self._failing
 
     def _do_stop_instance(self, instance):
         self.info('%s instance.shutdown' % (instance, ))
@@ -114,25 +293,73 @@ class Status(LogMixin):
         self.info('%s instance.shutdown' % (instance, ))
         instance.stop_verify()
 
-    def _do_verify_instance(self, instance, ratelimit=False):
+    def _do_verify_instance(self, instance, ratelimit=False, replies=None):
+        """Verify that the instance is in the state specified
+        by the model.
+
+        The instance is inspected using a single round trip
+        (see :meth:`inspect_all`), unless the snapshot is already
+        present in ``replies``.
+
+        Returns :const:`True` if the instance was found
+        to be consistent, :const:`False` if it had to be restarted or
+        stopped, and :const:`None` if the verification was skipped.
+
+        """
         if not self.paused:
+            if replies is None:
+                replies = self.inspect_all([instance])
             if instance.is_enabled and instance.pk:
-                if not self.ib(instance.alive):
-                    self._do_restart_instance(instance, ratelimit=ratelimit)
-                self._verify_instance_processes(instance)
-                self._verify_instance_queues(instance)
+                snapshot = replies.get(instance.name)
+                is_alive = self._is_alive(instance, replies)
+                if is_alive:
+                    self._instance_is_up(instance)
+                else:
+                    if not self._do_restart_instance(instance,
+                                                     ratelimit=ratelimit):
+                        # not up (yet), nothing more to verify.
+                        return False
+                    snapshot = None
+                self._verify_instance_processes(instance, snapshot)
+                self._verify_instance_queues(instance, snapshot)
+                return is_alive
             else:
-                if self.ib(instance.alive):
+                if self._is_alive(instance, replies):
                     self._do_stop_instance(instance)
+                    return False
+                return True
+
+    def _is_alive(self, instance, replies=None):
+        """Check if the instance is alive, using the events sent by the
+        instance, or the replies collected by :meth:`inspect_all`
+        if available.
+
+        Instances missing from the replies are pinged directly,
+        so that a lost reply does not lead to an unnecessary restart.
 
-    def _verify_instance_queues(self, instance):
+        """
+        seen_alive = self._seen_alive(instance)
+        if seen_alive is not None:
+            return seen_alive and instance.responds_to_signal()
+        if replies is not None and instance.name in replies:
+            return instance.responds_to_signal()
+        return self.ib(instance.alive)
+
+    def _seen_alive(self, instance):
+        if state.monitor is not None:
+            return state.monitor.is_alive(instance.name)
+
+    def _verify_instance_queues(self, instance, snapshot=None):
         """Verify that the queues the instance is consuming from matches
         the queues listed in the model."""
         queues = set(instance.queues)
-        reply = self.ib(instance.consuming_from)
-        if reply is None:
-            return
-        consuming_from = set(reply.keys())
+        try:
+            consuming_from = set(q['name'] for q in snapshot['active_queues'])
+        except (TypeError, KeyError):
+            reply = self.ib(instance.consuming_from)
+            if reply is None:
+                return
+            consuming_from = set(reply.keys())
 
         for queue in consuming_from ^ queues:
             if queue in queues:
@@ -145,13 +372,18 @@ class Status(LogMixin):
                     '%s: instance.cancel_consume: %s' % (instance, queue))
                 self.ib(instance.cancel_queue, queue)
 
-    def _verify_instance_processes(self, instance):
+    def _verify_instance_processes(self, instance, snapshot=None):
         """Verify that the max/min concurrency settings of the
         instance matches that which is specified in the model."""
         max, min = instance.max_concurrency, instance.min_concurrency
         try:
-            current = self.insured(instance, instance.stats)['autoscaler']
+            current = snapshot['autoscaler']
         except (TypeError, KeyError):
+            try:
+                current = self.insured(instance, instance.stats)['autoscaler']
+            except (TypeError, KeyError):
+                return
+        if not current:
             return
         if max != current['max'] or min != current['min']:
             self.info('%s: instance.set_autoscale max=%r min=%r' % (
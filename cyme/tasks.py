@@ -6,10 +6,14 @@
   present in the query string of the request, nor in the data returned
   in the response.
 
+- This module is imported by all instances, so it also registers
+  the ``cyme_inspect`` remote control command used by the supervisor.
+
 """
 from __future__ import absolute_import
 
 from celery.task import task
+from celery.worker.control import Panel
 from requests import request
 
 from . import __version__
@@ -32,3 +36,13 @@ def webhook(url, method='GET', params={}, data={}, headers=None, **kwargs):
     headers = {} if headers is None else headers
     return response_to_dict(request(method, url, params=params, data=data,
                                     headers=dict(headers, **DEFAULT_HEADERS)))
+
+
+@Panel.register
+def cyme_inspect(panel, **kwargs):
+    """Remote control command returning the autoscale settings and
+    active queues of the worker, so the supervisor can verify
+    an instance using a single round trip."""
+    autoscaler = panel.consumer.controller.autoscaler
+    return {'autoscaler': autoscaler.info() if autoscaler else {},
+            'active_queues': Panel.data['active_queues'](panel)}
@@ -0,0 +1,105 @@
+from __future__ import absolute_import
+
+from time import time
+
+from celery.tests.utils import unittest
+from kombu import BrokerConnection, Exchange, Producer, Queue
+from kombu.utils import uuid
+from mock import Mock
+
+from cyme.utils.actors import AwareActorMixin, RoutingState, collect_replies
+
+
+def meta(instances=(), queues=()):
+    return {'Instance': {'instances': list(instances)},
+            'Queue': {'queues': list(queues)},
+            'App': {}}
+
+
+class test_RoutingState(unittest.TestCase):
+
+    def setUp(self):
+        self.state = RoutingState(Mock(interval=10))
+
+    def test_route(self):
+        self.state.update_meta_for('A', meta(['i1', 'i2'], ['q1']))
+        self.state.update_meta_for('B', meta(['i3']))
+        self.assertEqual(self.state.route('Instance', 'instances', 'i1'), 'A')
+        self.assertEqual(self.state.route('Instance', 'instances', 'i3'), 'B')
+        self.assertEqual(self.state.route('Queue', 'queues', 'q1'), 'A')
+        with self.assertRaises(KeyError):
+            self.state.route('Instance', 'instances', 'q1')
+
+    def test_updated(self):
+        self.state.update_meta_for('A', meta(['i1', 'i2']))
+        self.state.update_meta_for('A', meta(['i2', 'i4']))
+        with self.assertRaises(KeyError):
+            self.state.route('Instance', 'instances', 'i1')
+        self.assertEqual(self.state.route('Instance', 'instances', 'i4'), 'A')
+
+        # moved to another agent, before A announced it's gone.
+        self.state.update_meta_for('B', meta(['i2']))
+        self.state.update_meta_for('A', meta(['i4']))
+        self.assertEqual(self.state.route('Instance', 'instances', 'i2'), 'B')
+
+    def test_agent_removed(self):
+        self.state.update_agent('A', meta=meta(['i1']), ts=time(),
+                                actors=['Instance'])
+        self.state.update_agent('B', meta=meta(['i2']), ts=time(),
+                                actors=['Instance'])
+        self.state.when_offline(agent='A')
+        with self.assertRaises(KeyError):
+            self.state.route('Instance', 'instances', 'i1')
+        self.assertEqual(self.state.can('Instance'), set(['B']))
+        self.state._agents['B']['ts'] = 1
+        self.state.expire_agents()  # B's heartbeat expired.
+        with self.assertRaises(KeyError):
+            self.state.route('Instance', 'instances', 'i2')
+        self.assertEqual(self.state.can('Instance'), set())
+
+
+class test_AwareActorMixin(unittest.TestCase):
+
+    def test_lookup(self):
+        actor = AwareActorMixin()
+        actor.name, actor.meta_lookup_section = 'Instance', 'instances'
+        actor.agent = Mock()
+        actor.agent.presence.state = RoutingState(Mock(interval=10))
+        actor.agent.presence.state.update_meta_for('A', meta(['i1']))
+        self.assertEqual(actor.lookup('i1'), 'A')
+        with self.assertRaises(KeyError):
+            actor.lookup('i2')
+        actor.agent = None
+        self.assertIsNone(actor.lookup('i1'))
+
+
+class test_collect_replies(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = BrokerConnection('memory://')
+        self.conn.transport.polling_interval = 0.05
+        self.channel = self.conn.default_channel
+        ticket = uuid()
+        self.queue = Queue(ticket, Exchange('reply'), ticket)(self.channel)
+        self.queue.declare()
+        self.producer = Producer(self.channel, self.queue.exchange,
+                                 routing_key=ticket)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_limit(self):
+        for i in range(3):
+            self.producer.publish({'ok': i})
+        replies = collect_replies(self.conn, self.channel, self.queue,
+                                  limit=2, timeout=1)
+        self.assertEqual(replies.next(), {'ok': 0})
+        self.assertEqual(list(replies), [{'ok': 1}])
+
+    def test_timeout(self):
+        self.producer.publish({'ok': 1})
+        time_start = time()
+        self.assertEqual(list(collect_replies(self.conn, self.channel,
+                                              self.queue, limit=3,
+                                              timeout=0.3)), [{'ok': 1}])
+        self.assertLess(time() - time_start, 1)
@@ -0,0 +1,44 @@
+from __future__ import absolute_import
+
+from celery.tests.utils import unittest
+
+from cyme.branch import metrics
+from cyme.brokers import BrokerRegistry
+from cyme.models import Broker
+
+
+class test_BrokerRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.brokers = BrokerRegistry()
+
+    def tearDown(self):
+        for broker in self.brokers._brokers.itervalues():
+            broker.close()
+
+    def test_shared_by_url(self):
+        a = self.brokers['memory://a']
+        self.assertIs(self.brokers['memory://a'], a)
+        self.assertIsNot(self.brokers['memory://b'], a)
+        self.assertIs(a.producers.connections, a.pool)
+
+    def test_models_share_connections(self):
+        b1, b2 = Broker(url='memory://'), Broker(url='memory://')
+        self.assertIs(b1.connection, b2.connection)
+        self.assertIs(b1.producers, b2.producers)
+
+    def test_limit(self):
+        self.brokers.set_limit('memory://a', 3)
+        broker = self.brokers['memory://a']
+        self.assertEqual(broker.pool.limit, 3)
+        self.assertEqual(
+            metrics.broker_pool_limit.get(broker=broker.name), 3)
+
+        producer = broker.producers.acquire(block=True)
+        self.assertEqual(
+            metrics.producers_in_use.get(broker=broker.name), 1)
+        producer.release()
+        self.assertEqual(
+            metrics.producers_in_use.get(broker=broker.name), 0)
+        self.assertTrue(
+            metrics.producer_wait_seconds.get(broker=broker.name))
@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+
+from time import time
+
+from celery.tests.utils import unittest
+from mock import Mock
+
+from cyme.branch.controller import Controller
+from cyme.branch.fleet import FleetView, fleet
+from cyme.branch.placement import placement
+from cyme.utils.actors import RoutingState
+
+
+def meta(instances={}, queues=()):
+    return {'Instance': {'instances': instances.keys(),
+                         'apps': instances},
+            'Queue': {'queues': list(queues)}}
+
+
+class test_FleetView(unittest.TestCase):
+
+    def setUp(self):
+        self.fleet = FleetView()
+        self.state = RoutingState(Mock(interval=10))
+        self.state.listeners.append(self.fleet)
+        self.fleet.state = self.state
+        self.now = time()
+
+    def announce(self, agent, ts, meta):
+        self.state.update_agent(agent, ts=self.now + ts, meta=meta,
+                                actors=['Instance', 'Queue'])
+
+    def test_merged(self):
+        self.announce('A', 1, meta({'i1': 'foo'}, ['q1']))
+        self.announce('B', 1, meta({'i2': 'bar', 'i3': 'foo'}, ['q1', 'q2']))
+        self.assertEqual(self.fleet.instances(), ['i1', 'i2', 'i3'])
+        self.assertEqual(self.fleet.instances(app='foo'), ['i1', 'i3'])
+        self.assertEqual(self.fleet.queues(), ['q1', 'q2'])
+
+        # instance removed from A.
+        self.announce('A', 2, meta({}, ['q1']))
+        self.assertEqual(self.fleet.instances(app='foo'), ['i3'])
+
+        # stale announcements are ignored.
+        self.announce('A', 1, meta({'i1': 'foo'}))
+        self.assertEqual(self.fleet.instances(app='foo'), ['i3'])
+
+        self.state.when_offline(agent='B')
+        self.assertEqual(self.fleet.instances(), [])
+        self.assertEqual(self.fleet.queues(), ['q1'])
+
+    def test_not_ready(self):
+        self.fleet.actors = Mock()
+        self.fleet.actors.instances.all.return_value = ['i1']
+        self.fleet.actors.queues.all.return_value = ['q1']
+        self.assertFalse(self.fleet.ready)
+        self.assertEqual(self.fleet.instances(app='foo'), ['i1'])
+        self.fleet.actors.instances.all.assert_called_with(app='foo')
+        self.assertEqual(self.fleet.queues(), ['q1'])
+
+        # agents without app information are not branches.
+        self.fleet.update('A', {'Instance': {'instances': ['i2']}}, 1)
+        self.assertFalse(self.fleet.ready)
+
+    def test_ready_when_all_branches_reported(self):
+        self.state.update_agent('A', ts=self.now, actors=['Instance'])
+        self.announce('B', 0, meta({'i1': 'foo'}))
+        # A can serve instances, but hasn't announced them yet.
+        self.assertFalse(self.fleet.ready)
+        self.announce('A', 1, meta({'i2': 'foo'}))
+        self.assertTrue(self.fleet.ready)
+
+        # expired branches are forgotten.
+        self.state._agents['A']['ts'] = self.now - 60
+        self.assertTrue(self.fleet.ready)
+        self.assertEqual(self.fleet.instances(), ['i1'])
+
+    def test_pending_changes(self):
+        self.announce('A', 1, meta({'i1': 'foo'}))
+        self.fleet.added('i2', 'foo')
+        self.fleet.removed('i1')
+        self.assertEqual(self.fleet.instances(app='foo'), ['i2'])
+
+        # announced by the branches.
+        self.announce('A', 2, meta({'i2': 'foo'}))
+        self.assertFalse(self.fleet._pending)
+        self.assertEqual(self.fleet.instances(), ['i2'])
+
+        self.fleet.added('i3')
+        self.fleet.pending_expire = -1
+        self.fleet.added('i4')
+        self.assertEqual(self.fleet.instances(), ['i2', 'i3'])
+
+
+class test_Controller_listeners(unittest.TestCase):
+
+    def controller(self):
+        c = Controller.__new__(Controller)
+        c.presence = Mock()
+        c.presence.state = RoutingState(Mock(interval=10))
+        return c
+
+    def test_shared_by_controllers(self):
+        c1, c2 = self.controller(), self.controller()
+        c1._start_listening()
+        c2._start_listening()
+        self.assertIs(fleet.state, c1.presence.state)
+        self.assertIn(fleet, c1.presence.state.listeners)
+        self.assertNotIn(fleet, c2.presence.state.listeners)
+
+        # the remaining controller takes over.
+        c1._stop_listening()
+        self.assertIs(fleet.state, c2.presence.state)
+        self.assertNotIn(placement, c1.presence.state.listeners)
+        self.assertIn(placement, c2.presence.state.listeners)
+
+        c2._stop_listening()
+        self.assertIsNone(fleet.state)
+        self.assertFalse(c2.presence.state.listeners)
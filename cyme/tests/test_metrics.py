@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+
+from celery import current_app as celery
+from celery.tests.utils import unittest
+from mock import Mock
+
+from cyme.branch import metrics
+from cyme.models import Broker
+
+
+class test_Registry(unittest.TestCase):
+
+    def test_render(self):
+        registry = metrics.Registry()
+        c = registry.counter('c_total', 'Counter.')
+        h = registry.histogram('h_seconds', 'Histogram.', buckets=(1, 5))
+        c.inc(instance='a"b')
+        c.inc(2, instance='a"b')
+        h.observe(0.5, action='ping')
+        h.observe(3, action='ping')
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP c_total Counter.',
+            '# TYPE c_total counter',
+            'c_total{instance="a\\"b"} 3.0',
+            '# HELP h_seconds Histogram.',
+            '# TYPE h_seconds histogram',
+            'h_seconds_bucket{action="ping",le="1.0"} 1.0',
+            'h_seconds_bucket{action="ping",le="5.0"} 2.0',
+            'h_seconds_bucket{action="ping",le="+Inf"} 2.0',
+            'h_seconds_sum{action="ping"} 3.5',
+            'h_seconds_count{action="ping"} 2.0'])
+        self.assertEqual(h.get(action='ping'), 2)
+
+    def test_remove(self):
+        c = metrics.Registry().counter('c_total', 'Counter.')
+        c.inc(instance='a', command='ping')
+        c.inc(instance='a', command='stats')
+        c.inc(instance='b', command='ping')
+        c.remove(instance='a')
+        self.assertEqual([labels for _, labels, _ in c.samples()],
+                         [(('command', 'ping'), ('instance', 'b'))])
+
+    def test_broadcast_timeouts(self):
+        broker = Broker(url='memory://')
+        before = metrics.broadcast_timeouts.get(instance='b', command='ping')
+        prev, celery.control.broadcast = celery.control.broadcast, Mock()
+        try:
+            celery.control.broadcast.side_effect = \
+                    lambda *a, **kw: kw['callback']({'a': 'pong'})
+            self.assertEqual(broker.broadcast('ping', destination=['a', 'b'],
+                                              connection=Mock()),
+                             {'a': 'pong'})
+        finally:
+            celery.control.broadcast = prev
+        self.assertEqual(
+            metrics.broadcast_timeouts.get(instance='b', command='ping'),
+            before + 1)
+        self.assertFalse(
+            metrics.broadcast_timeouts.get(instance='a', command='ping'))
@@ -1,9 +1,16 @@
 from __future__ import absolute_import
 
+from datetime import datetime, timedelta
+
 from celery.tests.utils import unittest
-from mock import Mock
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from mock import Mock, patch
 
-from cyme.models import Instance, Queue
+from cyme.bin.base import Env
+from cyme.branch import managers, metrics
+from cyme.management import migrate_instance_queues
+from cyme.models import App, Instance, Queue, RestartState
 
 
 class test_Queue(unittest.TestCase):
@@ -21,6 +28,140 @@ class test_Queue(unittest.TestCase):
         self.assertEqual(x[0], q1)
 
 
+class test_InstanceQueue(unittest.TestCase):
+
+    def tearDown(self):
+        Instance.objects.all().delete()
+
+    def reload(self, instance):
+        return Instance.objects.get(pk=instance.pk)
+
+    def test_queues(self):
+        instance = Instance.objects.create(name='q1')
+        instance.queues = 'foo,bar'
+        instance.save()
+        instance = self.reload(instance)
+        self.assertEqual(instance.queues, ['foo', 'bar'])
+        instance.queues.add(Queue(name='baz'))
+        instance.queues.remove('foo')
+        instance.save()
+        self.assertEqual(self.reload(instance).queues, ['bar', 'baz'])
+
+    def test_add_remove_queue(self):
+        a, b, c = [Instance.objects.create(name=name)
+                        for name in ('qa', 'qb', 'qc')]
+        added = Instance.objects.add_queue_to_instances('foo',
+                                                        name__in=['qa', 'qb'])
+        self.assertItemsEqual([i.name for i in added], ['qa', 'qb'])
+        self.assertFalse(
+            Instance.objects.add_queue_to_instances('foo', name='qa'))
+        self.assertItemsEqual(
+            Instance.objects.consuming_from('foo').values_list('name',
+                                                               flat=True),
+            ['qa', 'qb'])
+        self.assertEqual(self.reload(a).queues, ['foo'])
+
+        sup, managers.sup = managers.sup, Mock()
+        try:
+            removed = managers.local_instances.remove_queue('foo')
+            self.assertItemsEqual([i.name for i in removed], ['qa', 'qb'])
+            managers.sup.verify.assert_called_once_with(removed)
+        finally:
+            managers.sup = sup
+        self.assertFalse(Instance.objects.consuming_from('foo'))
+        self.assertEqual(self.reload(b).queues, [])
+
+    def test_migrate_legacy_column(self):
+        instance = Instance.objects.create(name='legacy')
+        table = Instance._meta.db_table
+        cursor = connection.cursor()
+        columns = [c[0] for c in
+            connection.introspection.get_table_description(cursor, table)]
+        if '_queues' not in columns:
+            cursor.execute('ALTER TABLE %s ADD COLUMN _queues text' % table)
+        cursor.execute('UPDATE %s SET _queues = %%s WHERE id = %%s' % table,
+                       ['foo,bar', instance.pk])
+        migrate_instance_queues(sender=None)
+        self.assertEqual(self.reload(instance).queues, ['foo', 'bar'])
+        # only migrated once.
+        migrate_instance_queues(sender=None)
+        self.assertEqual(self.reload(instance).queues, ['foo', 'bar'])
+
+
+class test_upgrade(TransactionTestCase):
+
+    def add_legacy_column(self, cursor, table):
+        columns = [c[0] for c in
+            connection.introspection.get_table_description(cursor, table)]
+        if '_queues' not in columns:
+            cursor.execute('ALTER TABLE %s ADD COLUMN _queues text' % table)
+
+    @patch('cyme.bin.base.Path')
+    def test_syncdb_existing_database(self, Path):
+        # the database file exists, and was created by an earlier
+        # version, without the instance queues table.
+        Path.return_value.absolute.return_value.exists.return_value = True
+        instance = Instance.objects.create(name='upgraded')
+        cursor = connection.cursor()
+        self.add_legacy_column(cursor, Instance._meta.db_table)
+        cursor.execute('UPDATE %s SET _queues = %%s WHERE id = %%s' % (
+            Instance._meta.db_table, ), ['foo,bar', instance.pk])
+        cursor.execute('DROP TABLE %s' % (
+            Instance.instance_queues.related.model._meta.db_table, ))
+
+        Env().syncdb()
+        self.assertEqual(Instance.objects.get(name='upgraded').queues,
+                         ['foo', 'bar'])
+
+    @patch('cyme.bin.base.Path')
+    def test_syncdb_creates_restart_state(self, Path):
+        Path.return_value.absolute.return_value.exists.return_value = True
+        connection.cursor().execute('DROP TABLE %s' % (
+            RestartState._meta.db_table, ))
+
+        Env().syncdb()
+        RestartState.objects.get_for('upgraded').record(backoff=10)
+        self.assertEqual(RestartState.objects.get_for('upgraded').failures, 1)
+
+
+class test_InstanceManager(TestCase):
+
+    def test_for_sweep_query_count(self):
+        app = App.objects.create(name='sweep')
+        for i in xrange(10):
+            Instance.objects.create(name='sweep%s' % i, app=app,
+                                    queues=['foo', 'bar%s' % i])
+
+        # instances with app and broker, the default broker,
+        # and the queues of all instances.
+        with self.assertNumQueries(3):
+            instances = Instance.objects.for_sweep(app=app)
+            self.assertEqual(len(instances), 10)
+            for instance in instances:
+                self.assertTrue(instance.broker.url)
+                self.assertEqual(instance.queues[0], 'foo')
+                instance.get_extra_config()
+
+
+class test_RestartState(unittest.TestCase):
+
+    def tearDown(self):
+        RestartState.objects.all().delete()
+
+    def test_evict(self):
+        week_ago = datetime.now() - timedelta(days=7)
+        RestartState.objects.create(name='gone', last_restart=datetime.now())
+        RestartState.objects.create(name='idle', last_restart=week_ago)
+        RestartState.objects.create(name='failing', failures=3,
+                                    last_restart=week_ago)
+        RestartState.objects.create(name='recent',
+                                    last_restart=datetime.now())
+        RestartState.objects.evict(['idle', 'failing', 'recent'], 3600)
+        self.assertItemsEqual(
+            RestartState.objects.values_list('name', flat=True),
+            ['failing', 'recent'])
+
+
 class test_Instance(unittest.TestCase):
 
     def setUp(self):
@@ -36,6 +177,36 @@ class test_Instance(unittest.TestCase):
     def test__unicode__(self):
         self.assertTrue(unicode(Instance(name='foo')))
 
+    def test_mutex_per_instance(self):
+        a1, a2 = Instance(name='a'), Instance(name='a')
+        b = Instance(name='b')
+        self.assertIs(a1.mutex, a2.mutex)
+        self.assertIsNot(a1.mutex, b.mutex)
+        with a1.mutex:
+            self.assertTrue(b.mutex.acquire(False))
+            b.mutex.release()
+            self.assertFalse(a2.mutex.acquire(False))
+
+    def test_mutex_evicted_when_deleted(self):
+        instance = Instance.objects.create(name='evicted',
+                                           app=App.objects.get_default())
+        instance.get_arguments = instance.get_extra_config = Mock()
+        instance.get_arguments.return_value = []
+        instance.mutex
+        instance.delete()
+        self.assertNotIn('evicted', Instance._mutexes)
+        # the worker is stopped after the instance is deleted.
+        instance.stop()
+        self.assertNotIn('evicted', Instance._mutexes)
+
+    def test_broadcast_timeouts_removed_when_deleted(self):
+        instance = Instance.objects.create(name='timedout',
+                                           app=App.objects.get_default())
+        metrics.broadcast_timeouts.inc(instance='timedout', command='ping')
+        instance.delete()
+        self.assertFalse(metrics.broadcast_timeouts.get(instance='timedout',
+                                                        command='ping'))
+
     def test_add(self):
         n1 = Instance.objects.add()
         self.assertTrue(n1.name)
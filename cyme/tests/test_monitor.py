@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+
+from celery.tests.utils import unittest
+from eventlet import sleep
+from mock import Mock
+
+from cyme.branch.monitor import EventMonitor
+from cyme.branch.thread import gThread
+
+
+class test_EventMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self._ginit, gThread.__init__ = gThread.__init__, Mock()
+        self.monitor = EventMonitor(set_as_current=False)
+        self.monitor.is_instance = lambda hostname: hostname in 'abc'
+        self.monitor.on_worker_gone = Mock()
+
+    def tearDown(self):
+        gThread.__init__ = self._ginit
+
+    def test_is_alive(self):
+        self.assertIsNone(self.monitor.is_alive('a'))
+        self.monitor.on_worker_event({'hostname': 'a'})
+        self.assertTrue(self.monitor.is_alive('a'))
+        self.assertIsNone(self.monitor.is_alive('a',
+                now=self.monitor.last_seen['a'][0] + 60))
+
+    def test_offline_expires(self):
+        self.monitor.on_worker_offline({'hostname': 'a'})
+        self.monitor.on_worker_gone.assert_called_with('a')
+        self.assertIs(self.monitor.is_alive('a'), False)
+        seen = self.monitor.last_seen['a'][0]
+        self.assertIsNone(self.monitor.is_alive('a', now=seen + 60))
+
+    def test_check_expired(self):
+        self.monitor.on_worker_event({'hostname': 'a'})
+        self.monitor.on_worker_event({'hostname': 'b'})
+        self.monitor.last_seen['a'] = (0, True)
+        self.monitor._reported.add('a')  # done by on_worker_gone.
+        self.monitor.last_seen['b'] = (0, True)
+        self.monitor.check_expired()
+        # a was reported before, and is no longer tracked.
+        self.monitor.on_worker_gone.assert_called_once_with('b')
+        self.assertNotIn('a', self.monitor.last_seen)
+        self.assertIn('b', self.monitor.last_seen)
+
+    def test_ignores_other_workers(self):
+        self.monitor.on_worker_event({'hostname': 'celery.example.com'})
+        self.monitor.on_worker_offline({'hostname': 'celery.example.com'})
+        self.assertFalse(self.monitor.last_seen)
+        self.assertFalse(self.monitor.on_worker_gone.called)
+
+    def test_expect_online(self):
+        callback = Mock()
+        self.monitor.expect_online('a', 10, callback)
+        self.monitor.on_worker_online({'hostname': 'b'})
+        self.assertFalse(callback.called)
+        # heartbeats may be sent by the old worker during a restart.
+        self.monitor.on_worker_event({'hostname': 'a'})
+        self.assertFalse(callback.called)
+        self.monitor.on_worker_online({'hostname': 'a'})
+        callback.assert_called_once_with('a', True)
+        self.monitor.on_worker_online({'hostname': 'a'})
+        self.assertEqual(callback.call_count, 1)
+        self.assertFalse(self.monitor._waiters)
+
+    def test_expect_online_timeout(self):
+        callback = Mock()
+        self.monitor.expect_online('a', 0.01, callback)
+        sleep(0.05)
+        callback.assert_called_once_with('a', False)
+        self.assertFalse(self.monitor._waiters)
+
+    def test_consume_restarted_on_error(self):
+        self.monitor.reconnect_interval = 0
+        self.monitor.error = Mock()
+        broker = Mock()
+        broker.connection.clone.return_value.connection_errors = ()
+        broker.connection.clone.return_value.channel_errors = ()
+        calls = []
+
+        def drain_events(receiver):
+            calls.append(receiver)
+            if len(calls) > 1:
+                self.monitor.should_stop = True
+            raise KeyError('bad event')
+        self.monitor._drain_events = drain_events
+        self.monitor._consume(broker)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.monitor.error.call_count, 2)
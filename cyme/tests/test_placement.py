@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+from __future__ import with_statement
+
+from tempfile import NamedTemporaryFile
+
+from celery.tests.utils import unittest
+from mock import Mock
+
+from cyme.branch import metrics
+from cyme.branch.placement import Placement, default_score, local_metrics
+from cyme.utils.actors import RoutingState
+
+
+def load(load_average=0.0, cpus=1, free_memory=None, total_memory=None,
+        disk_use=10, instances=0):
+    return {'load_average': (load_average, 0.0, 0.0), 'cpus': cpus,
+            'free_memory': free_memory, 'total_memory': total_memory,
+            'disk_use': disk_use, 'instances': instances}
+
+
+class test_Placement(unittest.TestCase):
+
+    def setUp(self):
+        self.placement = Placement(max_disk_use=90)
+        self.state = RoutingState(Mock(interval=10))
+        self.state.listeners.append(self.placement)
+
+    def announce(self, agent, load):
+        self.state.update_agent(agent, meta={'Branch': {'this': [agent],
+                                                        'load': load}})
+
+    def test_choose(self):
+        self.assertIsNone(self.placement.choose())
+        self.announce('A', load(load_average=2.0, cpus=4))
+        self.announce('B', load(load_average=1.0, cpus=1))
+        self.announce('C', load(load_average=0.1, disk_use=95))
+        self.assertEqual(self.placement.choose('foo'), 'A')
+
+        self.state.when_offline(agent='A')
+        self.assertEqual(self.placement.choose('foo'), 'B')
+
+    def test_stale_loads_ignored(self):
+        self.placement.expire_after = 25.0
+        self.placement.update('A', {'Branch': {'load': load()}}, 100.0)
+        self.placement.update('B', {'Branch': {'load': load(1.0)}}, 120.0)
+        self.assertEqual(self.placement.choose(now=110.0), 'A')
+        # A has not been heard from in time, and may be gone.
+        self.assertEqual(self.placement.choose(now=130.0), 'B')
+        self.assertNotIn('A', self.placement._branches)
+        self.assertIsNone(self.placement.choose(now=150.0))
+
+    def test_adds_between_heartbeats_spread(self):
+        for agent in 'A', 'B', 'C':
+            self.announce(agent, load(load_average=0.5, cpus=2))
+        chosen = [self.placement.choose() for i in xrange(6)]
+        self.assertItemsEqual(chosen, ['A', 'A', 'B', 'B', 'C', 'C'])
+        # the next announcement replaces the estimate.
+        self.announce('A', load(load_average=0.5, cpus=2))
+        self.assertEqual(self.placement.choose(), 'A')
+
+    def test_one_load_per_branch(self):
+        # both controllers of a branch announce the same load.
+        for agent in 'A.1', 'A.2', 'B.1', 'B.2':
+            self.announce(agent, load(load_average=0.5, cpus=2))
+        chosen = [self.placement.choose().partition('.')[0]
+                    for i in xrange(4)]
+        self.assertItemsEqual(chosen, ['A', 'A', 'B', 'B'])
+        self.assertIn(self.placement.choose(), ('A.2', 'B.2'))
+
+    def test_custom_score(self):
+        self.placement = Placement(max_disk_use=90,
+                score=lambda load, app=None: -load['instances'])
+        self.placement.update('A', {'Branch': {'load': load(instances=1)}})
+        self.placement.update('B', {'Branch': {'load': load(instances=3)}})
+        self.assertEqual(self.placement.choose(), 'B')
+
+    def test_default_score(self):
+        self.assertEqual(default_score(load(load_average=2.0, cpus=4)), 0.5)
+        self.assertEqual(default_score(load(free_memory=250,
+                                            total_memory=1000,
+                                            instances=50)), 1.25)
+
+
+class test_metrics(unittest.TestCase):
+
+    def test_memory(self):
+        with NamedTemporaryFile() as fh:
+            fh.write('MemTotal:  1000 kB\nMemFree:  100 kB\n'
+                     'Buffers:  50 kB\nCached:  50 kB\n')
+            fh.flush()
+            self.assertEqual(metrics.memory(fh.name), (1000, 200))
+        self.assertEqual(metrics.memory('/does/not/exist'), (None, None))
+
+    def test_local_metrics(self):
+        load = local_metrics()
+        self.assertGreaterEqual(load['cpus'], 1)
+        self.assertEqual(len(load['load_average']), 3)
@@ -0,0 +1,227 @@
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os
+import shutil
+import signal
+import sys
+
+from tempfile import NamedTemporaryFile, mkdtemp
+
+from celery.tests.utils import unittest
+from eventlet import sleep, spawn
+from mock import Mock
+
+from cyme.branch.processes import ProcessRegistry, is_worker_of, \
+                                  pid_exists, spawn_worker, worker_argv
+from cyme.branch.state import state
+
+
+class test_worker_argv(unittest.TestCase):
+
+    def test_detach_options(self):
+        instance = Mock()
+        instance.name = 'foo'
+        instance.get_arguments.return_value = [
+            "--broker='amqp://'", "--workdir='/var/cyme/foo'",
+            '-c 3', '--umask', '18']
+        instance.get_extra_config.return_value = ['celery.acks_late=yes']
+        argv, options = worker_argv(instance)
+        self.assertEqual(argv, [sys.executable, '-m', 'celery.bin.celeryd',
+                                '--hostname=foo', '--broker=amqp://',
+                                '-c', '3', '--', 'celery.acks_late=yes'])
+        self.assertEqual(options, {'workdir': '/var/cyme/foo',
+                                   'umask': '18'})
+
+
+def mock_instance(name, pidfile=None):
+    instance = Mock()
+    instance.name = name
+    instance.pidfile = pidfile
+    instance.responds_to_signal.return_value = False
+    return instance
+
+
+class test_is_worker_of(unittest.TestCase):
+
+    def test_cmdline(self):
+        for argv, expected in ((['python', '--hostname=foo'], True),
+                               (['python', '-n', 'foo'], True),
+                               (['python', '-n', 'bar'], False),
+                               (['/bin/sleep', 'foo'], False)):
+            proc = mkdtemp()
+            try:
+                os.mkdir(os.path.join(proc, '1234'))
+                with open(os.path.join(proc, '1234', 'cmdline'), 'w') as fh:
+                    fh.write('\0'.join(argv) + '\0')
+                self.assertEqual(is_worker_of(1234, 'foo', proc=proc),
+                                 expected)
+                self.assertFalse(is_worker_of(4321, 'foo', proc=proc))
+            finally:
+                shutil.rmtree(proc)
+
+
+class test_ProcessRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ProcessRegistry()
+        self.registry.track = Mock()
+        self.children = []
+
+    def tearDown(self):
+        for pid in self.children:
+            self.registry._signal(pid, signal.SIGKILL)
+            self.registry._reap(pid)
+
+    def spawn_child(self, *argv):
+        pid = spawn_worker(list(argv))
+        self.children.append(pid)
+        return pid
+
+    def test_spawn_and_wait_for_exit(self):
+        pid = self.spawn_child('/bin/sh', '-c', 'exit 0')
+        self.assertTrue(spawn(self.registry._wait_for_exit, pid).wait())
+        self.registry._reap(pid)
+        self.assertFalse(pid_exists(pid))
+
+    def test_spawn_umask_is_octal(self):
+        with NamedTemporaryFile() as out:
+            pid = spawn_worker(['/bin/sh', '-c', 'umask'],
+                               logfile=out.name, umask='0027')
+            os.waitpid(pid, 0)
+            self.assertEqual(int(open(out.name).read().strip(), 8), 027)
+
+    def test_wait_for_exit_timeout(self):
+        pid = self.spawn_child('/bin/sleep', '10')
+        self.assertFalse(spawn(self.registry._wait_for_exit,
+                               pid, 0.1).wait())
+        self.assertTrue(pid_exists(pid))
+
+    def test_stop_signals_tracked_process(self):
+        self.registry._signal = Mock()
+        self.registry._signal.return_value = True
+        self.registry._pids['foo'] = 1234
+        self.assertEqual(self.registry.stop(mock_instance('foo')), 1234)
+        self.registry._signal.assert_called_with(1234,
+                                                 self.registry.stop_signal)
+        self.assertIsNone(self.registry.get('foo'))
+
+    def test_stop_verify_kills_after_timeout(self):
+        pid = self.spawn_child(sys.executable, '-c',
+            'import signal, time; '
+            'signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(10)')
+        sleep(0.5)  # until the handler is installed.
+        self.registry._pids['foo'] = pid
+        self.registry.stop_timeout = 0.2
+        self.registry.warn = Mock()
+        signals = []
+        signal_, self.registry._signal = self.registry._signal, \
+                lambda pid, sig: signals.append(sig) or signal_(pid, sig)
+        self.assertEqual(spawn(self.registry.stop_verify,
+                               mock_instance('foo')).wait(), pid)
+        self.assertEqual(signals, [signal.SIGTERM, signal.SIGKILL])
+        self.registry._reap(pid)
+        self.assertFalse(pid_exists(pid))
+
+    def test_stale_pidfile_not_signalled(self):
+        pid = self.spawn_child('/bin/sleep', '10')
+        with NamedTemporaryFile() as pidfile:
+            pidfile.write('%s\n' % (pid, ))
+            pidfile.flush()
+            self.registry.warn = Mock()
+            instance = mock_instance('foo', pidfile.name)
+            if os.path.isdir('/proc'):
+                self.assertIsNone(self.registry.stop(instance))
+                self.assertTrue(pid_exists(pid))
+
+    def test_track_and_forget(self):
+        registry = ProcessRegistry()
+        registry.on_process_exit = Mock()
+        pid = self.spawn_child('/bin/sleep', '10')
+        prev, state.is_branch = state.is_branch, True
+        try:
+            registry.track('foo', pid)
+        finally:
+            state.is_branch = prev
+        self.assertEqual(registry.get('foo'), pid)
+        self.assertIsNone(registry.get('bar'))
+        self.assertEqual(registry.forget('foo'), pid)
+        self.assertIsNone(registry.get('foo'))
+        self.assertIsNone(registry.forget('foo'))
+        # exit of a forgotten process is not reported.
+        registry._signal(pid, signal.SIGKILL)
+        sleep(0.2)
+        self.assertFalse(registry.on_process_exit.called)
+
+    def test_exit_tracked(self):
+        registry = ProcessRegistry()
+        registry.poll_interval = 0.05
+        registry.on_process_exit = Mock()
+        pid = self.spawn_child('/bin/sh', '-c', 'sleep 0.1')
+        prev, state.is_branch = state.is_branch, True
+        try:
+            registry.track('foo', pid)
+        finally:
+            state.is_branch = prev
+        for i in xrange(50):
+            if registry.on_process_exit.called:
+                break
+            sleep(0.1)
+        registry.on_process_exit.assert_called_with('foo', pid)
+        self.assertIsNone(registry.get('foo'))
+        self.assertFalse(pid_exists(pid))
+
+    def test_track_only_in_branch(self):
+        registry = ProcessRegistry()
+        prev, state.is_branch = state.is_branch, False
+        try:
+            registry.track('foo', 1234)
+        finally:
+            state.is_branch = prev
+        self.assertIsNone(registry.get('foo'))
+
+    def test_getpid_from_pidfile(self):
+        pid = self.spawn_child(sys.executable, '-c',
+                               'import time; time.sleep(10)',
+                               '--hostname=foo')
+        sleep(0.2)
+        with NamedTemporaryFile() as pidfile:
+            pidfile.write('%s\n' % (pid, ))
+            pidfile.flush()
+            self.assertEqual(self.registry._getpid(
+                                mock_instance('foo', pidfile.name)), pid)
+
+    def test_start(self):
+        self.registry._spawn = Mock()
+        self.registry._spawn.return_value = 1234
+        self.registry._wait_for_startup = Mock()
+        instance = mock_instance('foo')
+        self.assertEqual(self.registry.start(instance), 1234)
+        self.registry.track.assert_called_with('foo', 1234)
+        self.registry._wait_for_startup.assert_called_with(instance, 1234)
+
+        # already running.
+        instance.responds_to_signal.return_value = True
+        self.assertIsNone(self.registry.start(instance))
+        self.assertEqual(self.registry._spawn.call_count, 1)
+
+    def test_start_respects_spawn_limit(self):
+        registry = ProcessRegistry(spawn_limit=2)
+        running, peak = [0], [0]
+
+        def spawn_instance(instance, env):
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            return 1000 + running[0]
+
+        def wait_for_startup(instance, pid):
+            sleep(0.01)
+            running[0] -= 1
+
+        registry.track = Mock()
+        registry._spawn = spawn_instance
+        registry._wait_for_startup = wait_for_startup
+        jobs = [spawn(registry.start, mock_instance('i%s' % (i, )))
+                    for i in xrange(5)]
+        self.assertEqual(len(filter(None, [job.wait() for job in jobs])), 5)
+        self.assertEqual(peak[0], 2)
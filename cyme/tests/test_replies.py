@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+from __future__ import with_statement
+
+from celery.tests.utils import unittest
+from kombu import Queue
+from mock import Mock
+
+from cyme.branch.replies import ReplyConsumer, Replies
+
+
+class test_ReplyConsumer(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = ReplyConsumer('memory://')
+        self.consumer.spare_tickets = 1
+        self.exchange = self.consumer.mailbox.reply_exchange
+        self.consumer.queue = Queue('q1.reply', self.exchange,
+                                    routing_key='q1')
+        self.consumer.mailbox = Mock()
+        self.channel = Mock()
+        self.consumer_channel = Mock()
+        self.bind()
+        self.sent = []
+
+        def publish(command, arguments, destination=None,
+                reply_ticket=None, channel=None):
+            self.sent.append(reply_ticket)
+            for name in destination or ():
+                self.reply(reply_ticket, {name: command})
+        self.consumer.mailbox._publish.side_effect = publish
+
+    def bind(self):
+        self.consumer._bind_tickets(self.consumer_channel,
+                                    self.consumer.queue)
+
+    def reply(self, ticket, body):
+        message = Mock()
+        message.delivery_info = {'routing_key': ticket}
+        self.consumer._on_reply(body, message)
+        message.ack.assert_called_with()
+
+    def call(self, destination, **kwargs):
+        replies = {}
+        sent = self.consumer.call('ping', {}, destination, timeout=0.1,
+                                  limit=len(destination),
+                                  callback=replies.update,
+                                  channel=self.channel, **kwargs)
+        return replies if sent else None
+
+    def test_call(self):
+        self.assertDictEqual(self.call(['a', 'b']),
+                             {'a': 'ping', 'b': 'ping'})
+        self.assertDictEqual(self.call(['c']), {'c': 'ping'})
+        # the ticket is bound once, by the consumer, and then reused.
+        self.assertEqual(self.sent, ['q1.1', 'q1.1'])
+        self.bind()
+        self.assertFalse(self.channel.queue_bind.call_count)
+        self.assertEqual(self.consumer_channel.queue_bind.call_count, 1)
+        self.consumer_channel.queue_bind.assert_called_with(
+                queue='q1.reply', exchange='reply.celeryd.pidbox',
+                routing_key='q1.1')
+
+    def test_no_ticket_available(self):
+        self.consumer._acquire_ticket()
+        self.assertIsNone(self.call(['a']))
+        self.assertEqual(self.sent, [])
+
+    def test_timeout(self):
+        self.consumer.mailbox._publish.side_effect = \
+                lambda *args, **kwargs: self.sent.append(
+                                            kwargs['reply_ticket'])
+        self.assertDictEqual(self.call(['a']), {})
+        # late replies are ignored, and the ticket isn't reused
+        # until it's out of quarantine.
+        self.reply('q1.1', {'a': 'pong'})
+        self.bind()
+        self.call(['a'])
+        self.assertEqual(self.sent, ['q1.1', 'q1.2'])
+        self.consumer._quarantined[:] = [(0, ticket)
+                for _, ticket in self.consumer._quarantined]
+        self.call(['a'])
+        self.assertIn(self.sent[-1], ('q1.1', 'q1.2'))
+
+    def test_consume_restarted_on_error(self):
+        self.consumer.reconnect_interval = 0
+        self.consumer.error = Mock()
+        calls = []
+
+        def drain_events(conn):
+            calls.append(conn)
+            if len(calls) == 1:
+                raise KeyError('foo')
+            raise SystemExit()
+        self.consumer._drain_events = drain_events
+        with self.assertRaises(SystemExit):
+            self.consumer._consume()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.consumer.error.call_count, 1)
+
+    def test_tickets_dropped_with_queue(self):
+        self.call(['a'])
+        self.consumer._reset()
+        self.consumer.queue = Queue('q2.reply', self.exchange,
+                                    routing_key='q2')
+        self.consumer._release_ticket('q1.1', True)
+        self.assertEqual(self.consumer._free, [])
+
+
+class test_Replies(unittest.TestCase):
+
+    def test_get(self):
+        replies = Replies()
+        replies.Consumer = Mock()
+        self.assertIsNone(replies.get('memory://'))
+
+        replies.start()
+        consumer = replies.Consumer.return_value
+        consumer.ready = False
+        self.assertIsNone(replies.get('memory://'))
+        consumer.start.assert_called_with()
+        consumer.ready = True
+        self.assertIs(replies.get('memory://'), consumer)
+        self.assertEqual(replies.Consumer.call_count, 1)
+
+        replies.stop()
+        consumer.stop.assert_called_with()
+        self.assertIsNone(replies.get('memory://'))
@@ -0,0 +1,47 @@
+from __future__ import absolute_import
+
+from celery.tests.utils import unittest
+
+from cyme.branch.schedule import Schedule
+
+
+class test_Schedule(unittest.TestCase):
+
+    def setUp(self):
+        self.s = Schedule(60.0, min_interval=5.0, max_interval=300.0,
+                          jitter=0.0)
+
+    def test_spread(self):
+        self.s.spread(['a', 'b', 'c', 'd'], now=1000.0)
+        self.assertEqual(self.s.pop_due(now=1000.0), ['a'])
+        self.assertEqual(self.s.pop_due(now=1030.0), ['b', 'c'])
+        self.assertEqual(self.s.next_due(), 1045.0)
+        # instances being verified are not scheduled again.
+        self.s.spread(['a', 'b', 'e'], now=1030.0)
+        self.assertItemsEqual(self.s.pop_due(now=1030.0), ['e'])
+
+    def test_adaptive_interval(self):
+        self.s.reschedule('a', True, now=1000.0)
+        self.assertEqual(self.s.interval_for('a'), 90.0)
+        for i in xrange(10):
+            self.s.reschedule('a', True, now=1000.0)
+        self.assertEqual(self.s.interval_for('a'), 300.0)
+        self.s.reschedule('a', None, now=1000.0)
+        self.assertEqual(self.s.interval_for('a'), 300.0)
+        self.s.reschedule('a', False, now=1000.0)
+        self.assertEqual(self.s.interval_for('a'), 5.0)
+        self.assertEqual(self.s.next_due(), 1005.0)
+
+    def test_add_only_moves_due_time_forward(self):
+        self.s.reschedule('a', False, now=1000.0)
+        self.s.add('a', 1001.0)
+        self.s.add('a', 2000.0)
+        self.assertFalse(self.s.pop_due(now=1000.5))
+        self.assertEqual(self.s.pop_due(now=1001.0), ['a'])
+        self.assertFalse(self.s.pop_due(now=3000.0))
+
+    def test_forget(self):
+        self.s.spread(['a', 'b'], now=1000.0)
+        self.s.forget('a')
+        self.assertNotIn('a', self.s)
+        self.assertEqual(self.s.pop_due(now=2000.0), ['b'])
@@ -0,0 +1,70 @@
+from __future__ import absolute_import
+
+from django.test import TestCase
+
+from cyme.branch.snapshots import InstanceSnapshotCache, SnapshotCache
+from cyme.models import App, Instance, Queue
+
+
+class test_SnapshotCache(TestCase):
+
+    def setUp(self):
+        Queue.objects.all().delete()
+        self.cache = SnapshotCache(Queue)
+        self.cache.connect()
+
+    def tearDown(self):
+        self.cache.disconnect()
+
+    def test_read_through(self):
+        Queue.objects.add('foo')
+        self.assertEqual(self.cache.names(), ['foo'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.get('foo')['name'], 'foo')
+            with self.assertRaises(Queue.DoesNotExist):
+                self.cache.get('bar')
+
+        # changes made in this process are applied by signals.
+        Queue.objects.add('bar', exchange='bar')
+        Queue.objects.filter(name='foo').delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.names(), ['bar'])
+            self.assertEqual(self.cache.get('bar')['exchange'], 'bar')
+
+    def test_check(self):
+        Queue.objects.add('foo')
+        self.cache.names()
+        # update() doesn't send signals.
+        Queue.objects.filter(name='foo').update(exchange='changed')
+        self.assertEqual(self.cache.check(), ['foo'])
+        self.assertEqual(self.cache.get('foo')['exchange'], 'changed')
+        self.assertEqual(self.cache.check(), [])
+
+    def test_disconnected_reads_database(self):
+        self.cache.disconnect()
+        Queue.objects.add('foo')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.cache.get('foo')['name'], 'foo')
+
+
+class test_InstanceSnapshotCache(TestCase):
+
+    def setUp(self):
+        self.cache = InstanceSnapshotCache(Instance)
+        self.cache.connect()
+
+    def tearDown(self):
+        self.cache.disconnect()
+
+    def test_queues_changed(self):
+        app = App.objects.create(name='snap')
+        Instance.objects.create(name='a', app=app, queues=['foo'])
+        Instance.objects.create(name='b')
+        self.assertEqual(self.cache.names(app='snap'), ['a'])
+        self.assertEqual(self.cache.indexed('app')['a'], 'snap')
+        self.assertEqual(self.cache.get('a')['queues'], ['foo'])
+
+        Instance.objects.add_queue_to_instances('bar', name='a')
+        self.assertEqual(self.cache.get('a')['queues'], ['foo', 'bar'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.get('a')['queues'], ['foo', 'bar'])
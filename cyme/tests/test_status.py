@@ -0,0 +1,170 @@
+from __future__ import absolute_import
+
+from celery.tests.utils import unittest
+from mock import Mock
+
+from cyme.branch.state import state
+from cyme.models import RestartState
+from cyme.status import Status
+
+
+def mock_instance(name, url='amqp://'):
+    instance = Mock()
+    instance.name = name
+    instance.broker.url = url
+    instance.broker.broadcast.return_value = {name: {'ok': 'pong'}}
+    return instance
+
+
+class test_Status(unittest.TestCase):
+
+    def setUp(self):
+        self.status = Status()
+        self.status.insured_broker = Mock()
+        self.status.insured_broker.side_effect = \
+                lambda broker, fun, *args, **kwargs: fun(*args, **kwargs)
+
+    def test_inspect_all_one_broadcast_per_broker(self):
+        a, b = mock_instance('a'), mock_instance('b')
+        c = mock_instance('c', url='amqp://other//')
+        a.broker.broadcast.return_value = {'a': {}, 'b': {}}
+        c.broker.broadcast.return_value = {'c': {}}
+
+        replies = self.status.inspect_all([a, b, c])
+        self.assertItemsEqual(replies.keys(), ['a', 'b', 'c'])
+        a.broker.broadcast.assert_called_with('cyme_inspect', {},
+                                              destination=['a', 'b'],
+                                              timeout=Status.ping_timeout)
+        self.assertFalse(b.broker.broadcast.called)
+        c.broker.broadcast.assert_called_with('cyme_inspect', {},
+                                              destination=['c'],
+                                              timeout=Status.ping_timeout)
+
+    def test_verify_from_snapshot(self):
+        instance = mock_instance('a')
+        instance.max_concurrency, instance.min_concurrency = 4, 2
+        instance.queues = ['foo', 'bar']
+        instance.direct_queue = 'dq.a'
+        instance.responds_to_signal.return_value = True
+        self.status.ib = Mock()
+        self.status.insured = Mock()
+        replies = {'a': {'autoscaler': {'max': 4, 'min': 1},
+                         'active_queues': [{'name': 'foo'},
+                                           {'name': 'baz'},
+                                           {'name': 'dq.a'}]}}
+
+        self.assertTrue(self.status._do_verify_instance(instance,
+                                                        replies=replies))
+        self.status.ib.assert_any_call(instance.autoscale, 4, 2)
+        self.status.ib.assert_any_call(instance.add_queue, 'bar')
+        self.status.ib.assert_any_call(instance.cancel_queue, 'baz')
+        self.assertEqual(self.status.ib.call_count, 3)
+        self.assertFalse(self.status.insured.called)
+
+    def test_is_alive_uses_replies(self):
+        self.status.ib = Mock()
+        instance = mock_instance('a')
+        instance.responds_to_signal.return_value = True
+        self.assertTrue(self.status._is_alive(instance, {'a': 'pong'}))
+        self.assertFalse(self.status.ib.called)
+
+    def test_is_alive_missing_reply_pings_instance(self):
+        self.status.ib = Mock()
+        self.status.ib.return_value = False
+        instance = mock_instance('a')
+        self.assertFalse(self.status._is_alive(instance, {}))
+        self.status.ib.assert_called_with(instance.alive)
+
+    def test_is_alive_uses_heartbeats(self):
+        self.status.ib = Mock()
+        monitor, state.monitor = state.monitor, Mock()
+        try:
+            instance = mock_instance('a')
+            instance.responds_to_signal.return_value = True
+            state.monitor.is_alive.return_value = True
+            self.assertTrue(self.status._is_alive(instance))
+            state.monitor.is_alive.return_value = False
+            self.assertFalse(self.status._is_alive(instance))
+            self.assertFalse(self.status.ib.called)
+            self.assertFalse(self.status.inspect_all([instance]))
+
+            state.monitor.is_alive.return_value = None
+            self.status._is_alive(instance)
+            self.status.ib.assert_called_with(instance.alive)
+        finally:
+            state.monitor = monitor
+
+    def test_rolling(self):
+        instances = [mock_instance(name) for name in 'abcdef']
+        progress = Mock()
+        failed = self.status.rolling(lambda i: i.name not in ('b', 'e'),
+                                     instances, batch_size=2,
+                                     progress=progress)
+        self.assertEqual(failed, ['b', 'e'])
+        self.assertEqual([c[0][:2] for c in progress.call_args_list],
+                         [(2, 6), (4, 6), (6, 6)])
+
+    def test_start_all_no_ping_after_restart(self):
+        up, down = mock_instance('up'), mock_instance('down')
+        for instance in up, down:
+            instance.is_enabled = True
+            instance.responds_to_signal.return_value = True
+        self.status.all_instances = Mock(return_value=[up, down])
+        self.status.inspect_all = Mock(return_value={'up': None})
+        self.status.ib = Mock(return_value=None)
+        self.status._do_verify_instance = Mock()
+        self.status._do_restart_instance = Mock(return_value=True)
+        self.assertEqual(self.status.start_all(), [])
+        self.status._do_restart_instance.assert_called_once_with(down)
+        # only the instance missing from the replies is pinged, once.
+        self.status.ib.assert_called_once_with(down.alive)
+        verified = self.status._do_verify_instance.call_args
+        self.assertIs(verified[0][0], up)
+
+    def test_rolling_aborts(self):
+        instances = [mock_instance(name) for name in 'abcdef']
+        fun = Mock()
+        fun.side_effect = KeyError('foo')
+        self.status.error = Mock()
+        with self.assertRaises(Status.RollingAborted):
+            self.status.rolling(fun, instances, batch_size=2,
+                                max_failure_rate=0.5)
+        self.assertEqual(fun.call_count, 2)
+
+    def test_restart_backoff(self):
+        self.status._verify_restart_instance = Mock()
+        instance = mock_instance('a')
+        try:
+            self.status._do_restart_instance(instance, ratelimit=True)
+            self.status._do_restart_instance(instance, ratelimit=True)
+            self.assertEqual(
+                self.status._verify_restart_instance.call_count, 1)
+            restarts = RestartState.objects.get(name='a')
+            self.assertEqual((restarts.restarts, restarts.failures), (1, 1))
+            self.assertTrue(restarts.in_backoff())
+
+            # state survives restarting the supervisor.
+            status = Status()
+            self.assertIn('a', status.failing)
+
+            # restarting by request resets the failure count.
+            self.status._do_restart_instance(instance)
+            restarts = RestartState.objects.get(name='a')
+            self.assertEqual((restarts.restarts, restarts.failures), (2, 0))
+            self.assertNotIn('a', self.status.failing)
+        finally:
+            RestartState.objects.all().delete()
+
+    def test_restart_disables_failing_instance(self):
+        self.status._verify_restart_instance = Mock()
+        self.status.error = Mock()
+        instance = mock_instance('a')
+        RestartState.objects.create(name='a', restarts=10,
+                failures=Status.max_restart_failures)
+        try:
+            self.status._do_restart_instance(instance, ratelimit=True)
+            instance.disable.assert_called_with()
+            self.assertFalse(self.status._verify_restart_instance.called)
+            self.assertEqual(RestartState.objects.get(name='a').failures, 0)
+        finally:
+            RestartState.objects.all().delete()
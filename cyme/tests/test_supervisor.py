@@ -0,0 +1,179 @@
+from __future__ import absolute_import
+
+from time import time
+
+from celery.tests.utils import unittest
+from django.db import DatabaseError
+from eventlet import sleep
+from mock import Mock
+
+from cyme.branch.state import state
+from cyme.branch.supervisor import BACKGROUND, Job, JobQueue, Supervisor
+from cyme.branch.thread import gThread
+from cyme.models import Instance
+
+
+def mock_instance(name):
+    instance = Mock()
+    instance.name = name
+    return instance
+
+
+class test_Supervisor(unittest.TestCase):
+
+    def setUp(self):
+        self._ginit, gThread.__init__ = gThread.__init__, Mock()
+        self.sup = Supervisor(set_as_current=False, pool_size=4)
+        self.sup.respond_to_ping = Mock()
+
+    def tearDown(self):
+        gThread.__init__ = self._ginit
+
+    def test_same_instance_actions_are_ordered(self):
+        calls = []
+
+        def action(instance, n=None):
+            sleep(0.01 if (instance.name, n) == ('a', 1) else 0)
+            calls.append((instance.name, n))
+
+        a, b = mock_instance('a'), mock_instance('b')
+        jobs = [self.sup._spawn_action(a, action, {'n': 1}),
+                self.sup._spawn_action(b, action, {'n': 1}),
+                self.sup._spawn_action(a, action, {'n': 2})]
+        [job.wait() for job in jobs]
+        self.assertLess(calls.index(('a', 1)), calls.index(('a', 2)))
+        self.assertLess(calls.index(('b', 1)), calls.index(('a', 1)))
+        self.assertFalse(self.sup._inflight)
+
+    def test_event_sent_when_all_done(self):
+        action = Mock()
+        action.side_effect = KeyError('foo')
+        self.sup.error = Mock()
+        event = Mock()
+        jobs = [self.sup._spawn_action(mock_instance(name), action, {})
+                    for name in ('a', 'b', 'c')]
+        self.sup._send_when_done(jobs, event)
+        event.send.assert_called_with(True)
+        self.assertEqual(action.call_count, 3)
+        self.assertEqual(self.sup.error.call_count, 3)
+
+    def test_dispatch_survives_errors(self):
+        self.sup.error = Mock()
+        action = Mock()
+        a = mock_instance('a')
+        job = Job(a, action, {}, BACKGROUND, None)
+        results = [RuntimeError('JobQueue: ready but no jobs'), job]
+
+        def get(timeout=None):
+            if len(results) == 1:
+                self.sup.should_stop = True
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        self.sup.jobs.get = get
+        self.sup._dispatch()
+        self.assertEqual(self.sup.error.call_count, 1)
+        job.wait()
+        action.assert_called_with(a)
+
+    def test_changed_while_verifying_is_due_again(self):
+        instance = mock_instance('a')
+
+        def verify(*args, **kwargs):
+            self.sup.mark_dirty('a')
+            return True
+
+        self.sup.inspect_all = Mock()
+        self.sup.inspect_all.return_value = {}
+        self.sup._is_alive = Mock()
+        self.sup._is_alive.side_effect = verify
+        self.sup._verify_instance_processes = Mock()
+        self.sup._verify_instance_queues = Mock()
+        self.sup._do_verify_instance(instance)
+        self.assertEqual(self.sup.schedule.pop_due(), ['a'])
+
+    def test_due_rescheduled_if_lookup_fails(self):
+        self.sup.schedule.add('a', 0)
+        self.sup.error = Mock()
+        self.sup.verify = Mock()
+        for_sweep = Instance._default_manager.for_sweep
+        Instance._default_manager.for_sweep = Mock()
+        Instance._default_manager.for_sweep.side_effect = DatabaseError(
+                'database is locked')
+        try:
+            self.sup._verify_due()
+        finally:
+            Instance._default_manager.for_sweep = for_sweep
+        self.assertTrue(self.sup.error.called)
+        self.assertFalse(self.sup.verify.called)
+        self.assertIn('a', self.sup.schedule)
+        self.assertEqual(self.sup.schedule.pop_due(now=time() + 1e6), ['a'])
+
+    def test_restart_waits_for_online_event(self):
+        monitor, state.monitor = state.monitor, Mock()
+        try:
+            instance = mock_instance('a')
+            instance.restart.side_effect = lambda: self.assertTrue(
+                    state.monitor.expect_online.called)
+            self.sup.verify = Mock()
+            self.sup.insured = Mock()
+            self.sup.info = Mock()
+            self.assertIsNone(self.sup._verify_restart_instance(instance))
+            instance.restart.assert_called_with()
+            name, timeout, callback = state.monitor.expect_online.call_args[0]
+            self.assertEqual(name, 'a')
+            self.assertFalse(self.sup.insured.called)
+
+            # not restarted again by the sweep while starting up.
+            self.sup._is_alive = Mock()
+            self.assertIsNone(self.sup._do_verify_instance(instance))
+            self.assertFalse(self.sup._is_alive.called)
+
+            callback('a', True)
+            self.sup.verify.assert_called_with([instance])
+            self.assertNotIn('a', self.sup._restarting)
+
+            self.sup.verify.reset_mock()
+            self.sup.insured.return_value = False
+            callback('a', False)
+            self.sup.insured.assert_called_with(instance,
+                                                instance.responds_to_ping)
+            self.assertFalse(self.sup.verify.called)
+        finally:
+            state.monitor = monitor
+
+
+class test_JobQueue(unittest.TestCase):
+
+    def test_interactive_lane_first(self):
+        jobs = JobQueue()
+        a, b, c = mock_instance('a'), mock_instance('b'), mock_instance('c')
+        jobs.put(a, 'verify', lane=BACKGROUND)
+        jobs.put(b, 'verify', lane=BACKGROUND)
+        jobs.put(c, 'restart')
+        self.assertEqual([jobs.get().instance.name for i in xrange(3)],
+                         ['c', 'a', 'b'])
+        self.assertFalse(len(jobs))
+
+    def test_coalesce(self):
+        jobs = JobQueue()
+        a = mock_instance('a')
+        j1 = jobs.put(a, 'verify', {'ratelimit': True}, lane=BACKGROUND)
+        self.assertIs(jobs.put(a, 'verify', {'ratelimit': True}), j1)
+        self.assertIsNot(jobs.put(a, 'verify', {'ratelimit': False}), j1)
+        self.assertEqual(len(jobs), 2)
+        self.assertIs(jobs.get(), j1)
+        # job already started, so a new job is needed.
+        self.assertIsNot(jobs.put(a, 'verify', {'ratelimit': True}), j1)
+
+    def test_order_kept_for_same_instance(self):
+        jobs = JobQueue()
+        a, b = mock_instance('a'), mock_instance('b')
+        jobs.put(b, 'verify', lane=BACKGROUND)
+        jobs.put(a, 'verify', lane=BACKGROUND)
+        jobs.put(a, 'shutdown')
+        self.assertEqual([(j.instance.name, j.action)
+                            for j in (jobs.get(), jobs.get(), jobs.get())],
+                         [('a', 'verify'), ('a', 'shutdown'),
+                          ('b', 'verify')])
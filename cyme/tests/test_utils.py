@@ -0,0 +1,38 @@
+from __future__ import absolute_import
+
+from celery.tests.utils import unittest
+from mock import patch
+
+from cyme.utils import ExpiringLRUCache
+
+
+class test_ExpiringLRUCache(unittest.TestCase):
+
+    def test_limit(self):
+        cache = ExpiringLRUCache(limit=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(len(cache), 2)
+
+    @patch('cyme.utils.time')
+    def test_ttl(self, time):
+        cache = ExpiringLRUCache(ttl=10)
+        time.return_value = 100
+        cache.put('a', 1)
+        time.return_value = 110
+        self.assertEqual(cache.get('a'), 1)
+        time.return_value = 111
+        with self.assertRaises(KeyError):
+            cache.get('a')
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate(self):
+        cache = ExpiringLRUCache()
+        cache.put('a', 1)
+        cache.invalidate('a')
+        cache.invalidate('b')
+        self.assertNotIn('a', cache)
@@ -4,8 +4,10 @@ from __future__ import absolute_import
 import sys
 
 from importlib import import_module
+from time import time
 
 from celery import current_app as celery
+from celery.datastructures import LRUCache
 from celery.utils import get_cls_by_name
 from celery.utils import promise, maybe_promise # noqa
 from kombu.utils import uuid, cached_property   # noqa
@@ -133,6 +135,52 @@ def redirect_stdouts_to_logger(loglevel='INFO', logfile=None,
                     redirect_level, stdout=stdout, stderr=stderr)
 
 
+class ExpiringLRUCache(object):
+    """Cache keeping the most recently used values,
+    for a limited time.
+
+    :keyword limit: Max number of keys to keep, the least recently
+        used key is discarded when the limit is exceeded.
+    :keyword ttl: Time in seconds (int/float) values are kept for.
+
+    """
+
+    def __init__(self, limit=None, ttl=None):
+        self.ttl = ttl
+        self._data = LRUCache(limit=limit)
+
+    def get(self, key):
+        """Returns the value cached for ``key``.
+
+        :raises KeyError: if the key is not cached, or has expired.
+
+        """
+        expires, value = self._data[key]
+        if expires is not None and expires < time():
+            self.invalidate(key)
+            raise KeyError(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = (time() + self.ttl if self.ttl else None, value)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        try:
+            self.get(key)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._data)
+
+
 class LazyProgressBar(object):
 
     def __init__(self, size, description=None, endtext=None):
@@ -1,10 +1,19 @@
 from __future__ import absolute_import
+from __future__ import with_statement
+
+import socket
+
+from collections import deque
+from time import time
 
 from celery.app import app_or_default
 
 import cell
 import cell.presence
 
+from kombu import Consumer
+from kombu.utils import cached_property
+
 
 def construct(cls, instance, connection=None, *args, **kwargs):
     app = instance.app = app_or_default(kwargs.pop('app', None))
@@ -12,11 +21,51 @@ def construct(cls, instance, connection=None, *args, **kwargs):
                                   *args, **kwargs)
 
 
+def collect_replies(conn, channel, queue, limit=None, timeout=None,
+        callback=None, **kwargs):
+    """Yields the replies received on ``queue`` as they arrive,
+    until ``limit`` replies have been received, or ``timeout``
+    seconds have passed since the first call."""
+    deadline = time() + timeout if timeout else None
+    received = deque()
+
+    def on_message(body, message):
+        received.append(body)
+        if callback:
+            callback(body)
+
+    count = 0
+    with Consumer(channel, [queue], callbacks=[on_message], no_ack=True):
+        while limit is None or count < limit:
+            remaining = deadline - time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                break
+            try:
+                conn.drain_events(timeout=remaining)
+            except socket.timeout:
+                break
+            while received and (limit is None or count < limit):
+                count += 1
+                yield received.popleft()
+    if count:
+        channel.after_reply_message_received(queue.name)
+
+
 class Actor(cell.Actor):
 
     def __init__(self, *args, **kwargs):
         construct(Actor, self, *args, **kwargs)
 
+    def _collect_replies(self, conn, channel, ticket, *args, **kwargs):
+        # the timeout applies to collecting all replies, not to waiting
+        # for each of them, and a scatter completes as soon as every
+        # live agent replied (see :meth:`get_default_scatter_limit`).
+        kwargs.setdefault('timeout', self.default_timeout)
+        if 'limit' not in kwargs:
+            kwargs['limit'] = self.get_default_scatter_limit()
+        return collect_replies(conn, channel, self.get_reply_queue(ticket),
+                               *args, **kwargs)
+
 
 class Agent(cell.Agent):
 
@@ -24,7 +73,93 @@ class Agent(cell.Agent):
         construct(Agent, self, *args, **kwargs)
 
 
+class RoutingState(cell.presence.State):
+    """Presence state also keeping a routing table, mapping the values
+    in the lookup sections of the actors' meta (like the names of the
+    instances in ``Instance.meta['instances']``) to the agent announcing
+    them, which is updated as announcements arrive.
+
+    Objects in :attr:`listeners` are also told about every announcement
+    (``listener.update(agent, meta, ts)``), and about agents that are
+    gone (``listener.remove(agent)``).
+
+    """
+
+    def __init__(self, presence):
+        super(RoutingState, self).__init__(presence)
+        self.listeners = []
+        self._routes = {}      # {(actor, section): {value: agent}}
+        self._announced = {}   # {agent: {(actor, section): set(values)}}
+
+    def can(self, actor):
+        # agents that went offline, or expired, are left as empty dicts.
+        return set(id.partition('.')[0]
+                    for id, state in self.agents.iteritems()
+                        if actor in state.get('actors', ()))
+
+    def route(self, actor, section, value):
+        """Returns the id of the agent that announced ``value``
+        in the ``section`` of ``actor``'s meta.
+
+        :raises KeyError: if no agent announced it.
+
+        """
+        return self._routes[(actor, section)][value]
+
+    def update_meta_for(self, agent, meta):
+        super(RoutingState, self).update_meta_for(agent, meta)
+        announced = {}
+        for actor, sections in meta.iteritems():
+            for section, values in (sections or {}).iteritems():
+                if isinstance(values, (list, tuple)):
+                    announced[(actor, section)] = set(values)
+        previous = self._announced.get(agent, {})
+        for key in set(previous) | set(announced):
+            routes = self._routes.setdefault(key, {})
+            values = announced.get(key, set())
+            for value in previous.get(key, set()) - values:
+                if routes.get(value) == agent:
+                    del routes[value]
+            for value in values:
+                routes[value] = agent
+        self._announced[agent] = announced
+
+    def _update_agent(self, agent, kw):
+        super(RoutingState, self)._update_agent(agent, kw)
+        if kw.get('meta'):
+            for listener in self.listeners:
+                listener.update(agent, kw['meta'], kw.get('ts'))
+
+    def _remove_agent(self, agent):
+        super(RoutingState, self)._remove_agent(agent)
+        for listener in self.listeners:
+            listener.remove(agent)
+        for key, values in self._announced.pop(agent, {}).iteritems():
+            routes = self._routes.get(key, {})
+            for value in values:
+                if routes.get(value) == agent:
+                    del routes[value]
+
+
+class Presence(cell.presence.Presence):
+    State = RoutingState
+
+
 class AwareAgent(cell.presence.AwareAgent):
 
     def __init__(self, *args, **kwargs):
         construct(AwareAgent, self, *args, **kwargs)
+
+    @cached_property
+    def presence(self):
+        return Presence(self, on_awake=self.on_awake)
+
+
+class AwareActorMixin(cell.presence.AwareActorMixin):
+
+    def lookup(self, value):
+        # find the owner in the routing table, instead of searching
+        # the meta of every agent.
+        if self.agent:
+            return self.agent.presence.state.route(
+                        self.name, self.meta_lookup_section, value)